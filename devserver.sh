@@ -1,3 +1,3 @@
 #!/bin/sh
 source .venv/bin/activate
-python -m flask --app main run -p $PORT --debug
\ No newline at end of file
+python -m flask --app 'main:create_app()' run -p $PORT --debug
\ No newline at end of file
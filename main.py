@@ -1,28 +1,58 @@
+import time
+# Measured from the first line so cold-start cost shows up in /api/ready
+_import_started = time.perf_counter()
+
 import os
 from datetime import datetime, timedelta
-from flask import Flask, send_file, redirect, url_for, request, jsonify, render_template, make_response, Response
+from flask import Flask, send_file, redirect, url_for, request, jsonify, render_template, Response, g, has_app_context
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING, DESCENDING, UpdateOne, ReturnDocument, CursorType
+from pymongo.errors import DuplicateKeyError
 from bson import ObjectId
 from werkzeug.security import generate_password_hash, check_password_hash
 from dotenv import load_dotenv
 import random
 import string
-import google.generativeai as genai
-from google.generativeai import types, GenerationConfig
+import importlib
 import json
+import click
 from bson import Binary
 import io
 import traceback
-import tempfile
-import pathlib
+import threading
+from collections import OrderedDict, Counter
+from abc import ABC, abstractmethod
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
 from io import BytesIO
 import re
 import base64
+import hashlib
+import math
+import unicodedata
+from urllib.parse import quote
 from flask_cors import CORS
-from PIL import Image, ImageDraw
 from gridfs import GridFS
 
+class LazyModule:
+    """
+    Stand-in for a heavy module that is only imported on first attribute
+    access, so importing main.py (every gunicorn worker boot) does not pay
+    for SDKs that a given process may never touch.
+    """
+    
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+    
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+genai = LazyModule("google.generativeai")
+google_exceptions = LazyModule("google.api_core.exceptions")
+
 # Add a custom JSON encoder to handle ObjectId and datetime
 class MongoJSONEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -75,49 +105,393 @@ def pdf_to_images(pdf_bytes):
     # Return as a list for compatibility with existing code
     return [img]
 
-load_dotenv()
+load_dotenv(override=True)
 app = Flask(__name__, template_folder="src", static_folder="src", static_url_path="")
 app.json_encoder = MongoJSONEncoder
 
-# Debug logging for API key
-print("\n=== Gemini API Configuration Debug ===")
-print("Current working directory:", os.getcwd())
-print("Checking .env file exists:", os.path.exists(".env"))
-if os.path.exists(".env"):
-    with open(".env", "r") as f:
-        env_contents = f.read()
-        print("Number of lines in .env:", len(env_contents.splitlines()))
-
-# Force reload environment variables
-load_dotenv(override=True)
-
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-print(f"API Key loaded from .env: {'Yes' if GEMINI_API_KEY else 'No'}")
-print(f"API Key length: {len(GEMINI_API_KEY) if GEMINI_API_KEY else 0}")
-print(f"First 4 chars of API key: {GEMINI_API_KEY[:4] if GEMINI_API_KEY else 'None'}")
-print("=====================================\n")
 
-if not GEMINI_API_KEY:
-    raise Exception("GEMINI_API_KEY not set in .env file")
+# ============ LLM BACKENDS ============
 
-if not GEMINI_API_KEY.startswith("AIza"):
-    raise Exception("Invalid GEMINI_API_KEY format. Should start with 'AIza'")
+# Which backend serves LLM calls: "gemini" (default) or "stub" for offline load testing
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini").lower()
+GEMINI_MODEL_NAME = "gemini-2.0-flash"
 
-try:
-    # Configure the Gemini API with debug mode
-    print("Attempting to configure Gemini API...")
-    genai.configure(api_key=GEMINI_API_KEY, transport="rest")
-    # Initialize the model
-    gemini_model = genai.GenerativeModel('gemini-2.0-flash')
-    gemini_pro_vision = genai.GenerativeModel('gemini-2.0-flash')
-
-    # Test the API connection
-    print("Testing API connection...")
-    response = gemini_model.generate_content("Hello, Gemini!")
-    print("API connection test successful.")
-except Exception as e:
-    print(f"Error configuring Gemini API: {e}")
-    raise
+class LLMBackend(ABC):
+    """
+    Interface every LLM backend implements. Call sites go through
+    gemini_client, which passes the call name so backends can tell the
+    tasks apart. Responses only need a `.text` attribute; with stream=True
+    they are an iterable of chunks that each have `.text`. A `timeout`
+    keyword (seconds) bounds a single request.
+    """
+    name = "base"
+    
+    @abstractmethod
+    def generate_content(self, call_name, model_name, contents, **kwargs):
+        """Run one generation call and return the response"""
+    
+    @abstractmethod
+    def start_chat(self, model_name, history):
+        """Return a chat session object with send_message(text)"""
+    
+    def config_error(self):
+        """Why the backend cannot serve calls, or None"""
+        return None
+
+class GeminiBackend(LLMBackend):
+    """Google Gemini through google.generativeai"""
+    name = "gemini"
+    
+    def __init__(self):
+        self._models = {}
+        self._configured = False
+        self._lock = threading.Lock()
+    
+    def config_error(self):
+        """Why the API key cannot be used, or None. Checked locally, no network call."""
+        if not GEMINI_API_KEY:
+            return "GEMINI_API_KEY not set in .env file"
+        if not GEMINI_API_KEY.startswith("AIza"):
+            return "Invalid GEMINI_API_KEY format. Should start with 'AIza'"
+        return None
+    
+    def model(self, model_name):
+        """Configure the SDK and build the model on first use"""
+        with self._lock:
+            if not self._configured:
+                error = self.config_error()
+                if error:
+                    raise Exception(error)
+                genai.configure(api_key=GEMINI_API_KEY, transport="rest")
+                self._configured = True
+            if model_name not in self._models:
+                self._models[model_name] = genai.GenerativeModel(model_name)
+            return self._models[model_name]
+    
+    def generate_content(self, call_name, model_name, contents, timeout=None, **kwargs):
+        if timeout:
+            # Only passed when set; request_options needs google-generativeai >= 0.4
+            kwargs["request_options"] = {"timeout": timeout}
+        return self.model(model_name).generate_content(contents, **kwargs)
+    
+    def start_chat(self, model_name, history):
+        return self.model(model_name).start_chat(history=history)
+
+class StubLLMBackend(LLMBackend):
+    """
+    Deterministic offline stand-in for Gemini, for load testing.
+    
+    Output is derived from a hash of the input, so identical inputs give
+    identical results, and is shaped like the real responses: numbered
+    question text for extraction, fenced JSON for segregation, mapping and
+    grading. LLM_STUB_LATENCY_MS (mean, +/-50% jitter) and
+    LLM_STUB_ERROR_RATE (fraction of calls raising 503/429) simulate the
+    upstream.
+    """
+    name = "stub"
+    
+    def __init__(self, latency_ms, error_rate, questions):
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.questions = questions
+    
+    @staticmethod
+    def _contents_text(contents):
+        """Flatten prompt contents (strings, parts dicts, role/parts messages) into text"""
+        if isinstance(contents, str):
+            return contents
+        if isinstance(contents, dict):
+            if "parts" in contents:
+                return StubLLMBackend._contents_text(contents["parts"])
+            return contents.get("text", "")
+        if isinstance(contents, (list, tuple)):
+            return "\n".join(StubLLMBackend._contents_text(item) for item in contents)
+        return ""
+    
+    @staticmethod
+    def _contents_digest(contents):
+        """Stable hash of the prompt, including any inline file bytes"""
+        digest = hashlib.sha256()
+        for item in contents if isinstance(contents, (list, tuple)) else [contents]:
+            if isinstance(item, dict) and isinstance(item.get("data"), (bytes, bytearray)):
+                digest.update(bytes(item["data"]))
+            elif isinstance(item, (bytes, bytearray)):
+                digest.update(bytes(item))
+            else:
+                digest.update(StubLLMBackend._contents_text(item).encode("utf-8"))
+        return digest.hexdigest()
+    
+    def _simulate_upstream(self):
+        if self.latency_ms > 0:
+            time.sleep(self.latency_ms * random.uniform(0.5, 1.5) / 1000.0)
+        if self.error_rate > 0 and random.random() < self.error_rate:
+            if random.random() < 0.5:
+                raise google_exceptions.TooManyRequests("Stub backend simulated rate limit")
+            raise google_exceptions.ServiceUnavailable("Stub backend simulated outage")
+    
+    def _extracted_text(self, seed):
+        lines = ["Instructions: answer all questions."]
+        for number in range(1, self.questions + 1):
+            lines.append(f"{number}. Stub content {seed[number % len(seed):][:8]} for question {number}, "
+                         f"covering definition, worked example and conclusion.")
+        return "\n".join(lines)
+    
+    @staticmethod
+    def _segregate(prompt):
+        text = prompt.split("Extracted Text:", 1)[-1]
+        sections = {"0": "notes" if "student's answer" in prompt else "preamble"}
+        for match in re.finditer(r'^\s*(?:Question\s+)?(\d+)[.):]?\s+(.+)$', text, re.MULTILINE):
+            sections[match.group(1)] = match.group(2).strip()
+        return sections
+    
+    @staticmethod
+    def _grade(seed, max_marks):
+        score = round(max_marks * (0.4 + 0.6 * int(seed[:4], 16) / 0xFFFF), 1)
+        return {
+            "score": score,
+            "feedback": "Stub grade: the answer covers the main idea but misses some detail.",
+            "key_points_addressed": ["Main definition"],
+            "key_points_missed": ["Supporting example"],
+            "improvement_suggestions": ["Add a worked example."]
+        }
+    
+    @staticmethod
+    def _stream(text, chunk_chars=40):
+        """Yield the reply in small chunks, like a streamed Gemini response"""
+        for start in range(0, len(text), chunk_chars):
+            time.sleep(0.02)
+            yield SimpleNamespace(text=text[start:start + chunk_chars])
+    
+    def generate_content(self, call_name, model_name, contents, stream=False, **kwargs):
+        self._simulate_upstream()
+        prompt = self._contents_text(contents)
+        seed = self._contents_digest(contents)
+        
+        if call_name in ("extract_pdf_text", "extract_image_text"):
+            text = self._extracted_text(seed)
+        elif call_name == "segregate":
+            text = f"```json\n{json.dumps(self._segregate(prompt))}\n```"
+        elif call_name == "map_answers":
+            question_ids = re.findall(r'"id":\s*"([^"]+)"', prompt)
+            text = json.dumps([
+                {"question_id": question_id, "student_answer": f"Stub answer for question {question_id}."}
+                for question_id in question_ids
+            ])
+        elif call_name.startswith("grade"):
+            max_match = re.search(r'worth (\d+) marks|MAXIMUM SCORE: (\d+(?:\.\d+)?)|out of (\d+) points', prompt)
+            max_marks = float(next(group for group in max_match.groups() if group)) if max_match else 20
+            text = f"```json\n{json.dumps(self._grade(seed, max_marks))}\n```"
+        else:
+            text = f"(stub) This is a canned reply for {call_name}."
+        if stream:
+            return self._stream(text)
+        return SimpleNamespace(text=text)
+    
+    def start_chat(self, model_name, history):
+        backend = self
+        
+        class StubChat:
+            def __init__(self):
+                self.history = list(history)
+            
+            def send_message(self, message, stream=False):
+                self.history.append({"role": "user", "parts": [message]})
+                response = backend.generate_content("chat_doubt", model_name, message)
+                self.history.append({"role": "model", "parts": [response.text]})
+                if stream:
+                    return backend._stream(response.text)
+                return response
+        
+        return StubChat()
+
+def create_llm_backend(name):
+    """Build the backend selected by LLM_BACKEND"""
+    if name == "stub":
+        return StubLLMBackend(
+            latency_ms=float(os.getenv("LLM_STUB_LATENCY_MS", "800")),
+            error_rate=float(os.getenv("LLM_STUB_ERROR_RATE", "0")),
+            questions=int(os.getenv("LLM_STUB_QUESTIONS", "5"))
+        )
+    if name == "gemini":
+        return GeminiBackend()
+    raise ValueError(f"Unknown LLM_BACKEND '{name}' (expected 'gemini' or 'stub')")
+
+llm_backend = create_llm_backend(LLM_BACKEND)
+
+# ============ GEMINI CLIENT ============
+
+class LLMUnavailableError(Exception):
+    """Raised when a Gemini call is refused locally (circuit open or rate limit wait exceeded)"""
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, bursting up to `capacity`"""
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self, timeout):
+        """Take one token, waiting up to `timeout` seconds. Returns False if none became available."""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+class GeminiClient:
+    """
+    Single entry point for every Gemini call.
+    
+    - A shared token bucket keeps the process under GEMINI_REQUESTS_PER_MINUTE.
+    - 429 and 5xx/timeout errors are retried with exponential backoff and full jitter.
+    - After GEMINI_BREAKER_FAILURES consecutive upstream failures the circuit
+      opens and calls fail fast with LLMUnavailableError for
+      GEMINI_BREAKER_RESET_SECONDS, then a single trial call is let through.
+    - Latency and outcome counters are kept per call name (see stats()).
+    """
+    
+    def __init__(self, requests_per_minute, burst, max_retries, base_delay, max_delay,
+                 rate_limit_wait, breaker_failures, breaker_reset_seconds):
+        self.bucket = TokenBucket(requests_per_minute / 60.0, burst)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.rate_limit_wait = rate_limit_wait
+        self.breaker_failures = breaker_failures
+        self.breaker_reset_seconds = breaker_reset_seconds
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._metrics = {}
+    
+    @staticmethod
+    def is_retryable(error):
+        """429 and upstream/transport failures are worth retrying; bad requests are not"""
+        return isinstance(error, (
+            google_exceptions.TooManyRequests,
+            google_exceptions.ResourceExhausted,
+            google_exceptions.ServerError,
+            google_exceptions.DeadlineExceeded,
+            ConnectionError,
+            TimeoutError
+        ))
+    
+    def _before_call(self):
+        """Raise LLMUnavailableError while the circuit is open"""
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < self.breaker_reset_seconds or self._trial_in_flight:
+                raise LLMUnavailableError("Gemini circuit breaker is open")
+            # Half-open: let one trial call through
+            self._trial_in_flight = True
+    
+    def _record_upstream(self, success):
+        with self._lock:
+            self._trial_in_flight = False
+            if success:
+                self._consecutive_failures = 0
+                self._opened_at = None
+            else:
+                self._consecutive_failures += 1
+                if self._consecutive_failures >= self.breaker_failures:
+                    if self._opened_at is None:
+                        print(f"Gemini circuit breaker opened after {self._consecutive_failures} consecutive failures")
+                    self._opened_at = time.monotonic()
+    
+    def _record_metric(self, call_name, outcome, latency, retries):
+        with self._lock:
+            metric = self._metrics.setdefault(call_name, {
+                "calls": 0, "success": 0, "error": 0, "rejected": 0,
+                "retries": 0, "totalLatencyMs": 0.0, "maxLatencyMs": 0.0
+            })
+            metric["calls"] += 1
+            metric[outcome] += 1
+            metric["retries"] += retries
+            latency_ms = latency * 1000
+            metric["totalLatencyMs"] += latency_ms
+            metric["maxLatencyMs"] = max(metric["maxLatencyMs"], latency_ms)
+    
+    def call(self, call_name, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) under the rate limit, retry policy and circuit breaker"""
+        started = time.monotonic()
+        retries = 0
+        try:
+            while True:
+                self._before_call()
+                if not self.bucket.acquire(self.rate_limit_wait):
+                    with self._lock:
+                        self._trial_in_flight = False
+                    raise LLMUnavailableError("Timed out waiting for Gemini rate limit")
+                try:
+                    result = fn(*args, **kwargs)
+                except Exception as e:
+                    if not self.is_retryable(e):
+                        # The upstream answered; the request itself was bad
+                        self._record_upstream(True)
+                        raise
+                    self._record_upstream(False)
+                    if retries >= self.max_retries:
+                        raise
+                    retries += 1
+                    delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retries))
+                    print(f"Gemini call {call_name} failed ({type(e).__name__}); retry {retries}/{self.max_retries} in {delay:.1f}s")
+                    time.sleep(delay)
+                    continue
+                self._record_upstream(True)
+                self._record_metric(call_name, "success", time.monotonic() - started, retries)
+                return result
+        except LLMUnavailableError:
+            self._record_metric(call_name, "rejected", time.monotonic() - started, retries)
+            raise
+        except Exception:
+            self._record_metric(call_name, "error", time.monotonic() - started, retries)
+            raise
+    
+    def generate_content(self, call_name, *args, model_name=None, **kwargs):
+        """llm_backend.generate_content(...) through call()"""
+        return self.call(
+            call_name, llm_backend.generate_content,
+            call_name, model_name or GEMINI_MODEL_NAME, *args, **kwargs
+        )
+    
+    def stats(self):
+        with self._lock:
+            calls = {}
+            for call_name, metric in self._metrics.items():
+                calls[call_name] = dict(metric)
+                calls[call_name]["avgLatencyMs"] = round(metric["totalLatencyMs"] / metric["calls"], 1) if metric["calls"] else 0
+                calls[call_name]["totalLatencyMs"] = round(metric["totalLatencyMs"], 1)
+                calls[call_name]["maxLatencyMs"] = round(metric["maxLatencyMs"], 1)
+            return {
+                "circuitOpen": self._opened_at is not None,
+                "consecutiveFailures": self._consecutive_failures,
+                "calls": calls
+            }
+
+gemini_client = GeminiClient(
+    requests_per_minute=float(os.getenv("GEMINI_REQUESTS_PER_MINUTE", "60")),
+    burst=float(os.getenv("GEMINI_BURST", "10")),
+    max_retries=int(os.getenv("GEMINI_MAX_RETRIES", "4")),
+    base_delay=float(os.getenv("GEMINI_RETRY_BASE_SECONDS", "1")),
+    max_delay=float(os.getenv("GEMINI_RETRY_MAX_SECONDS", "30")),
+    rate_limit_wait=float(os.getenv("GEMINI_RATE_LIMIT_WAIT_SECONDS", "60")),
+    breaker_failures=int(os.getenv("GEMINI_BREAKER_FAILURES", "5")),
+    breaker_reset_seconds=float(os.getenv("GEMINI_BREAKER_RESET_SECONDS", "30"))
+)
 
 app.config["JWT_SECRET_KEY"] = os.getenv("JWT_SECRET_KEY", "super-secret-key")
 app.config["JWT_ACCESS_TOKEN_EXPIRES"] = timedelta(hours=24)
@@ -135,25 +509,149 @@ db = client["edubridge_db"]
 users_collection = db["users"]
 classrooms_collection = db["classrooms"]
 
+# Quizzes and submissions live in their own collections instead of being
+# embedded in the classroom document (see migrate_classroom_quizzes)
+quizzes_collection = db["quizzes"]
+submissions_collection = db["submissions"]
+drafts_collection = db["drafts"]
+# Durable queue for background work (see enqueue_job)
+jobs_collection = db["jobs"]
+# Shared store behind the PersistentCache instances (LLM extraction/grading results)
+llm_cache_collection = db["llm_cache"]
+# Doubt-chat history, one document per user (see ChatSessionStore)
+chat_history_collection = db["chat_history"]
+# Capped log of grading/extraction progress, tailed by /api/events/stream
+progress_events_collection = db["progress_events"]
+
 # Initialize GridFS for file storage
 fs = GridFS(db)
 
+# ============ INDEX REGISTRY ============
+
+# Every index the app relies on. Each entry is (collection, keys, options).
+INDEX_REGISTRY = [
+    # Login and signup look users up by email
+    (users_collection, [("email", ASCENDING)], {"unique": True}),
+    # Joining a classroom by code
+    (classrooms_collection, [("classCode", ASCENDING)], {"unique": True}),
+    # Classroom lists for teachers and students, newest first
+    (classrooms_collection, [("teacher_id", ASCENDING), ("createdAt", DESCENDING)], {}),
+    (classrooms_collection, [("enrolled_students", ASCENDING), ("createdAt", DESCENDING)], {}),
+    # Quiz documents use the quiz id as _id; list them per classroom in creation order
+    (quizzes_collection, [("classroom_id", ASCENDING), ("_id", ASCENDING)], {}),
+    # One submission per student per quiz
+    (submissions_collection, [("classroom_id", ASCENDING), ("quiz_id", ASCENDING), ("student_id", ASCENDING)], {"unique": True}),
+    # Student analytics across classrooms
+    (submissions_collection, [("student_id", ASCENDING), ("classroom_id", ASCENDING)], {}),
+    # Announcement drafts are keyed per classroom, teacher and draft
+    (drafts_collection, [("classroom_id", ASCENDING), ("user_id", ASCENDING), ("draft_id", ASCENDING)], {"unique": True}),
+    # Workers claim due jobs in runAfter order; expired leases are found by status
+    (jobs_collection, [("status", ASCENDING), ("runAfter", ASCENDING)], {}),
+    (jobs_collection, [("status", ASCENDING), ("leaseExpiresAt", ASCENDING)], {}),
+    # Cached LLM results are removed by MongoDB once they expire
+    (llm_cache_collection, [("expiresAt", ASCENDING)], {"expireAfterSeconds": 0}),
+    # Idle chat histories are removed the same way
+    (chat_history_collection, [("expiresAt", ASCENDING)], {"expireAfterSeconds": 0}),
+]
+
+# Representative filters for the hot query paths: (collection, filter, sort).
+# Used by check_query_plans() to make sure none of them scans a whole collection.
+HOT_QUERY_SHAPES = [
+    (users_collection, {"email": "user@example.com"}, None),
+    (classrooms_collection, {"classCode": "ABC123"}, None),
+    (classrooms_collection, {"teacher_id": ObjectId()}, [("createdAt", DESCENDING)]),
+    (classrooms_collection, {"enrolled_students": ObjectId()}, [("createdAt", DESCENDING)]),
+    (quizzes_collection, {"classroom_id": ObjectId()}, [("_id", ASCENDING)]),
+    (submissions_collection, {"classroom_id": ObjectId(), "quiz_id": ObjectId(), "student_id": ObjectId()}, None),
+    (submissions_collection, {"student_id": ObjectId(), "classroom_id": {"$in": [ObjectId()]}}, None),
+    (drafts_collection, {"classroom_id": ObjectId(), "user_id": ObjectId(), "draft_id": "autosave_draft"}, None),
+    (jobs_collection, {"status": "queued", "runAfter": {"$lte": datetime.utcnow()}}, [("runAfter", ASCENDING)]),
+]
+
+def ensure_indexes():
+    """
+    Create every index in INDEX_REGISTRY. create_index is a no-op for indexes
+    that already exist, so this is safe to run on every boot.
+
+    Returns:
+        list: (collection name, keys, error message) for indexes that could not be built
+    """
+    failures = []
+    for collection, keys, options in INDEX_REGISTRY:
+        try:
+            collection.create_index(keys, **options)
+        except Exception as e:
+            print(f"Error creating index {keys} on {collection.name}: {str(e)}")
+            failures.append((collection.name, keys, str(e)))
+    return failures
+
+def _plan_stages(plan):
+    """Yield every stage name in an explain() plan tree"""
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from _plan_stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from _plan_stages(item)
+
+def check_query_plans():
+    """
+    Explain each query in HOT_QUERY_SHAPES and report the ones whose winning
+    plan falls back to a collection scan.
+
+    Returns:
+        list: (collection name, filter) for every query shape that uses COLLSCAN
+    """
+    collscans = []
+    for collection, query, sort in HOT_QUERY_SHAPES:
+        cursor = collection.find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        winning_plan = cursor.explain().get("queryPlanner", {}).get("winningPlan", {})
+        if "COLLSCAN" in _plan_stages(winning_plan):
+            collscans.append((collection.name, query))
+    return collscans
+
+@app.cli.command("ensure-indexes")
+@click.option("--check/--no-check", default=True, help="Fail if a hot query shape still uses COLLSCAN.")
+def ensure_indexes_command(check):
+    """Create the registered indexes and verify the hot query plans."""
+    failures = ensure_indexes()
+    click.echo(f"Ensured {len(INDEX_REGISTRY) - len(failures)}/{len(INDEX_REGISTRY)} indexes")
+    
+    collscans = check_query_plans() if check else []
+    for collection_name, query in collscans:
+        click.echo(f"COLLSCAN: {collection_name} {query}")
+    
+    if failures or collscans:
+        raise click.ClickException("Index check failed")
+
 # Quiz utility functions
 # -------------------------------------------------------------------------------------
 
 # Default time buffer for quiz availability (for testing purposes, can be adjusted in production)
 QUIZ_TIME_BUFFER = timedelta(minutes=10)
 
-def get_classroom_and_validate_access(classroom_id, user_id, required_role=None):
+# Fields loaded by the access check unless an endpoint asks for more
+CLASSROOM_ACCESS_PROJECTION = {"teacher_id": 1, "className": 1, "name": 1, "subject": 1}
+
+def get_classroom_and_validate_access(classroom_id, user_id, required_role=None, projection=None):
     """
     Get classroom document and validate user access.
     
+    Membership is checked in the classroom query itself, so only a small
+    projection of the classroom is read instead of the whole document.
+    
     Args:
         classroom_id: The classroom ID
         user_id: The user ID
         required_role: If "teacher", checks if user is the classroom teacher
                       If "student", checks if user is enrolled
                       If None, checks if user is either teacher or student
+        projection: Classroom fields the endpoint needs (defaults to
+                    CLASSROOM_ACCESS_PROJECTION)
     
     Returns:
         tuple: (classroom, user, None) if successful, or (None, None, error_response) if failed
@@ -163,49 +661,608 @@ def get_classroom_and_validate_access(classroom_id, user_id, required_role=None)
         classroom_obj_id = ObjectId(classroom_id)
         user_obj_id = ObjectId(user_id)
         
-        # Find classroom
-        classroom = classrooms_collection.find_one({"_id": classroom_obj_id})
+        # Build the membership filter for the required role
+        if required_role == "teacher":
+            access_filter = {"teacher_id": user_obj_id}
+            denied_msg = "Unauthorized. Teacher access required."
+        elif required_role == "student":
+            access_filter = {"enrolled_students": user_obj_id}
+            denied_msg = "Unauthorized. Student enrollment required."
+        else:
+            # Either teacher or enrolled student
+            access_filter = {"$or": [{"teacher_id": user_obj_id}, {"enrolled_students": user_obj_id}]}
+            denied_msg = "Unauthorized to access this classroom"
+        
+        if projection is None:
+            projection = CLASSROOM_ACCESS_PROJECTION
+        
+        classroom = classrooms_collection.find_one({"_id": classroom_obj_id, **access_filter}, projection)
         if not classroom:
-            return None, None, (jsonify({"msg": "Classroom not found"}), 404)
+            # Tell a missing classroom apart from a denied one
+            if classrooms_collection.find_one({"_id": classroom_obj_id}, {"_id": 1}) is None:
+                return None, None, (jsonify({"msg": "Classroom not found"}), 404)
+            return None, None, (jsonify({"msg": denied_msg}), 403)
         
-        # Find user
-        user = users_collection.find_one({"_id": user_obj_id})
+        # Find user (display fields come from the profile cache)
+        user = get_user_profile(user_obj_id)
         if not user:
             return None, None, (jsonify({"msg": "User not found"}), 404)
         
-        # Check access based on required role
-        if required_role == "teacher":
-            if user.get("userType") != "teacher" or classroom["teacher_id"] != user_obj_id:
-                return None, None, (jsonify({"msg": "Unauthorized. Teacher access required."}), 403)
-        elif required_role == "student":
-            if user_obj_id not in classroom.get("enrolled_students", []):
-                return None, None, (jsonify({"msg": "Unauthorized. Student enrollment required."}), 403)
-        else:
-            # Either teacher or enrolled student
-            if (classroom["teacher_id"] != user_obj_id and 
-                user_obj_id not in classroom.get("enrolled_students", [])):
-                return None, None, (jsonify({"msg": "Unauthorized to access this classroom"}), 403)
+        if required_role == "teacher" and user.get("userType") != "teacher":
+            return None, None, (jsonify({"msg": denied_msg}), 403)
                 
         return classroom, user, None
         
     except Exception as e:
         return None, None, (jsonify({"msg": f"Error: {str(e)}"}), 500)
 
-def find_quiz_by_id(classroom, quiz_id):
+# ============ CACHES ============
+
+class LRUCache:
+    """
+    Thread-safe in-process LRU cache with a per-entry TTL and hit/miss counters.
+    """
+    
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get_many(self, keys):
+        """Return {key: value} for the keys that are cached and still fresh"""
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry and entry[0] > now:
+                    self._entries.move_to_end(key)
+                    found[key] = entry[1]
+                    self.hits += 1
+                else:
+                    if entry:
+                        del self._entries[key]
+                    self.misses += 1
+        return found
+    
+    def get(self, key):
+        """Return the cached value for key, or None"""
+        return self.get_many([key]).get(key)
+    
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+    
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "maxEntries": self.max_entries,
+                "ttlSeconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hitRate": round(self.hits / lookups, 3) if lookups else 0
+            }
+
+class PersistentCache:
+    """
+    Two-level cache for expensive LLM results: an LRUCache in front of the
+    llm_cache collection, shared by every process. Entries are namespaced so
+    several caches can share the collection, and MongoDB drops them once
+    expiresAt passes. Cache failures are logged and treated as misses.
+    """
+    
+    def __init__(self, namespace, max_entries, ttl_seconds):
+        self.namespace = namespace
+        self.ttl_seconds = ttl_seconds
+        self.memory = LRUCache(max_entries, ttl_seconds)
+        self.db_hits = 0
+    
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            return value
+        try:
+            doc = llm_cache_collection.find_one({"_id": f"{self.namespace}:{key}"}, {"value": 1, "expiresAt": 1})
+        except Exception as e:
+            print(f"Error reading {self.namespace} cache: {str(e)}")
+            return None
+        if not doc or doc.get("expiresAt", datetime.utcnow()) <= datetime.utcnow():
+            return None
+        self.db_hits += 1
+        self.memory.put(key, doc["value"])
+        return doc["value"]
+    
+    def put(self, key, value):
+        self.memory.put(key, value)
+        now = datetime.utcnow()
+        try:
+            llm_cache_collection.update_one(
+                {"_id": f"{self.namespace}:{key}"},
+                {"$set": {
+                    "namespace": self.namespace,
+                    "value": value,
+                    "createdAt": now,
+                    "expiresAt": now + timedelta(seconds=self.ttl_seconds)
+                }},
+                upsert=True
+            )
+        except Exception as e:
+            print(f"Error writing {self.namespace} cache: {str(e)}")
+    
+    def stats(self):
+        stats = self.memory.stats()
+        stats["dbHits"] = self.db_hits
+        # Memory misses that were answered by MongoDB are not real misses
+        stats["misses"] -= self.db_hits
+        lookups = stats["hits"] + stats["dbHits"] + stats["misses"]
+        stats["hitRate"] = round((stats["hits"] + stats["dbHits"]) / lookups, 3) if lookups else 0
+        return stats
+
+def sha256_hex(data):
+    """SHA-256 hex digest of bytes or text"""
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+# ============ USER NAME RESOLUTION ============
+
+# Display fields kept for users in the profile cache
+USER_NAME_PROJECTION = {"fullName": 1, "email": 1, "userType": 1}
+
+# Process-wide cache of user display fields. Entries are dropped on profile
+# writes (see invalidate_user_profile); the TTL bounds how stale a profile
+# changed by another process can get.
+user_profile_cache = LRUCache(
+    max_entries=int(os.getenv("USER_CACHE_MAX_ENTRIES", "5000")),
+    ttl_seconds=int(os.getenv("USER_CACHE_TTL_SECONDS", "300"))
+)
+
+def invalidate_user_profile(user_id):
+    """Drop a user from the profile cache after their document changes"""
+    user_id = ObjectId(user_id)
+    user_profile_cache.invalidate(user_id)
+    if has_app_context():
+        g.setdefault("resolved_users", {}).pop(user_id, None)
+
+def resolve_users(user_ids, projection=None):
+    """
+    Look up several users with a single $in query.
+    
+    With the default display-field projection, users come from the request
+    memo on flask.g, then the process-wide profile cache, and only the
+    remaining ids are fetched from the database.
+    
+    Returns:
+        dict: user ObjectId -> user document (missing users are left out)
+    """
+    requested_ids = {ObjectId(uid) for uid in user_ids if uid}
+    if projection is not None:
+        if not requested_ids:
+            return {}
+        return {u["_id"]: u for u in users_collection.find({"_id": {"$in": list(requested_ids)}}, projection)}
+    
+    resolved = g.setdefault("resolved_users", {}) if has_app_context() else {}
+    missing_ids = [uid for uid in requested_ids if uid not in resolved]
+    if missing_ids:
+        cached = user_profile_cache.get_many(missing_ids)
+        resolved.update(cached)
+        missing_ids = [uid for uid in missing_ids if uid not in cached]
+    if missing_ids:
+        for user in users_collection.find({"_id": {"$in": missing_ids}}, USER_NAME_PROJECTION):
+            user_profile_cache.put(user["_id"], user)
+            resolved[user["_id"]] = user
+        for uid in missing_ids:
+            resolved.setdefault(uid, None)
+    return {uid: resolved[uid] for uid in requested_ids if resolved.get(uid)}
+
+def get_user_profile(user_id):
+    """Return the cached display fields for a single user, or None"""
+    return resolve_users([user_id]).get(ObjectId(user_id))
+
+def get_user_name(users, user_id, default="Unknown"):
+    """Return a user's fullName from a resolve_users() map"""
+    user = users.get(ObjectId(user_id)) if user_id else None
+    return user.get("fullName", default) if user else default
+
+def collect_commenter_ids(announcements):
+    """Collect the commenter ids from a list of announcements"""
+    return [
+        comment["commenter_id"]
+        for ann in announcements or []
+        for comment in ann.get("comments", [])
+    ]
+
+# Projections that leave the PDF bytes in the database
+QUIZ_FILE_CONTENT_PROJECTION = {"questionPaper.content": 0, "answerKey.content": 0}
+SUBMISSION_FILE_CONTENT_PROJECTION = {"answerFile.content": 0}
+
+# Classrooms already checked for embedded quizzes by this process
+_migrated_classroom_ids = set()
+
+def normalize_submission_student_ids(classroom_obj_id):
+    """
+    Convert string student_ids left by earlier migrations to ObjectId.
+    A submission whose converted id clashes with an existing one is left as
+    is (find_submission still matches it by string).
+    """
+    try:
+        submissions_collection.update_many(
+            {"classroom_id": classroom_obj_id, "student_id": {"$type": "string", "$regex": "^[0-9a-fA-F]{24}$"}},
+            [{"$set": {"student_id": {"$toObjectId": "$student_id"}}}]
+        )
+    except Exception as e:
+        print(f"Could not normalize submission student ids for classroom {classroom_obj_id}: {str(e)}")
+
+def migrate_classroom_quizzes(classroom_id):
+    """
+    Move quizzes and submissions still embedded in a classroom document into
+    the quizzes and submissions collections.
+
+    Safe to run while the app is serving traffic: documents are upserted with
+    $setOnInsert so anything already written to the new collections wins, and
+    a quiz is pulled from the classroom only after its submissions are copied.
+    Quizzes are read one at a time so a large classroom is never loaded whole.
+
+    Returns:
+        tuple: (quizzes moved, submissions moved)
+    """
+    classroom_obj_id = ObjectId(classroom_id)
+    if classroom_obj_id in _migrated_classroom_ids:
+        return 0, 0
+
+    moved_quizzes = 0
+    moved_submissions = 0
+
+    while True:
+        classroom = classrooms_collection.find_one(
+            {"_id": classroom_obj_id, "quizzes.0": {"$exists": True}},
+            {"quizzes": {"$slice": 1}}
+        )
+        if not classroom or not classroom.get("quizzes"):
+            break
+
+        quiz = classroom["quizzes"][0]
+        embedded_id = quiz["id"]
+        quiz_obj_id = embedded_id if isinstance(embedded_id, ObjectId) else ObjectId(str(embedded_id))
+        submissions = quiz.pop("submissions", [])
+        quiz["id"] = quiz_obj_id
+        quiz["classroom_id"] = classroom_obj_id
+
+        quizzes_collection.update_one(
+            {"_id": quiz_obj_id},
+            {"$setOnInsert": quiz},
+            upsert=True
+        )
+
+        if submissions:
+            operations = []
+            for submission in submissions:
+                submission["classroom_id"] = classroom_obj_id
+                submission["quiz_id"] = quiz_obj_id
+                # Legacy submissions may hold the student id as a string
+                if isinstance(submission.get("student_id"), str) and ObjectId.is_valid(submission["student_id"]):
+                    submission["student_id"] = ObjectId(submission["student_id"])
+                operations.append(UpdateOne(
+                    {
+                        "classroom_id": classroom_obj_id,
+                        "quiz_id": quiz_obj_id,
+                        "student_id": submission["student_id"]
+                    },
+                    {"$setOnInsert": submission},
+                    upsert=True
+                ))
+            submissions_collection.bulk_write(operations, ordered=False)
+
+        classrooms_collection.update_one(
+            {"_id": classroom_obj_id},
+            {"$pull": {"quizzes": {"id": embedded_id}}}
+        )
+        moved_quizzes += 1
+        moved_submissions += len(submissions)
+
+    # Drop the now empty legacy array
+    classrooms_collection.update_one(
+        {"_id": classroom_obj_id, "quizzes": {"$size": 0}},
+        {"$unset": {"quizzes": ""}}
+    )
+    normalize_submission_student_ids(classroom_obj_id)
+    _migrated_classroom_ids.add(classroom_obj_id)
+
+    if moved_quizzes:
+        print(f"Migrated {moved_quizzes} quizzes and {moved_submissions} submissions for classroom {classroom_id}")
+    return moved_quizzes, moved_submissions
+
+@app.cli.command("migrate-quizzes")
+def migrate_quizzes_command():
+    """Move embedded classroom quizzes and submissions into their own collections"""
+    total_quizzes = 0
+    total_submissions = 0
+    classroom_ids = [c["_id"] for c in classrooms_collection.find({"quizzes.0": {"$exists": True}}, {"_id": 1})]
+    click.echo(f"Found {len(classroom_ids)} classrooms with embedded quizzes")
+
+    for classroom_id in classroom_ids:
+        moved_quizzes, moved_submissions = migrate_classroom_quizzes(classroom_id)
+        total_quizzes += moved_quizzes
+        total_submissions += moved_submissions
+        click.echo(f"{classroom_id}: {moved_quizzes} quizzes, {moved_submissions} submissions")
+
+    click.echo(f"Migration complete: {total_quizzes} quizzes, {total_submissions} submissions moved")
+
+def find_quiz_by_id(classroom_id, quiz_id, projection=QUIZ_FILE_CONTENT_PROJECTION):
     """Find a quiz in a classroom by its ID"""
-    for quiz in classroom.get("quizzes", []):
-        if str(quiz["id"]) == quiz_id:
-            return quiz
-    return None
+    if not ObjectId.is_valid(str(quiz_id)):
+        return None
+    migrate_classroom_quizzes(classroom_id)
+    return quizzes_collection.find_one(
+        {"_id": ObjectId(quiz_id), "classroom_id": ObjectId(classroom_id)},
+        projection
+    )
+
+def list_classroom_quizzes(classroom_id, query=None, projection=QUIZ_FILE_CONTENT_PROJECTION):
+    """List the quizzes of a classroom in creation order"""
+    migrate_classroom_quizzes(classroom_id)
+    quiz_query = {"classroom_id": ObjectId(classroom_id)}
+    if query:
+        quiz_query.update(query)
+    return list(quizzes_collection.find(quiz_query, projection).sort("_id", ASCENDING))
+
+def find_submission(classroom_id, quiz_id, student_id, projection=SUBMISSION_FILE_CONTENT_PROJECTION):
+    """Find a student's submission for a quiz"""
+    return submissions_collection.find_one(
+        {
+            "classroom_id": ObjectId(classroom_id),
+            "quiz_id": ObjectId(quiz_id),
+            # Legacy submissions stored the id as a string
+            "student_id": {"$in": [ObjectId(student_id), str(student_id)]}
+        },
+        projection
+    )
+
+def list_quiz_submissions(classroom_id, quiz_id, projection=SUBMISSION_FILE_CONTENT_PROJECTION):
+    """List all submissions for a quiz"""
+    return list(submissions_collection.find(
+        {"classroom_id": ObjectId(classroom_id), "quiz_id": ObjectId(quiz_id)},
+        projection
+    ))
+
+def quiz_has_submissions(classroom_id, quiz_id):
+    """Check whether any student has submitted a quiz"""
+    return submissions_collection.find_one(
+        {"classroom_id": ObjectId(classroom_id), "quiz_id": ObjectId(quiz_id)},
+        {"_id": 1}
+    ) is not None
+
+def group_submissions_by_quiz(submissions):
+    """Group submission documents by the id of their quiz"""
+    grouped = {}
+    for submission in submissions:
+        grouped.setdefault(submission["quiz_id"], []).append(submission)
+    return grouped
+
+def load_quizzes_with_submissions(classroom_ids, student_id=None):
+    """
+    Load the quizzes of several classrooms with their submissions attached
+    under "submissions", the shape the frontend expects.
+
+    When student_id is given only that student's submissions are attached.
+
+    Returns:
+        dict: classroom ObjectId -> list of quizzes in creation order
+    """
+    classroom_ids = [ObjectId(classroom_id) for classroom_id in classroom_ids]
+    for classroom_id in classroom_ids:
+        migrate_classroom_quizzes(classroom_id)
+
+    submission_query = {"classroom_id": {"$in": classroom_ids}}
+    if student_id is not None:
+        submission_query["student_id"] = ObjectId(student_id)
+    submissions_by_quiz = group_submissions_by_quiz(submissions_collection.find(
+        submission_query,
+        SUBMISSION_FILE_CONTENT_PROJECTION
+    ))
+
+    quizzes_by_classroom = {classroom_id: [] for classroom_id in classroom_ids}
+    quiz_cursor = quizzes_collection.find(
+        {"classroom_id": {"$in": classroom_ids}},
+        QUIZ_FILE_CONTENT_PROJECTION
+    ).sort("_id", ASCENDING)
+    for quiz in quiz_cursor:
+        quiz["submissions"] = submissions_by_quiz.get(quiz["id"], [])
+        quizzes_by_classroom[quiz["classroom_id"]].append(quiz)
+    return quizzes_by_classroom
+
+def has_student_submitted(quiz, student_obj_id):
+    """Check whether a student has a submission for a quiz document"""
+    return submissions_collection.find_one(
+        {"classroom_id": quiz["classroom_id"], "quiz_id": quiz["id"], "student_id": student_obj_id},
+        {"_id": 1}
+    ) is not None
+
+# ============ PDF FILE STORAGE (GRIDFS) ============
+
+# Size of each chunk written to the client when streaming a PDF
+PDF_STREAM_CHUNK_SIZE = 256 * 1024
+
+# (collection, field) pairs that hold an uploaded PDF descriptor
+PDF_FILE_FIELDS = (
+    (quizzes_collection, "questionPaper"),
+    (quizzes_collection, "answerKey"),
+    (submissions_collection, "answerFile"),
+)
+
+def store_pdf_file(pdf_binary, filename, metadata=None):
+    """Store PDF bytes in GridFS and return the descriptor saved on the quiz/submission"""
+    file_id = fs.put(
+        pdf_binary,
+        filename=filename,
+        contentType="application/pdf",
+        metadata=metadata or {}
+    )
+    return {
+        "filename": filename,
+        "file_id": file_id,
+        "contentType": "application/pdf",
+        "size": len(pdf_binary)
+    }
+
+def has_pdf_content(file_data):
+    """Check whether a file descriptor points at stored PDF bytes (GridFS or legacy inline)"""
+    return bool(file_data) and (bool(file_data.get("file_id")) or "content" in file_data)
+
+def read_pdf_file(file_data):
+    """Read the full PDF bytes for a file descriptor, falling back to legacy inline content"""
+    if not file_data:
+        return None
+    if file_data.get("file_id"):
+        return fs.get(file_data["file_id"]).read()
+    content = file_data.get("content")
+    return bytes(content) if content else None
+
+def delete_pdf_file(file_data):
+    """Remove the GridFS file behind a descriptor, if there is one"""
+    if not file_data or not file_data.get("file_id"):
+        return
+    try:
+        fs.delete(file_data["file_id"])
+    except Exception as e:
+        print(f"Error deleting GridFS file {file_data['file_id']}: {str(e)}")
+
+def stream_pdf_file(file_data, default_filename, as_attachment=True):
+    """
+    Stream a stored PDF to the client in chunks.
+    
+    Honours a single HTTP Range request with a 206 Partial Content response so
+    PDF viewers can fetch pages on demand instead of downloading the whole file.
+    Multi-range requests are answered with the whole file (200).
+    """
+    if file_data.get("file_id"):
+        source = fs.get(file_data["file_id"])
+        size = source.length
+    else:
+        content = bytes(file_data["content"])
+        source = BytesIO(content)
+        size = len(content)
+    
+    status = 200
+    start, stop = 0, size
+    # multipart/byteranges is not supported, so several ranges get the full body
+    if request.range and len(request.range.ranges) == 1:
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            source.close()
+            return Response(status=416, headers={"Content-Range": f"bytes */{size}"})
+        start, stop = byte_range
+        status = 206
+    
+    def generate():
+        try:
+            source.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = source.read(min(PDF_STREAM_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            source.close()
+    
+    filename = file_data.get("filename") or default_filename
+    disposition_type = "attachment" if as_attachment else "inline"
+    try:
+        filename.encode("latin-1")
+        disposition = f'{disposition_type}; filename="{filename}"'
+    except UnicodeEncodeError:
+        disposition = f"{disposition_type}; filename*=UTF-8''{quote(filename)}"
+    
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Length": str(stop - start),
+        "Content-Disposition": disposition
+    }
+    if status == 206:
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+    
+    return Response(
+        generate(),
+        status=status,
+        mimetype=file_data.get("contentType", "application/pdf"),
+        headers=headers,
+        direct_passthrough=True
+    )
+
+def backfill_inline_pdf(collection, doc_id, field):
+    """Move one legacy inline PDF blob into GridFS. Returns True if the document was updated."""
+    doc = collection.find_one({"_id": doc_id, f"{field}.content": {"$exists": True}}, {field: 1})
+    if not doc:
+        return False
+    
+    file_data = doc[field]
+    file_info = store_pdf_file(
+        bytes(file_data["content"]),
+        file_data.get("filename", f"{field}.pdf"),
+        metadata={"collection": collection.name, "document_id": doc_id, "field": field}
+    )
+    
+    # Only swap if the inline content is still there, so concurrent runs don't double-write
+    result = collection.update_one(
+        {"_id": doc_id, f"{field}.content": {"$exists": True}},
+        {
+            "$set": {f"{field}.file_id": file_info["file_id"], f"{field}.size": file_info["size"]},
+            "$unset": {f"{field}.content": ""}
+        }
+    )
+    if not result.modified_count:
+        delete_pdf_file(file_info)
+        return False
+    return True
+
+@app.cli.command("backfill-pdf-gridfs")
+def backfill_pdf_gridfs_command():
+    """Move inline quiz and submission PDF blobs into GridFS."""
+    # Embedded classroom quizzes have to be moved into their own collection first
+    classroom_ids = [c["_id"] for c in classrooms_collection.find({"quizzes.0": {"$exists": True}}, {"_id": 1})]
+    for classroom_id in classroom_ids:
+        migrate_classroom_quizzes(classroom_id)
+    
+    for collection, field in PDF_FILE_FIELDS:
+        doc_ids = [d["_id"] for d in collection.find({f"{field}.content": {"$exists": True}}, {"_id": 1})]
+        click.echo(f"{collection.name}.{field}: {len(doc_ids)} inline PDFs to move")
+        moved = 0
+        for doc_id in doc_ids:
+            try:
+                if backfill_inline_pdf(collection, doc_id, field):
+                    moved += 1
+            except Exception as e:
+                click.echo(f"  {doc_id}: failed ({str(e)})")
+        click.echo(f"{collection.name}.{field}: moved {moved}")
 
 def calculate_quiz_end_time(quiz):
     """Calculate the end time for a quiz based on start time and duration"""
     return quiz["startTime"] + timedelta(minutes=int(quiz["duration"]))
 
-def get_quiz_status(quiz, user_obj_id, current_time=None):
+def get_quiz_status(quiz, user_obj_id, current_time=None, has_submitted=None):
     """
     Determine the status of a quiz for a student.
     
+    Pass has_submitted when the caller already knows whether the student has a
+    submission, otherwise it is looked up in the submissions collection.
+    
     Returns one of: "submitted", "upcoming", "available", "missed"
     """
     if current_time is None:
@@ -217,10 +1274,8 @@ def get_quiz_status(quiz, user_obj_id, current_time=None):
     print(f"Current time (IST): {current_time.isoformat()}")
         
     # Check if student has submitted
-    has_submitted = any(
-        submission["student_id"] == user_obj_id 
-        for submission in quiz.get("submissions", [])
-    )
+    if has_submitted is None:
+        has_submitted = has_student_submitted(quiz, user_obj_id)
     
     if has_submitted:
         print(f"Quiz status: 'submitted' (Student has already submitted)")
@@ -641,13 +1696,466 @@ def teacher_settings():
     return send_file('src/teacher_settings.html')
 
 
-chat_sessions = {}
+# ============ CHAT SESSIONS ============
+
+CHAT_SYSTEM_INSTRUCTION = "You are an AI academic assistant. Answer the user's doubt clearly and concisely. If the user asks for navigation help, instruct them to use the 'navigate' function. If they ask non-academic questions, gently guide them back to their studies."
+CHAT_SYSTEM_PRELUDE = [
+    {'role': 'user', 'parts': [CHAT_SYSTEM_INSTRUCTION]},
+    {'role': 'model', 'parts': ["Understood. I am ready to help with academic doubts."]}
+]
+
+CHAT_SUMMARY_PROMPT = """Summarize this conversation between a student and an academic assistant so the assistant can continue helping without the full transcript.
+Keep the topics covered, the key facts, definitions and worked results given, and any open questions or misunderstandings the student still has. Write at most 200 words.
+
+Summary of the conversation before this part:
+{previous_summary}
+
+Conversation:
+{transcript}"""
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token), good enough for budgeting"""
+    return (len(text) + 3) // 4 if text else 0
+
+class ChatSessionStore:
+    """
+    Doubt-chat sessions, one per user.
+    
+    The conversation itself is persisted in chat_history (one document per
+    user, last `max_messages` turns, removed by a TTL index after
+    `history_ttl_seconds` of inactivity), so any worker can rebuild a
+    session. Live sessions are kept in a bounded LRUCache together with the
+    history version they were built from; a version bump by another worker
+    makes the local copy stale and it is rebuilt from MongoDB.
+    
+    Once the verbatim history passes `token_budget` (estimated), a background
+    job folds everything but the last `keep_messages` messages into a running
+    summary that is replayed ahead of the recent turns (see compact()).
+    """
+    
+    def __init__(self, max_entries, idle_seconds, max_messages, history_ttl_seconds, token_budget, keep_messages):
+        self.sessions = LRUCache(max_entries, idle_seconds)
+        self.max_messages = max_messages
+        self.history_ttl_seconds = history_ttl_seconds
+        self.token_budget = token_budget
+        self.keep_messages = keep_messages
+        self.rebuilds = 0
+    
+    @staticmethod
+    def build_history(doc):
+        """Prompt history for a session: system prelude, summary turn, recent messages"""
+        history = list(CHAT_SYSTEM_PRELUDE)
+        if doc.get("summary"):
+            history.append({"role": "user", "parts": ["Summary of our earlier conversation:\n" + doc["summary"]]})
+            history.append({"role": "model", "parts": ["Thanks, I will keep that context in mind."]})
+        history.extend(
+            {"role": message["role"], "parts": [message["text"]]}
+            for message in doc.get("messages", [])
+        )
+        return history
+    
+    @staticmethod
+    def history_tokens(chat):
+        """Estimated tokens in a live session's history (dict turns or SDK Content objects)"""
+        total = 0
+        for message in chat.history:
+            parts = message["parts"] if isinstance(message, dict) else message.parts
+            for part in parts:
+                total += estimate_tokens(part if isinstance(part, str) else getattr(part, "text", ""))
+        return total
+    
+    def get(self, user_id):
+        """Return (chat session, history version) for the user, rebuilding it if needed"""
+        try:
+            doc = chat_history_collection.find_one({"_id": ObjectId(user_id)}, {"version": 1})
+            version = doc.get("version", 0) if doc else 0
+        except Exception as e:
+            # Without MongoDB, keep using whatever this worker has
+            print(f"Error reading chat history version: {str(e)}")
+            doc = None
+            version = None
+        
+        cached = self.sessions.get(user_id)
+        if cached and (version is None or cached[1] == version):
+            return cached
+        version = version or 0
+        
+        history = list(CHAT_SYSTEM_PRELUDE)
+        if doc:
+            try:
+                doc = chat_history_collection.find_one(
+                    {"_id": ObjectId(user_id)},
+                    {"messages": 1, "summary": 1, "version": 1}
+                ) or {}
+                version = doc.get("version", 0)
+                history = self.build_history(doc)
+            except Exception as e:
+                print(f"Error loading chat history: {str(e)}")
+        
+        session = (llm_backend.start_chat(GEMINI_MODEL_NAME, history=history), version)
+        self.sessions.put(user_id, session)
+        self.rebuilds += 1
+        return session
+    
+    def record_turn(self, user_id, chat, version, query, answer, usage=None):
+        """
+        Persist a completed exchange, update the token counters and keep the
+        local session in step. `usage` is the response's usage_metadata when
+        the backend reports one; otherwise tokens are estimated.
+        """
+        now = datetime.utcnow()
+        turn_tokens = estimate_tokens(query) + estimate_tokens(answer)
+        prompt_tokens = getattr(usage, "prompt_token_count", None)
+        if prompt_tokens is None:
+            # The whole history is resent with every message
+            prompt_tokens = self.history_tokens(chat)
+        response_tokens = getattr(usage, "candidates_token_count", None) or estimate_tokens(answer)
+        try:
+            doc = chat_history_collection.find_one_and_update(
+                {"_id": ObjectId(user_id)},
+                {
+                    "$push": {"messages": {
+                        "$each": [
+                            {"role": "user", "text": query, "at": now},
+                            {"role": "model", "text": answer, "at": now}
+                        ],
+                        "$slice": -self.max_messages
+                    }},
+                    "$inc": {
+                        "version": 1,
+                        "historyTokens": turn_tokens,
+                        "tokens.turns": 1,
+                        "tokens.prompt": prompt_tokens,
+                        "tokens.response": response_tokens
+                    },
+                    "$set": {"updatedAt": now, "expiresAt": now + timedelta(seconds=self.history_ttl_seconds)}
+                },
+                projection={"version": 1, "historyTokens": 1, "compactionPending": 1},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except Exception as e:
+            print(f"Error saving chat history: {str(e)}")
+            return
+        
+        # Once the live session outgrows the persisted window, drop it so the
+        # next message rebuilds from the trimmed history
+        if len(chat.history) > len(CHAT_SYSTEM_PRELUDE) + 2 + self.max_messages:
+            self.sessions.invalidate(user_id)
+        elif doc.get("version") == version + 1:
+            self.sessions.put(user_id, (chat, version + 1))
+        
+        if doc.get("historyTokens", 0) > self.token_budget and not doc.get("compactionPending"):
+            self.request_compaction(user_id)
+    
+    def request_compaction(self, user_id):
+        """Queue one compaction job per user at a time"""
+        try:
+            claimed = chat_history_collection.update_one(
+                {"_id": ObjectId(user_id), "compactionPending": {"$ne": True}},
+                {"$set": {"compactionPending": True}}
+            )
+            if claimed.modified_count:
+                enqueue_job("compact_chat_history", {"user_id": str(user_id)}, user_id)
+        except Exception as e:
+            print(f"Error queueing chat history compaction: {str(e)}")
+    
+    def compact(self, user_id):
+        """
+        Fold all but the last keep_messages messages into the summary.
+        
+        Turns appended while the summary is generated are kept: the update
+        drops exactly the summarized prefix, and only if that prefix is still
+        at the front of the array.
+        """
+        doc = chat_history_collection.find_one(
+            {"_id": ObjectId(user_id)},
+            {"messages": 1, "summary": 1, "historyTokens": 1}
+        )
+        if not doc:
+            return {"compacted": 0}
+        
+        messages = doc.get("messages", [])
+        older = messages[:-self.keep_messages] if self.keep_messages else messages
+        if not older:
+            chat_history_collection.update_one({"_id": doc["_id"]}, {"$set": {"compactionPending": False}})
+            return {"compacted": 0}
+        recent = messages[len(older):]
+        
+        transcript = "\n".join(
+            f"{'Student' if message['role'] == 'user' else 'Assistant'}: {message['text']}"
+            for message in older
+        )
+        response = gemini_client.generate_content(
+            "chat_summarize",
+            CHAT_SUMMARY_PROMPT.format(previous_summary=doc.get("summary") or "(none)", transcript=transcript),
+            generation_config={"temperature": 0.2, "max_output_tokens": 1024}
+        )
+        summary = (response.text or "").strip()
+        if not summary:
+            raise ValueError("Empty summary returned")
+        
+        older_tokens = sum(estimate_tokens(message["text"]) for message in older)
+        kept_tokens = estimate_tokens(summary) + sum(estimate_tokens(message["text"]) for message in recent)
+        result = chat_history_collection.update_one(
+            {"_id": doc["_id"], "messages.0": older[0]},
+            [{"$set": {
+                "messages": {"$slice": ["$messages", len(older), {"$max": [{"$size": "$messages"}, 1]}]},
+                "summary": {"$literal": summary},
+                # Keep tokens of turns appended since we read the document
+                "historyTokens": {"$add": [kept_tokens, {"$subtract": ["$historyTokens", doc.get("historyTokens", 0)]}]},
+                "tokens.summarized": {"$add": [{"$ifNull": ["$tokens.summarized", 0]}, older_tokens]},
+                "tokens.compactions": {"$add": [{"$ifNull": ["$tokens.compactions", 0]}, 1]},
+                "version": {"$add": ["$version", 1]},
+                "compactionPending": False
+            }}]
+        )
+        if not result.modified_count:
+            # The history was trimmed or cleared underneath us; try again next turn
+            chat_history_collection.update_one({"_id": doc["_id"]}, {"$set": {"compactionPending": False}})
+            return {"compacted": 0}
+        return {"compacted": len(older), "summaryTokens": estimate_tokens(summary)}
+    
+    def token_stats(self, user_id):
+        """Per-session token counters for the user"""
+        doc = chat_history_collection.find_one(
+            {"_id": ObjectId(user_id)},
+            {"summary": 1, "messages.text": 1, "historyTokens": 1, "tokens": 1}
+        ) or {}
+        tokens = doc.get("tokens", {})
+        return {
+            "messages": len(doc.get("messages", [])),
+            "historyTokens": doc.get("historyTokens", 0),
+            "summaryTokens": estimate_tokens(doc.get("summary")),
+            "tokenBudget": self.token_budget,
+            "turns": tokens.get("turns", 0),
+            "promptTokens": tokens.get("prompt", 0),
+            "responseTokens": tokens.get("response", 0),
+            "summarizedTokens": tokens.get("summarized", 0),
+            "compactions": tokens.get("compactions", 0)
+        }
+    
+    def discard(self, user_id):
+        """Forget the live session, e.g. after a stream was cut off mid-reply"""
+        self.sessions.invalidate(user_id)
+    
+    def stats(self):
+        stats = self.sessions.stats()
+        stats["rebuilds"] = self.rebuilds
+        return stats
+
+chat_session_store = ChatSessionStore(
+    max_entries=int(os.getenv("CHAT_SESSION_MAX_ENTRIES", "1000")),
+    idle_seconds=int(os.getenv("CHAT_SESSION_IDLE_SECONDS", "1800")),
+    max_messages=int(os.getenv("CHAT_HISTORY_MAX_MESSAGES", "40")),
+    history_ttl_seconds=int(os.getenv("CHAT_HISTORY_TTL_SECONDS", str(7 * 24 * 3600))),
+    token_budget=int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "3000")),
+    keep_messages=int(os.getenv("CHAT_HISTORY_KEEP_MESSAGES", "8"))
+)
+
+@app.route("/api/chat/session", methods=["GET"])
+@jwt_required()
+def get_chat_session_stats():
+    """Token counters for the current user's doubt-chat session"""
+    user_id = get_jwt_identity()
+    try:
+        return jsonify(chat_session_store.token_stats(user_id)), 200
+    except Exception as e:
+        print(f"Error reading chat session stats: {str(e)}")
+        return jsonify({"msg": f"Error reading chat session: {str(e)}"}), 500
+
+# ============ NAVIGATION ANSWER CACHE ============
+
+# Bump when either navigate system instruction changes
+NAVIGATE_PROMPT_VERSION = "1"
+
+# Words that do not change what a navigation question asks for
+NAVIGATE_FILLER_WORDS = {"please", "pls", "plz", "kindly", "hey", "hi", "hello", "the", "a", "an", "thanks", "thank", "you"}
+# Question scaffolding ignored when comparing paraphrases, so the match rests on what is asked about
+NAVIGATE_MATCH_STOPWORDS = {
+    "how", "do", "does", "can", "could", "would", "should", "i", "me", "my", "is", "are", "where", "what",
+    "to", "in", "on", "of", "for", "want", "like", "go", "get", "find", "show", "see", "page"
+}
+
+def normalize_navigate_query(query):
+    """Lowercase, drop punctuation and filler words, collapse whitespace"""
+    words = re.sub(r"[^a-z0-9/]+", " ", query.lower()).split()
+    return " ".join(word for word in words if word not in NAVIGATE_FILLER_WORDS)
+
+class TfidfMatcher:
+    """
+    Small in-process TF-IDF index of normalized queries for one role, used to
+    map paraphrases ("how to open calendar" / "how do i open the calendar")
+    onto an already answered query. Bounded to max_entries, oldest dropped first.
+    """
+    
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._queries = OrderedDict()
+        self._doc_freq = {}
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def terms(normalized):
+        return set(normalized.split()) - NAVIGATE_MATCH_STOPWORDS
+    
+    def add(self, normalized):
+        terms = self.terms(normalized)
+        with self._lock:
+            if normalized in self._queries:
+                self._queries.move_to_end(normalized)
+                return
+            self._queries[normalized] = terms
+            for term in terms:
+                self._doc_freq[term] = self._doc_freq.get(term, 0) + 1
+            while len(self._queries) > self.max_entries:
+                _, old_terms = self._queries.popitem(last=False)
+                for term in old_terms:
+                    self._doc_freq[term] -= 1
+                    if not self._doc_freq[term]:
+                        del self._doc_freq[term]
+    
+    def _vector(self, terms, total):
+        # Smoothed idf; terms are unique per short query so tf is 1
+        vector = {term: math.log((1 + total) / (1 + self._doc_freq.get(term, 0))) + 1 for term in terms}
+        norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1.0
+        return {term: weight / norm for term, weight in vector.items()}
+    
+    def best_match(self, normalized, threshold):
+        """Return (indexed query, cosine similarity) for the closest query at or above threshold, else (None, 0)"""
+        terms = self.terms(normalized)
+        if not terms:
+            return None, 0
+        with self._lock:
+            total = len(self._queries)
+            query_vector = self._vector(terms, total)
+            best, best_score = None, 0
+            for candidate, candidate_terms in self._queries.items():
+                if not terms & candidate_terms:
+                    continue
+                candidate_vector = self._vector(candidate_terms, total)
+                score = sum(weight * candidate_vector.get(term, 0) for term, weight in query_vector.items())
+                if score > best_score:
+                    best, best_score = candidate, score
+        if best_score >= threshold:
+            return best, round(best_score, 3)
+        return None, 0
+
+class NavigateAnswerCache:
+    """
+    Answers to the stateless "navigate" chatbot function, keyed by
+    (role, normalized query, prompt version) in a PersistentCache shared by
+    every worker. With fuzzy matching on, a per-role TfidfMatcher maps
+    near-duplicate queries onto a cached one.
+    """
+    
+    def __init__(self, max_entries, ttl_seconds, fuzzy, threshold):
+        self.cache = PersistentCache("navigate", max_entries, ttl_seconds)
+        self.fuzzy = fuzzy
+        self.threshold = threshold
+        self.matchers = {}
+        self.fuzzy_hits = 0
+    
+    def _key(self, role, normalized):
+        return sha256_hex(f"{role}:{normalized}:{NAVIGATE_PROMPT_VERSION}")
+    
+    def _matcher(self, role):
+        if role not in self.matchers:
+            self.matchers[role] = TfidfMatcher(self.cache.memory.max_entries)
+        return self.matchers[role]
+    
+    def get(self, role, query):
+        """Cached answer for the query, or None"""
+        normalized = normalize_navigate_query(query)
+        if not normalized:
+            return None
+        answer = self.cache.get(self._key(role, normalized))
+        if answer is not None:
+            if self.fuzzy:
+                self._matcher(role).add(normalized)
+            return answer
+        if self.fuzzy:
+            match, score = self._matcher(role).best_match(normalized, self.threshold)
+            if match:
+                answer = self.cache.get(self._key(role, match))
+                if answer is not None:
+                    self.fuzzy_hits += 1
+                    print(f"Navigate cache fuzzy hit ({score}): '{normalized}' -> '{match}'")
+                    return answer
+        return None
+    
+    def put(self, role, query, answer):
+        normalized = normalize_navigate_query(query)
+        if not normalized or not answer or answer.startswith("Error occurred"):
+            return
+        self.cache.put(self._key(role, normalized), answer)
+        if self.fuzzy:
+            self._matcher(role).add(normalized)
+    
+    def stats(self):
+        stats = self.cache.stats()
+        stats["fuzzyHits"] = self.fuzzy_hits
+        stats["fuzzy"] = self.fuzzy
+        return stats
+
+navigate_cache = NavigateAnswerCache(
+    max_entries=int(os.getenv("NAVIGATE_CACHE_MAX_ENTRIES", "2000")),
+    ttl_seconds=int(os.getenv("NAVIGATE_CACHE_TTL_SECONDS", str(7 * 24 * 3600))),
+    fuzzy=os.getenv("NAVIGATE_CACHE_FUZZY", "1") == "1",
+    threshold=float(os.getenv("NAVIGATE_CACHE_FUZZY_THRESHOLD", "0.8"))
+)
+
+def sse_event(event, data, event_id=None):
+    """Format one Server-Sent Event with a JSON payload (and optional id)"""
+    prefix = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{prefix}event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def stream_chat_answer(start_stream, on_complete=None, on_abort=None):
+    """
+    Stream an LLM reply as SSE: `chunk` events with text deltas, then a
+    `done` event with the full answer, or an `error` event.
+    
+    start_stream() must return an iterable of chunks with `.text`.
+    on_complete(answer) runs once the whole reply has arrived; on_abort()
+    runs if the stream fails or the client disconnects before that.
+    """
+    def generate():
+        parts = []
+        completed = False
+        try:
+            for chunk in start_stream():
+                try:
+                    text = chunk.text
+                except ValueError:
+                    # Chunks without text (e.g. safety metadata only)
+                    continue
+                if text:
+                    parts.append(text)
+                    yield sse_event("chunk", {"text": text})
+            answer = "".join(parts)
+            completed = True
+            if on_complete:
+                on_complete(answer)
+            yield sse_event("done", {"answer": answer})
+        except Exception as e:
+            print(f"Error streaming chat answer: {str(e)}")
+            yield sse_event("error", {"error": f"Error occurred: {str(e)}"})
+        finally:
+            if not completed and on_abort:
+                on_abort()
+    
+    return Response(generate(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        # Stop nginx from buffering the stream
+        "X-Accel-Buffering": "no"
+    })
 
 @app.route("/chat", methods=["POST"])
 @jwt_required()
 def chat():
     user_id = get_jwt_identity()
-    user = users_collection.find_one({"_id": ObjectId(user_id)})
+    # Only userType is needed, served from the profile cache
+    user = get_user_profile(user_id)
     if not user:
         return jsonify({"error": "User not found"}), 404
 
@@ -658,35 +2166,26 @@ def chat():
 
     query = data["query"]
     function_type = data["function"]
+    # POST /chat?stream=1 answers with Server-Sent Events instead of JSON
+    stream = request.args.get("stream", "").lower() in ("1", "true", "yes")
 
     if function_type == "doubt":
-        # Use a chat session for multi-turn conversation.
-        global chat_sessions
-        if user_id not in chat_sessions:
-            # Define system instruction for the doubt function
-            system_instruction = "You are an AI academic assistant. Answer the user's doubt clearly and concisely. If the user asks for navigation help, instruct them to use the 'navigate' function. If they ask non-academic questions, gently guide them back to their studies."
-            # Create and store a new chat session using start_chat
-            # Initialize with system instructions and first user query
-            chat_sessions[user_id] = gemini_model.start_chat(history=[
-                {'role': 'user', 'parts': [system_instruction]},
-                {'role': 'model', 'parts': ["Understood. I am ready to help with academic doubts."]}
-            ])
-            chat = chat_sessions[user_id]
-            try:
-                # Send the first user query
-                response = chat.send_message(query)
-                answer = response.text
-            except Exception as e:
-                answer = f"Error occurred: {str(e)}"
-        else:
-            # Retrieve existing chat session
-            chat = chat_sessions[user_id]
-            try:
-                # Send the new query to the existing chat session
-                response = chat.send_message(query) # Send the new query
-                answer = response.text             # Get the text from the new response
-            except Exception as e:
-                answer = f"Error occurred: {str(e)}"
+        # Multi-turn conversation; history is shared by every worker
+        chat, version = chat_session_store.get(user_id)
+        if stream:
+            return stream_chat_answer(
+                lambda: gemini_client.call("chat_doubt", chat.send_message, query, stream=True),
+                on_complete=lambda answer: chat_session_store.record_turn(user_id, chat, version, query, answer),
+                # A half-read reply leaves the SDK session unusable; rebuild it next time
+                on_abort=lambda: chat_session_store.discard(user_id)
+            )
+        try:
+            response = gemini_client.call("chat_doubt", chat.send_message, query)
+            answer = response.text
+            chat_session_store.record_turn(user_id, chat, version, query, answer,
+                                           usage=getattr(response, "usage_metadata", None))
+        except Exception as e:
+            answer = f"Error occurred: {str(e)}"
     elif function_type == "navigate":
         # Stateless call for navigation assistance.
         if user_role == "student":
@@ -714,18 +2213,34 @@ def chat():
                 "You are an AI assistant helping a teacher navigate the website. "
                 "Provide clear instructions with clickable links (in HTML) for common actions such as 'Manage Classes' or 'View Profile'."
             )
-        config = genai.GenerationConfig(
-            temperature=0.3,
-        )
+        cache_role = "student" if user_role == "student" else "teacher"
+        cached_answer = navigate_cache.get(cache_role, query)
+        if cached_answer is not None:
+            if stream:
+                return stream_chat_answer(lambda: [SimpleNamespace(text=cached_answer)])
+            return jsonify({"answer": cached_answer, "cached": True})
+        
+        config = {
+            "temperature": 0.3,
+        }
+        if stream:
+            return stream_chat_answer(
+                lambda: gemini_client.generate_content(
+                    "chat_navigate",
+                    contents=[system_instruction, query],
+                    generation_config=config,
+                    stream=True
+                ),
+                on_complete=lambda answer: navigate_cache.put(cache_role, query, answer)
+            )
         try:
-            # Using gemini_model instead of gemini_pro_vision as vision model requires images
-            # Also passing system instruction directly if needed, or pre-pending to query
-            # For now, let's just remove it to fix the immediate error
-            answer = gemini_model.generate_content( 
+            answer = gemini_client.generate_content(
+                "chat_navigate",
                 contents=[system_instruction, query],
                 generation_config=config
             )
             answer = answer.text # Get text from the response object
+            navigate_cache.put(cache_role, query, answer)
         except Exception as e:
             answer = f"Error occurred: {str(e)}"
     else:
@@ -762,6 +2277,7 @@ def api_signup():
         "createdAt": datetime.utcnow()
     }
     result = users_collection.insert_one(user)
+    invalidate_user_profile(result.inserted_id)
     return jsonify({"msg": "Signup successful", "user_id": str(result.inserted_id)}), 201
 
 @app.route("/api/login", methods=["POST"])
@@ -872,12 +2388,37 @@ def update_profile():
         {"_id": ObjectId(user_id)},
         {"$set": update_data}
     )
+    invalidate_user_profile(user_id)
 
     if result.modified_count:
         return jsonify({"msg": "Profile updated successfully"}), 200
     else:
         return jsonify({"msg": "No changes made to profile"}), 200
 
+@app.route("/api/llm/stats", methods=["GET"])
+@jwt_required()
+def get_llm_stats():
+    """Per-call latency/outcome counters and circuit breaker state for Gemini calls"""
+    stats = gemini_client.stats()
+    stats["backend"] = llm_backend.name
+    stats["pdfExtraction"] = get_pdf_extraction_stats()
+    with _segregation_paths_lock:
+        stats["segregation"] = dict(segregation_paths)
+    return jsonify(stats), 200
+
+@app.route("/api/cache/stats", methods=["GET"])
+@jwt_required()
+def get_cache_stats():
+    """Hit/miss counters for the in-process caches"""
+    return jsonify({
+        "userProfiles": user_profile_cache.stats(),
+        "pdfText": pdf_text_cache.stats(),
+        "segregation": segregation_cache.stats(),
+        "grading": grading_cache.stats(),
+        "chatSessions": chat_session_store.stats(),
+        "navigate": navigate_cache.stats()
+    }), 200
+
 
 
 
@@ -925,15 +2466,25 @@ def create_classroom():
 @jwt_required()
 def get_classrooms():
     user_id = get_jwt_identity()
-    user = users_collection.find_one({"_id": ObjectId(user_id)})
+    user = get_user_profile(user_id)
     classrooms = []
     if user["userType"] == "teacher":
         query = {"teacher_id": ObjectId(user_id)}
+        submissions_for = None
     else:
         query = {"enrolled_students": ObjectId(user_id)}
-    for c in classrooms_collection.find(query).sort("createdAt", -1):
-        teacher = users_collection.find_one({"_id": c["teacher_id"]})
-        c["teacherName"] = teacher["fullName"] if teacher else ""
+        # Students only ever see their own submissions
+        submissions_for = user_id
+    classroom_docs = list(classrooms_collection.find(query, {"quizzes": 0}).sort("createdAt", -1))
+    quizzes_by_classroom = load_quizzes_with_submissions([c["_id"] for c in classroom_docs], submissions_for)
+    
+    # Resolve every teacher and commenter name in one query
+    users = resolve_users(
+        [c["teacher_id"] for c in classroom_docs] +
+        [cid for c in classroom_docs for cid in collect_commenter_ids(c.get("announcements"))]
+    )
+    for c in classroom_docs:
+        c["teacherName"] = get_user_name(users, c["teacher_id"], "")
         # Add header image before conversion
         c["headerImage"] = c.get("headerImage", random.choice(BACKGROUND_IMAGES))
         
@@ -941,39 +2492,10 @@ def get_classrooms():
         if "announcements" in c:
             for ann in c["announcements"]:
                 for comment in ann.get("comments", []):
-                    cid = comment["commenter_id"]
-                    user_obj = users_collection.find_one({"_id": cid})
-                    comment["commenterName"] = user_obj["fullName"] if user_obj else "Unknown"
-        
-        # Remove binary content from quizzes to prevent JSON serialization issues
-        if "quizzes" in c:
-            for quiz in c["quizzes"]:
-                # Remove binary content from question papers and answer keys
-                if "questionPaper" in quiz and "content" in quiz["questionPaper"]:
-                    # Replace binary content with metadata only
-                    quiz["questionPaper"] = {
-                        "filename": quiz["questionPaper"].get("filename", "question_paper.pdf"),
-                        "contentType": quiz["questionPaper"].get("contentType", "application/pdf"),
-                        "size": quiz["questionPaper"].get("size", 0)
-                    }
-                
-                if "answerKey" in quiz and "content" in quiz["answerKey"]:
-                    # Replace binary content with metadata only
-                    quiz["answerKey"] = {
-                        "filename": quiz["answerKey"].get("filename", "answer_key.pdf"),
-                        "contentType": quiz["answerKey"].get("contentType", "application/pdf"),
-                        "size": quiz["answerKey"].get("size", 0)
-                    }
-                
-                # Handle student submissions with file attachments
-                if "submissions" in quiz:
-                    for submission in quiz["submissions"]:
-                        if "answerFile" in submission and "content" in submission["answerFile"]:
-                            submission["answerFile"] = {
-                                "filename": submission["answerFile"].get("filename", "answer_file.pdf"),
-                                "contentType": submission["answerFile"].get("contentType", "application/pdf"),
-                                "size": submission["answerFile"].get("size", 0)
-                            }
+                    comment["commenterName"] = get_user_name(users, comment["commenter_id"])
+        
+        # Quizzes are loaded without their PDF content
+        c["quizzes"] = quizzes_by_classroom.get(c["_id"], [])
         
         # Convert the entire classroom object to be JSON serializable
         classrooms.append(mongo_to_json_serializable(c))
@@ -982,50 +2504,23 @@ def get_classrooms():
 @app.route("/api/classrooms/<classroom_id>", methods=["GET"])
 @jwt_required()
 def get_classroom(classroom_id):
-    classroom = classrooms_collection.find_one({"_id": ObjectId(classroom_id)})
-    if not classroom:
-        return jsonify({"msg": "Classroom not found"}), 404
-    teacher = users_collection.find_one({"_id": classroom["teacher_id"]})
-    classroom["teacherName"] = teacher["fullName"] if teacher else ""
+    user_id = get_jwt_identity()
+    classroom, user, error = get_classroom_and_validate_access(classroom_id, user_id, projection={"quizzes": 0})
+    if error:
+        return error
+    users = resolve_users([classroom["teacher_id"]] + collect_commenter_ids(classroom.get("announcements")))
+    classroom["teacherName"] = get_user_name(users, classroom["teacher_id"], "")
     classroom["headerImage"] = classroom.get("headerImage", random.choice(BACKGROUND_IMAGES))
     
     # Add commenter names for all announcements
     if "announcements" in classroom:
         for ann in classroom["announcements"]:
             for comment in ann.get("comments", []):
-                cid = comment["commenter_id"]
-                user_obj = users_collection.find_one({"_id": cid})
-                comment["commenterName"] = user_obj["fullName"] if user_obj else "Unknown"
-    
-    # Remove binary content from quizzes to prevent JSON serialization issues
-    if "quizzes" in classroom:
-        for quiz in classroom["quizzes"]:
-            # Remove binary content from question papers and answer keys
-            if "questionPaper" in quiz and "content" in quiz["questionPaper"]:
-                # Replace binary content with metadata only
-                quiz["questionPaper"] = {
-                    "filename": quiz["questionPaper"].get("filename", "question_paper.pdf"),
-                    "contentType": quiz["questionPaper"].get("contentType", "application/pdf"),
-                    "size": quiz["questionPaper"].get("size", 0)
-                }
-            
-            if "answerKey" in quiz and "content" in quiz["answerKey"]:
-                # Replace binary content with metadata only
-                quiz["answerKey"] = {
-                    "filename": quiz["answerKey"].get("filename", "answer_key.pdf"),
-                    "contentType": quiz["answerKey"].get("contentType", "application/pdf"),
-                    "size": quiz["answerKey"].get("size", 0)
-                }
-            
-            # Handle student submissions with file attachments
-            if "submissions" in quiz:
-                for submission in quiz["submissions"]:
-                    if "answerFile" in submission and "content" in submission["answerFile"]:
-                        submission["answerFile"] = {
-                            "filename": submission["answerFile"].get("filename", "answer_file.pdf"),
-                            "contentType": submission["answerFile"].get("contentType", "application/pdf"),
-                            "size": submission["answerFile"].get("size", 0)
-                        }
+                comment["commenterName"] = get_user_name(users, comment["commenter_id"])
+    
+    # Quizzes are loaded without their PDF content; students only see their own submissions
+    submissions_for = None if classroom["teacher_id"] == ObjectId(user_id) else user_id
+    classroom["quizzes"] = load_quizzes_with_submissions([classroom["_id"]], submissions_for)[classroom["_id"]]
     
     # Convert the entire classroom object to be JSON serializable
     classroom = mongo_to_json_serializable(classroom)
@@ -1092,10 +2587,11 @@ def post_classroom_announcement(classroom_id):
 @app.route("/api/classrooms/<classroom_id>/announcements", methods=["GET"])
 @jwt_required()
 def get_classroom_announcements(classroom_id):
-    classroom = classrooms_collection.find_one({"_id": ObjectId(classroom_id)})
+    classroom = classrooms_collection.find_one({"_id": ObjectId(classroom_id)}, {"announcements": 1})
     if not classroom:
         return jsonify({"msg": "Classroom not found"}), 404
     announcements = classroom.get("announcements", [])
+    users = resolve_users(collect_commenter_ids(announcements))
     for ann in announcements:
         ann["announcement_id"] = str(ann["announcement_id"])
         ann["teacher_id"] = str(ann["teacher_id"])
@@ -1104,8 +2600,7 @@ def get_classroom_announcements(classroom_id):
             cid = comment["commenter_id"]
             comment["commenter_id"] = str(cid)
             comment["commentTime"] = comment["commentTime"].isoformat()
-            user_obj = users_collection.find_one({"_id": cid})
-            comment["commenterName"] = user_obj["fullName"] if user_obj else "Unknown"
+            comment["commenterName"] = get_user_name(users, cid)
     return jsonify(announcements), 200
 
 @app.route("/api/classrooms/<classroom_id>/announcements/<announcement_id>", methods=["PUT"])
@@ -1174,8 +2669,13 @@ def get_classroom_quizzes(classroom_id):
         return error
     
     try:
-        # Process quizzes
-        quizzes = classroom.get("quizzes", [])
+        # Load quizzes without PDF content, with their submissions attached
+        quizzes = load_quizzes_with_submissions([classroom["_id"]])[classroom["_id"]]
+        
+        # Resolve every submitting student's name in one query
+        students = resolve_users([
+            submission["student_id"] for quiz in quizzes for submission in quiz["submissions"]
+        ])
         
         # Process each quiz
         for quiz in quizzes:
@@ -1215,31 +2715,13 @@ def get_classroom_quizzes(classroom_id):
                 
                 # Add student names to all quiz types
                 for submission in quiz["submissions"]:
-                    student = users_collection.find_one({"_id": submission["student_id"]})
-                    submission["studentName"] = student["fullName"] if student else "Unknown"
+                    submission["studentName"] = get_user_name(students, submission["student_id"])
                     
                     # Calculate percentage score for each submission
                     max_score = submission.get("maxScore", 0)
                     score = submission.get("score", 0)
                     submission["percentage"] = round((score / max_score) * 100, 1) if max_score > 0 else 0
             
-            # Remove binary content from response to reduce size
-            if "questionPaper" in quiz and "content" in quiz["questionPaper"]:
-                # Replace binary content with metadata only
-                quiz["questionPaper"] = {
-                    "filename": quiz["questionPaper"].get("filename", "question_paper.pdf"),
-                    "contentType": quiz["questionPaper"].get("contentType", "application/pdf"),
-                    "size": quiz["questionPaper"].get("size", 0)
-                }
-                
-            if "answerKey" in quiz and "content" in quiz["answerKey"]:
-                # Replace binary content with metadata only
-                quiz["answerKey"] = {
-                    "filename": quiz["answerKey"].get("filename", "answer_key.pdf"),
-                    "contentType": quiz["answerKey"].get("contentType", "application/pdf"),
-                    "size": quiz["answerKey"].get("size", 0)
-                }
-            
             # Ensure end time is calculated
             quiz["endTime"] = calculate_quiz_end_time(quiz)
         
@@ -1303,127 +2785,59 @@ def create_classroom_quiz(classroom_id):
         except ValueError:
             return jsonify({"msg": "Duration must be a positive integer"}), 400
         
-        # Process file uploads and store as binary data
+        # Read the uploads; the bytes are stored in GridFS, not on the quiz document
         question_paper_binary = question_paper_file.read() if question_paper_file else None
         answer_key_binary = answer_key_file.read() if answer_key_file else None
         
         # Create quiz object with PDF data
+        quiz_obj_id = ObjectId()
         quiz = {
-            "id": ObjectId(),
+            "_id": quiz_obj_id,
+            "id": quiz_obj_id,
+            "classroom_id": ObjectId(classroom_id),
             "title": data["title"],
             "description": data["description"],
             "startTime": start_time,
             "duration": duration,
             "published": data.get("published", "true").lower() == "true",
             "quizType": "pdf",  # Indicate this is a PDF-based quiz
-            "questionPaper": {
-                "filename": question_paper_file.filename,
-                "content": Binary(question_paper_binary),  # Store as Binary data in MongoDB
-                "contentType": "application/pdf",
-                "size": len(question_paper_binary)
-            },
-            "submissions": [],
+            "questionPaper": store_pdf_file(
+                question_paper_binary,
+                question_paper_file.filename,
+                metadata={"classroom_id": ObjectId(classroom_id), "quiz_id": quiz_obj_id, "field": "questionPaper"}
+            ),
             "createdAt": datetime.utcnow(),
             "updatedAt": datetime.utcnow()
         }
         
         # Add answer key if provided
         if answer_key_binary:
-            quiz["answerKey"] = {
-                "filename": answer_key_file.filename,
-                "content": Binary(answer_key_binary),  # Store as Binary data in MongoDB
-                "contentType": "application/pdf",
-                "size": len(answer_key_binary)
-            }
+            quiz["answerKey"] = store_pdf_file(
+                answer_key_binary,
+                answer_key_file.filename,
+                metadata={"classroom_id": ObjectId(classroom_id), "quiz_id": quiz_obj_id, "field": "answerKey"}
+            )
         
-        # ============ AUTOMATIC PDF TEXT EXTRACTION ============
-        print("\n===== AUTOMATIC PDF TEXT EXTRACTION STARTED =====")
-        print(f"Processing quiz: {quiz['title']}")
+        # Text extraction and segregation run in the background (see ingest_quiz_pdfs_job)
+        quiz["extractionStatus"] = "queued"
+        quiz["extractionLeaseExpiresAt"] = datetime.utcnow() + timedelta(seconds=QUIZ_EXTRACTION_LEASE_SECONDS)
+        quiz["extractionProgress"] = {"questionPaper": "queued"}
+        if answer_key_binary:
+            quiz["extractionProgress"]["answerKey"] = "queued"
         
-        # Extract text from question paper PDF
-        question_paper_extracted_texts = []
+        # Store the quiz in its own collection
         try:
-            print(f"\nExtracting text from question paper: {question_paper_file.filename}")
-            
-            # Extract text using Gemini 1.5
-            print("Extracting text from question paper PDF...")
-            question_paper_text = extract_text_from_pdf(question_paper_binary)
-            print(f"Extracted text from question paper: {len(question_paper_text)} characters")
-            print(f"Sample text: {question_paper_text}...")
-            
-            # Segregate questions by number
-            print("Segregating questions by number...")
-            segregated_questions = segregate_questions_by_number(question_paper_text, is_question_paper=True)
-            
-            question_paper_extracted_texts.append(question_paper_text)
-            
-            print(f"Successfully extracted text from question paper")
-            
-            # Add extracted text to quiz
-            quiz["extractedText"] = {
-                "questionPaper": question_paper_extracted_texts,
-                "segregatedQuestions": segregated_questions,
-                "timestamp": datetime.utcnow()
-            }
-            
-        except Exception as e:
-            print(f"ERROR extracting text from question paper: {str(e)}")
-            traceback.print_exc()
-            print("Continuing without question paper text extraction")
-        
-        # Extract text from answer key PDF if provided
-        if answer_key_binary:
-            answer_key_extracted_texts = []
-            try:
-                print(f"\nExtracting text from answer key: {answer_key_file.filename}")
-                
-                # Extract text using Gemini 1.5
-                print("Extracting text from answer key PDF...")
-                answer_key_text = extract_text_from_pdf(answer_key_binary)
-                print(f"Extracted text from answer key: {len(answer_key_text)} characters")
-                print(f"Sample text: {answer_key_text}...")
-                
-                # Segregate answer key by question number
-                print("Segregating answer key by question number...")
-                segregated_answers = segregate_questions_by_number(answer_key_text, is_question_paper=False)
-                
-                answer_key_extracted_texts.append(answer_key_text)
-                
-                print(f"Successfully extracted text from answer key")
-                
-                # Add extracted answer key text to quiz
-                if "extractedText" not in quiz:
-                    quiz["extractedText"] = {"timestamp": datetime.utcnow()}
-                
-                quiz["extractedText"]["answerKey"] = answer_key_extracted_texts
-                quiz["extractedText"]["segregatedAnswers"] = segregated_answers
-                
-            except Exception as e:
-                print(f"ERROR extracting text from answer key: {str(e)}")
-                traceback.print_exc()
-                print("Continuing without answer key text extraction")
+            result = quizzes_collection.insert_one(quiz)
+        except Exception:
+            delete_pdf_file(quiz.get("questionPaper"))
+            delete_pdf_file(quiz.get("answerKey"))
+            raise
         
-        # Print summary
-        if "extractedText" in quiz:
-            question_pages = len(quiz["extractedText"].get("questionPaper", []))
-            answer_pages = len(quiz["extractedText"].get("answerKey", []))
+        if result.inserted_id:
+            job_id = enqueue_job("ingest_quiz_pdfs", {"quiz_id": quiz_obj_id}, user_id=user_id, classroom_id=classroom_id)
+            quizzes_collection.update_one({"_id": quiz_obj_id}, {"$set": {"extractionJobId": job_id}})
+            quiz["extractionJobId"] = job_id
             
-            print("\n===== PDF TEXT EXTRACTION SUMMARY =====")
-            print(f"Quiz: {quiz['title']}")
-            print(f"Question paper pages processed: {question_pages}")
-            print(f"Answer key pages processed: {answer_pages}")
-            print("Extracted text saved to database")
-        
-        print("===== AUTOMATIC PDF TEXT EXTRACTION COMPLETE =====\n")
-        # ============ END PDF TEXT EXTRACTION ============
-        
-        # Add quiz to classroom
-        result = classrooms_collection.update_one(
-            {"_id": ObjectId(classroom_id)},
-            {"$push": {"quizzes": quiz}}
-        )
-        
-        if result.modified_count:
             # Calculate and add end time for response
             quiz["endTime"] = calculate_quiz_end_time(quiz)
             
@@ -1445,16 +2859,15 @@ def create_classroom_quiz(classroom_id):
                     "size": quiz["answerKey"]["size"]
                 }
             
-            # Include text extraction status in response
-            if "extractedText" in quiz:
-                response_quiz["textExtractionStatus"] = "completed"
-                response_quiz["questionPaperTextPages"] = len(quiz["extractedText"].get("questionPaper", []))
-                response_quiz["answerKeyTextPages"] = len(quiz["extractedText"].get("answerKey", []))
+            response_quiz["textExtractionStatus"] = "queued"
             
             return jsonify({
-                "msg": "Quiz created successfully", 
-                "quiz": mongo_to_json_serializable(response_quiz)
-            }), 201
+                "msg": "Quiz created; PDF text extraction is running in the background",
+                "quiz": mongo_to_json_serializable(response_quiz),
+                "extractionStatus": "queued",
+                "jobId": str(job_id),
+                "statusUrl": url_for("get_job_status", job_id=str(job_id))
+            }), 202
         
         return jsonify({"msg": "Failed to create quiz"}), 500
         
@@ -1476,105 +2889,44 @@ def get_classroom_quiz(classroom_id, quiz_id):
     
     try:
         # Find the quiz
-        quiz = find_quiz_by_id(classroom, quiz_id)
+        quiz = find_quiz_by_id(classroom_id, quiz_id)
         if not quiz:
             return jsonify({"msg": "Quiz not found"}), 404
         
         # Process quiz based on user type
         is_teacher = classroom["teacher_id"] == ObjectId(user_id)
         
-        # For teachers, automatically extract PDF text if not already done
-        if is_teacher and not quiz.get("extractedText"):
-            print(f"\n===== AUTOMATIC PDF TEXT EXTRACTION FOR QUIZ =====")
-            print(f"Quiz: {quiz.get('title', 'Untitled Quiz')} (ID: {quiz_id})")
-            
-            # Check for question paper PDF
-            pdf_processed = False
-            if quiz.get("questionPaper") and "content" in quiz.get("questionPaper", {}):
-                try:
-                    print(f"Found question paper PDF: {quiz['questionPaper'].get('filename', 'unnamed')}")
-                    
-                    # Extract question paper PDF content
-                    pdf_binary = quiz["questionPaper"]["content"]
-                    
-                    # Use new robust extraction method
-                    print("Extracting text from question paper PDF...")
-                    question_paper_text = extract_text_from_pdf(pdf_binary)
-                    
-                    # Process answer key PDF if available
-                    answer_key_text = None
-                    if quiz.get("answerKey") and "content" in quiz.get("answerKey", {}):
-                        print(f"\nFound answer key PDF: {quiz['answerKey'].get('filename', 'unnamed')}")
-                        
-                        # Extract answer key PDF content
-                        answer_key_binary = quiz["answerKey"]["content"]
-                        
-                        # Use new robust extraction method
-                        print("Extracting text from answer key PDF...")
-                        answer_key_text = extract_text_from_pdf(answer_key_binary)
-                    
-                    # Save extracted text to database
-                    extracted_text = {
-                        "timestamp": datetime.utcnow()
-                    }
-                    
-                    if question_paper_text:
-                        extracted_text["questionPaper"] = [question_paper_text]
-                        
-                    if answer_key_text:
-                        extracted_text["answerKey"] = [answer_key_text]
-                    
-                    # Only save if we have extracted text
-                    if "questionPaper" in extracted_text or "answerKey" in extracted_text:
-                        print("\nSaving extracted text to database...")
-                        
-                        result = classrooms_collection.update_one(
-                            {"_id": ObjectId(classroom_id), "quizzes.id": ObjectId(quiz_id)},
-                            {"$set": {"quizzes.$.extractedText": extracted_text}}
-                        )
-                        
-                        if result.modified_count == 1:
-                            print("Text extraction saved to database successfully")
-                            
-                            # Update the quiz object with extracted text for the response
-                            quiz["extractedText"] = extracted_text
-                            pdf_processed = True
-                        else:
-                            print("Warning: Failed to save text extraction to database")
-                    else:
-                        print("No text was extracted from either PDF")
-                    
-                except Exception as e:
-                    print(f"Error extracting text from PDF: {str(e)}")
-                    traceback.print_exc()
-            
-            print(f"===== PDF TEXT EXTRACTION {'COMPLETED' if pdf_processed else 'FAILED'} =====\n")
+        # For teachers, extract PDF text in the background if it is missing;
+        # the page is returned right away with the extraction status
+        if is_teacher:
+            if quiz.get("extractedText"):
+                quiz.setdefault("extractionStatus", "completed")
+            else:
+                quiz["extractionStatus"] = request_quiz_extraction(quiz, user_id, classroom_id)
         
         if is_teacher:
             # Teacher view - include all information
             # Add student names to submissions
-            if "submissions" in quiz:
-                for submission in quiz["submissions"]:
-                    student = users_collection.find_one({"_id": submission["student_id"]})
-                    submission["studentName"] = student["fullName"] if student else "Unknown"
+            quiz["submissions"] = list_quiz_submissions(classroom_id, quiz_id)
+            students = resolve_users([submission["student_id"] for submission in quiz["submissions"]])
+            for submission in quiz["submissions"]:
+                submission["studentName"] = get_user_name(students, submission["student_id"])
             
             # Add end time
             quiz["endTime"] = calculate_quiz_end_time(quiz)
         else:
             # Student view - hide correct answers
             user_obj_id = ObjectId(user_id)
-            quiz_status = get_quiz_status(quiz, user_obj_id)
+            submission = find_submission(classroom_id, quiz_id, user_obj_id)
+            quiz_status = get_quiz_status(quiz, user_obj_id, has_submitted=submission is not None)
             
             # Prepare student view of quiz
             quiz = prepare_quiz_for_student(quiz, include_correct_answers=False)
             quiz["studentStatus"] = quiz_status
             
             # If submitted, include the student's submission details
-            if quiz_status == "submitted":
-                for submission in quiz["submissions"]:
-                    if submission["student_id"] == user_obj_id:
-                        quiz["submission"] = mongo_to_json_serializable(submission)
-                        break
+            if submission:
+                quiz["submission"] = mongo_to_json_serializable(submission)
         
         return jsonify(mongo_to_json_serializable(quiz)), 200
         
@@ -1596,24 +2948,19 @@ def update_classroom_quiz(classroom_id, quiz_id):
     
     try:
         # Find the quiz
-        quiz = None
-        quiz_index = -1
-        
-        for i, q in enumerate(classroom.get("quizzes", [])):
-            if str(q["id"]) == quiz_id:
-                quiz = q
-                quiz_index = i
-                break
-                
+        quiz = find_quiz_by_id(classroom_id, quiz_id)
         if quiz is None:
             return jsonify({"msg": "Quiz not found"}), 404
         
         # Check if quiz has submissions (limit what can be changed)
-        has_submissions = len(quiz.get("submissions", [])) > 0
+        has_submissions = quiz_has_submissions(classroom_id, quiz_id)
         
         # Check if this is a PDF quiz
         is_pdf_quiz = quiz.get("quizType") == "pdf"
         
+        # Replacement PDFs as {field: (filename, bytes)}
+        new_pdf_uploads = {}
+        
         # Process request based on content type
         if is_pdf_quiz:
             # Handle PDF quiz update with FormData (multipart/form-data)
@@ -1661,14 +3008,8 @@ def update_classroom_quiz(classroom_id, quiz_id):
                 if not question_paper_file.filename.lower().endswith('.pdf'):
                     return jsonify({"msg": "Question paper must be a PDF file"}), 400
                 
-                # Process new question paper file
-                question_paper_binary = question_paper_file.read()
-                updated_quiz["questionPaper"] = {
-                    "filename": question_paper_file.filename,
-                    "content": Binary(question_paper_binary),
-                    "contentType": "application/pdf",
-                    "size": len(question_paper_binary)
-                }
+                # Process new question paper file; it is written to GridFS once validation passes
+                new_pdf_uploads["questionPaper"] = (question_paper_file.filename, question_paper_file.read())
             
             if answer_key_file:
                 # Validate files are PDFs
@@ -1676,27 +3017,21 @@ def update_classroom_quiz(classroom_id, quiz_id):
                     return jsonify({"msg": "Answer key must be a PDF file"}), 400
                 
                 # Process new answer key file
-                answer_key_binary = answer_key_file.read()
-                updated_quiz["answerKey"] = {
-                    "filename": answer_key_file.filename,
-                    "content": Binary(answer_key_binary),
-                    "contentType": "application/pdf",
-                    "size": len(answer_key_binary)
-                }
+                new_pdf_uploads["answerKey"] = (answer_key_file.filename, answer_key_file.read())
                 
         else:
             # Handle regular quiz update with JSON data
             data = request.get_json()
-        if not data:
-            return jsonify({"msg": "Quiz data is required"}), 400
-        
-        # Create updated quiz object
-        updated_quiz = quiz.copy()
-        
-        # Update basic fields
-        for field in ["title", "description", "published"]:
-            if field in data:
-                updated_quiz[field] = data[field]
+            if not data:
+                return jsonify({"msg": "Quiz data is required"}), 400
+            
+            # Create updated quiz object
+            updated_quiz = quiz.copy()
+            
+            # Update basic fields
+            for field in ["title", "description", "published"]:
+                if field in data:
+                    updated_quiz[field] = data[field]
         
         # Handle questions update if provided and no submissions exist
         if "questions" in data:
@@ -1807,7 +3142,7 @@ def update_classroom_quiz(classroom_id, quiz_id):
             
             # If duration is updated
             if "duration" in data:
-                if has_submissions and data["duration"] < updated_quiz["duration"]:
+                if has_submissions and int(data["duration"]) < updated_quiz["duration"]:
                     return jsonify({"msg": "Cannot shorten duration for a quiz with existing submissions"}), 400
                     
                 updated_quiz["duration"] = int(data["duration"])
@@ -1816,16 +3151,32 @@ def update_classroom_quiz(classroom_id, quiz_id):
         except ValueError as e:
             return jsonify({"msg": f"Invalid date format or duration: {str(e)}"}), 400
         
+        # Store replacement PDFs now that the update is known to be valid
+        for field, (filename, pdf_binary) in new_pdf_uploads.items():
+            updated_quiz[field] = store_pdf_file(
+                pdf_binary,
+                filename,
+                metadata={"classroom_id": quiz["classroom_id"], "quiz_id": quiz["_id"], "field": field}
+            )
+        
         # Update modified timestamp
         updated_quiz["updatedAt"] = datetime.utcnow()
         
-        # Update the quiz in classroom
-        classroom["quizzes"][quiz_index] = updated_quiz
-        result = classrooms_collection.update_one(
-            {"_id": ObjectId(classroom_id)},
-            {"$set": {"quizzes": classroom["quizzes"]}}
+        # Only write the fields that changed; the stored PDF content was not
+        # loaded and is left untouched unless a new file was uploaded
+        changed_fields = {
+            field: value for field, value in updated_quiz.items()
+            if field != "_id" and quiz.get(field) != value
+        }
+        result = quizzes_collection.update_one(
+            {"_id": quiz["_id"]},
+            {"$set": changed_fields}
         )
         
+        # Drop the GridFS files that the new uploads replaced
+        for field in new_pdf_uploads:
+            delete_pdf_file(quiz.get(field))
+        
         if result.modified_count:
             # Calculate and add end time for response
             updated_quiz["endTime"] = calculate_quiz_end_time(updated_quiz)
@@ -1854,22 +3205,23 @@ def delete_classroom_quiz(classroom_id, quiz_id):
     
     try:
         # Find the quiz
-        quiz = find_quiz_by_id(classroom, quiz_id)
+        quiz = find_quiz_by_id(
+            classroom_id, quiz_id,
+            projection={"_id": 1, "questionPaper.file_id": 1, "answerKey.file_id": 1}
+        )
         if not quiz:
             return jsonify({"msg": "Quiz not found"}), 404
             
         # Check if quiz has submissions
-        if quiz.get("submissions") and len(quiz["submissions"]) > 0:
+        if quiz_has_submissions(classroom_id, quiz_id):
             return jsonify({"msg": "Cannot delete a quiz with existing submissions. Consider unpublishing it instead."}), 400
         
         # Delete the quiz
-        updated_quizzes = [q for q in classroom["quizzes"] if str(q["id"]) != quiz_id]
-        result = classrooms_collection.update_one(
-            {"_id": ObjectId(classroom_id)},
-            {"$set": {"quizzes": updated_quizzes}}
-        )
+        result = quizzes_collection.delete_one({"_id": quiz["_id"]})
         
-        if result.modified_count:
+        if result.deleted_count:
+            delete_pdf_file(quiz.get("questionPaper"))
+            delete_pdf_file(quiz.get("answerKey"))
             return jsonify({"msg": "Quiz deleted successfully"}), 200
         return jsonify({"msg": "No changes made"}), 200
         
@@ -1891,7 +3243,7 @@ def get_quiz_results(classroom_id, quiz_id):
     
     try:
         # Find the quiz
-        quiz = find_quiz_by_id(classroom, quiz_id)
+        quiz = find_quiz_by_id(classroom_id, quiz_id)
         if not quiz:
             return jsonify({"msg": "Quiz not found"}), 404
             
@@ -1900,9 +3252,11 @@ def get_quiz_results(classroom_id, quiz_id):
         
         # Process submissions
         submissions = []
-        for submission in quiz.get("submissions", []):
+        quiz_submissions = list_quiz_submissions(classroom_id, quiz_id)
+        students = resolve_users([submission["student_id"] for submission in quiz_submissions])
+        for submission in quiz_submissions:
             # Get student info
-            student = users_collection.find_one({"_id": submission["student_id"]})
+            student = students.get(submission["student_id"])
             submission_copy = submission.copy()
             submission_copy["studentName"] = student["fullName"] if student else "Unknown"
             submission_copy["studentEmail"] = student["email"] if student else ""
@@ -2040,46 +3394,15 @@ def get_student_quiz_results(classroom_id, quiz_id):
     
     try:
         # Find the quiz
-        quiz = find_quiz_by_id(classroom, quiz_id)
+        quiz = find_quiz_by_id(classroom_id, quiz_id)
         if not quiz:
             return jsonify({"msg": "Quiz not found"}), 404
             
         # Find the student's submission
-        user_id_str = str(user_id)
-        user_obj_id = None
-        
-        # Try to convert user_id to ObjectId if it's a valid format
-        try:
-            user_obj_id = ObjectId(user_id)
-        except:
-            pass  # If conversion fails, we'll just use the string version
-            
-        # Debug info
-        print(f"Looking for student submission with user_id: {user_id}, user_id_str: {user_id_str}")
-        if user_obj_id:
-            print(f"Also checking with ObjectId: {user_obj_id}")
-        
-        # Iterate through submissions with more flexible comparison
-        student_submission = None
-        for submission in quiz.get("submissions", []):
-            sub_student_id = submission.get("student_id")
-            sub_student_id_str = str(sub_student_id) if sub_student_id else None
-            
-            print(f"Comparing submission student_id: {sub_student_id}, str: {sub_student_id_str}")
-            
-            # Try different comparison methods to find a match
-            if (sub_student_id_str == user_id_str or 
-                (user_obj_id and sub_student_id == user_obj_id) or
-                (user_obj_id and str(user_obj_id) == sub_student_id_str)):
-                student_submission = submission
-                print(f"Found matching submission for student")
-                break
+        student_submission = find_submission(classroom_id, quiz_id, user_id)
                 
         if not student_submission:
             print(f"No submission found for student with user_id: {user_id}")
-            # List available submissions for debugging
-            submission_ids = [str(s.get("student_id")) for s in quiz.get("submissions", [])]
-            print(f"Available submission student_ids: {submission_ids}")
             return jsonify({"msg": "No submission found for this student"}), 404
         
         # Create a modified copy for the student view
@@ -2156,28 +3479,18 @@ def get_quiz_pdf(classroom_id, quiz_id, file_type):
         return error
     
     try:
-        # Instead of using the returned classroom, fetch the quiz directly from the database
-        # to ensure we have the binary content
-        classroom_obj = classrooms_collection.find_one({"_id": ObjectId(classroom_id)})
-        if not classroom_obj:
-            return jsonify({"msg": "Classroom not found"}), 404
-            
-        # Find the quiz
-        quiz = None
-        for q in classroom_obj.get("quizzes", []):
-            if str(q["id"]) == quiz_id:
-                quiz = q
-                break
-                
+        # Validate file type
+        if file_type not in ["questionPaper", "answerKey"]:
+            return jsonify({"msg": "Invalid file type. Must be 'questionPaper' or 'answerKey'"}), 400
+        
+        # Load the quiz with only the requested file's content
+        other_file_type = "answerKey" if file_type == "questionPaper" else "questionPaper"
+        quiz = find_quiz_by_id(classroom_id, quiz_id, projection={f"{other_file_type}.content": 0})
         if not quiz:
             return jsonify({"msg": "Quiz not found"}), 404
         
         is_teacher = user.get("userType") == "teacher"
         
-        # Validate file type
-        if file_type not in ["questionPaper", "answerKey"]:
-            return jsonify({"msg": "Invalid file type. Must be 'questionPaper' or 'answerKey'"}), 400
-        
         # Only teachers can access answer keys
         if file_type == "answerKey" and not is_teacher:
             return jsonify({"msg": "Unauthorized access to answer key"}), 403
@@ -2197,16 +3510,11 @@ def get_quiz_pdf(classroom_id, quiz_id, file_type):
         file_data = quiz[file_type]
         
         # Check if content exists in the file_data
-        if "content" not in file_data:
+        if not has_pdf_content(file_data):
             return jsonify({"msg": f"The file content is missing"}), 500
         
-        # Return PDF file
-        return send_file(
-            io.BytesIO(file_data["content"]),
-            mimetype=file_data.get("contentType", "application/pdf"),
-            as_attachment=True,
-            download_name=file_data.get("filename", f"{file_type}.pdf")
-        )
+        # Stream the PDF from GridFS (supports Range requests)
+        return stream_pdf_file(file_data, f"{file_type}.pdf")
         
     except Exception as e:
         error_traceback = traceback.format_exc()
@@ -2227,29 +3535,13 @@ def get_student_submission_pdf(classroom_id, quiz_id, student_id):
         return error
     
     try:
-        # Fetch classroom directly from the database to ensure we have binary content
-        classroom_obj = classrooms_collection.find_one({"_id": ObjectId(classroom_id)})
-        if not classroom_obj:
-            return jsonify({"msg": "Classroom not found"}), 404
-            
         # Find the quiz
-        quiz = None
-        for q in classroom_obj.get("quizzes", []):
-            if str(q["id"]) == quiz_id:
-                quiz = q
-                break
-                
+        quiz = find_quiz_by_id(classroom_id, quiz_id, projection={"_id": 1})
         if not quiz:
             return jsonify({"msg": "Quiz not found"}), 404
         
-        # Find student submission
-        submission = None
-        student_obj_id = ObjectId(student_id)
-        
-        for sub in quiz.get("submissions", []):
-            if sub["student_id"] == student_obj_id:
-                submission = sub
-                break
+        # Find student submission with its file descriptor
+        submission = find_submission(classroom_id, quiz_id, student_id, projection={"answerFile": 1})
                 
         if not submission:
             return jsonify({"msg": "Student submission not found"}), 404
@@ -2262,16 +3554,11 @@ def get_student_submission_pdf(classroom_id, quiz_id, student_id):
         file_data = submission["answerFile"]
         
         # Check if content exists in the file_data
-        if "content" not in file_data:
+        if not has_pdf_content(file_data):
             return jsonify({"msg": "The file content is missing"}), 500
         
-        # Return PDF file
-        return send_file(
-            io.BytesIO(file_data["content"]),
-            mimetype=file_data.get("contentType", "application/pdf"),
-            as_attachment=True,
-            download_name=file_data.get("filename", "student_submission.pdf")
-        )
+        # Stream the PDF from GridFS (supports Range requests)
+        return stream_pdf_file(file_data, "student_submission.pdf")
         
     except Exception as e:
         error_traceback = traceback.format_exc()
@@ -2291,20 +3578,12 @@ def grade_pdf_submission(classroom_id, quiz_id, student_id):
     
     try:
         # Find the quiz
-        quiz = find_quiz_by_id(classroom, quiz_id)
+        quiz = find_quiz_by_id(classroom_id, quiz_id, projection={"_id": 1})
         if not quiz:
             return jsonify({"msg": "Quiz not found"}), 404
         
         # Find the student's submission
-        student_obj_id = ObjectId(student_id)
-        submission = None
-        submission_index = -1
-        
-        for i, sub in enumerate(quiz.get("submissions", [])):
-            if sub["student_id"] == student_obj_id:
-                submission = sub
-                submission_index = i
-                break
+        submission = find_submission(classroom_id, quiz_id, student_id, projection={"_id": 1})
                 
         if not submission:
             return jsonify({"msg": "Student submission not found"}), 404
@@ -2324,21 +3603,16 @@ def grade_pdf_submission(classroom_id, quiz_id, student_id):
             feedback = data.get("feedback", "")
             
             # Update submission with grade
-            submission["score"] = score
-            submission["maxScore"] = max_score
-            submission["feedback"] = feedback
-            submission["isGraded"] = True
-            submission["gradedAt"] = datetime.utcnow()
-            submission["gradedBy"] = ObjectId(user_id)
-            
-            # Update the submission in the quiz
-            quiz["submissions"][submission_index] = submission
-            
-            # Update the quiz in the database
-            result = classrooms_collection.update_one(
-                {"_id": ObjectId(classroom_id)},
-                {"$set": {f"quizzes.$[quiz].submissions": quiz["submissions"]}},
-                array_filters=[{"quiz.id": ObjectId(quiz_id)}]
+            result = submissions_collection.update_one(
+                {"_id": submission["_id"]},
+                {"$set": {
+                    "score": score,
+                    "maxScore": max_score,
+                    "feedback": feedback,
+                    "isGraded": True,
+                    "gradedAt": datetime.utcnow(),
+                    "gradedBy": ObjectId(user_id)
+                }}
             )
             
             if result.modified_count:
@@ -2379,18 +3653,12 @@ def get_student_answer_pdf(classroom_id, quiz_id, student_id):
     
     try:
         # Find the quiz
-        quiz = find_quiz_by_id(classroom, quiz_id)
+        quiz = find_quiz_by_id(classroom_id, quiz_id, projection={"_id": 1})
         if not quiz:
             return jsonify({"msg": "Quiz not found"}), 404
         
-        # Find the student's submission
-        student_obj_id = ObjectId(student_id)
-        submission = None
-        
-        for sub in quiz.get("submissions", []):
-            if sub["student_id"] == student_obj_id:
-                submission = sub
-                break
+        # Find the student's submission with its file descriptor
+        submission = find_submission(classroom_id, quiz_id, student_id, projection={"answerFile": 1})
                 
         if not submission:
             return jsonify({"msg": "Student submission not found"}), 404
@@ -2401,21 +3669,12 @@ def get_student_answer_pdf(classroom_id, quiz_id, student_id):
         
         # Get the file data
         file_data = submission["answerFile"]
-        content = file_data.get("content")
         
-        if not content:
+        if not has_pdf_content(file_data):
             return jsonify({"msg": "Answer file content not found"}), 404
         
-        # Set filename for download
-        filename = file_data.get("filename", "student_answer.pdf")
-        
-        # Send the file
-        response = make_response(content)
-        response.headers.set("Content-Type", "application/pdf")
-        response.headers.set(
-            "Content-Disposition", f"attachment; filename={filename}"
-        )
-        return response
+        # Stream the PDF from GridFS (supports Range requests)
+        return stream_pdf_file(file_data, "student_answer.pdf")
         
     except Exception as e:
         error_traceback = traceback.format_exc()
@@ -2435,7 +3694,7 @@ def debug_quiz_status(classroom_id, quiz_id):
     
     try:
         # Find the quiz
-        quiz = find_quiz_by_id(classroom, quiz_id)
+        quiz = find_quiz_by_id(classroom_id, quiz_id)
         if not quiz:
             return jsonify({"msg": "Quiz not found"}), 404
         
@@ -2449,17 +3708,14 @@ def debug_quiz_status(classroom_id, quiz_id):
         
         # Check if student has submitted
         user_obj_id = ObjectId(user_id)
-        has_submitted = any(
-            submission["student_id"] == user_obj_id 
-            for submission in quiz.get("submissions", [])
-        )
+        has_submitted = has_student_submitted(quiz, user_obj_id)
         
         # Calculate time differences
         time_since_start = current_time - quiz_start
         time_until_end = quiz_end - current_time
         
         # Determine status
-        quiz_status = get_quiz_status(quiz, user_obj_id, current_time)
+        quiz_status = get_quiz_status(quiz, user_obj_id, current_time, has_submitted=has_submitted)
         
         # Return debug info
         return jsonify({
@@ -2518,12 +3774,12 @@ def get_classroom_drafts(classroom_id):
         user_obj_id = ObjectId(user_id)
         
         # Validate classroom access
-        classroom = get_classroom_and_validate_access(classroom_id, user_id, required_role="teacher")
-        if not classroom:
-            return jsonify({"msg": "Classroom not found or access denied"}), 404
+        classroom, user, error = get_classroom_and_validate_access(classroom_id, user_id, required_role="teacher")
+        if error:
+            return error
         
         # Get drafts from the database
-        drafts = list(db.drafts.find({
+        drafts = list(drafts_collection.find({
             "classroom_id": ObjectId(classroom_id),
             "user_id": user_obj_id
         }))
@@ -2549,9 +3805,9 @@ def save_classroom_draft(classroom_id):
         user_obj_id = ObjectId(user_id)
         
         # Validate classroom access
-        classroom = get_classroom_and_validate_access(classroom_id, user_id, required_role="teacher")
-        if not classroom:
-            return jsonify({"msg": "Classroom not found or access denied"}), 404
+        classroom, user, error = get_classroom_and_validate_access(classroom_id, user_id, required_role="teacher")
+        if error:
+            return error
         
         # Get draft data from request
         data = request.json
@@ -2571,7 +3827,7 @@ def save_classroom_draft(classroom_id):
         }
         
         # Use upsert to create or update
-        result = db.drafts.update_one(
+        result = drafts_collection.update_one(
             {
                 "classroom_id": ObjectId(classroom_id),
                 "user_id": user_obj_id,
@@ -2599,9 +3855,9 @@ def autosave_classroom_draft(classroom_id):
         user_obj_id = ObjectId(user_id)
         
         # Validate classroom access
-        classroom = get_classroom_and_validate_access(classroom_id, user_id, required_role="teacher")
-        if not classroom:
-            return jsonify({"msg": "Classroom not found or access denied"}), 404
+        classroom, user, error = get_classroom_and_validate_access(classroom_id, user_id, required_role="teacher")
+        if error:
+            return error
         
         # Get draft data from request
         data = request.json
@@ -2621,7 +3877,7 @@ def autosave_classroom_draft(classroom_id):
         }
         
         # Use upsert to create or update
-        result = db.drafts.update_one(
+        result = drafts_collection.update_one(
             {
                 "classroom_id": ObjectId(classroom_id),
                 "user_id": user_obj_id,
@@ -2649,12 +3905,12 @@ def delete_classroom_draft(classroom_id, draft_id):
         user_obj_id = ObjectId(user_id)
         
         # Validate classroom access
-        classroom = get_classroom_and_validate_access(classroom_id, user_id, required_role="teacher")
-        if not classroom:
-            return jsonify({"msg": "Classroom not found or access denied"}), 404
+        classroom, user, error = get_classroom_and_validate_access(classroom_id, user_id, required_role="teacher")
+        if error:
+            return error
         
         # Delete the draft
-        result = db.drafts.delete_one({
+        result = drafts_collection.delete_one({
             "classroom_id": ObjectId(classroom_id),
             "user_id": user_obj_id,
             "draft_id": draft_id
@@ -2677,26 +3933,28 @@ def get_submission(classroom_id, quiz_id, student_id):
     if error:
         return None, None, None
         
-    quiz = find_quiz_by_id(classroom, quiz_id)
+    quiz = find_quiz_by_id(classroom_id, quiz_id)
     if not quiz:
         return classroom, None, None
         
-    student_obj_id = ObjectId(student_id)
-    submission = None
-    
-    for sub in quiz.get("submissions", []):
-        if sub["student_id"] == student_obj_id:
-            submission = sub
-            break
+    submission = find_submission(classroom_id, quiz_id, student_id)
             
     return classroom, quiz, submission
 
 def update_submission(classroom_id, quiz_id, student_id, updated_submission):
-    """Update an existing quiz submission in the database"""
-    result = classrooms_collection.update_one(
-        {"_id": ObjectId(classroom_id), "quizzes.id": ObjectId(quiz_id), "quizzes.submissions.student_id": ObjectId(student_id)},
-        {"$set": {"quizzes.$.submissions.$[elem]": updated_submission}},
-        array_filters=[{"elem.student_id": ObjectId(student_id)}]
+    """Update fields of an existing quiz submission in the database"""
+    # The binary answer file is never loaded by readers, so never overwrite it here
+    fields = {
+        field: value for field, value in updated_submission.items()
+        if field not in ("_id", "classroom_id", "quiz_id", "student_id", "answerFile")
+    }
+    result = submissions_collection.update_one(
+        {
+            "classroom_id": ObjectId(classroom_id),
+            "quiz_id": ObjectId(quiz_id),
+            "student_id": ObjectId(student_id)
+        },
+        {"$set": fields}
     )
     return result.modified_count > 0
 
@@ -2704,15 +3962,16 @@ def extract_text_from_image(image_bytes):
     """Extract text from an image using Gemini Vision API"""
     try:
         # Generate content from image
-        response = gemini_pro_vision.generate_content(
+        response = gemini_client.generate_content(
+            "extract_image_text",
             [
                 image_bytes,
                 "Extract all visible text from this image. Preserve structure and formatting as much as possible. Separate paragraphs with newlines. Don't include any commentary, just return the extracted text."
             ],
-            generation_config=genai.GenerationConfig(
-                temperature=0.0,
-                max_output_tokens=4000,
-            )
+            generation_config={
+                "temperature": 0.0,
+                "max_output_tokens": 4000,
+            }
         )
         
         # Check response and return extracted text
@@ -2724,67 +3983,481 @@ def extract_text_from_image(image_bytes):
         print(f"Error in extract_text_from_image: {str(e)}")
         return f"Error extracting text: {str(e)}"
 
-def extract_text_from_pdf(pdf_bytes):
+# Bump the prompt version whenever the extraction prompt or model changes so
+# cached results from the old prompt are no longer used
+PDF_EXTRACTION_MODEL = "gemini-2.0-flash"
+PDF_EXTRACTION_PROMPT = "Extract all text from this document. Preserve structure and formatting as much as possible."
+PDF_EXTRACTION_PROMPT_VERSION = "1"
+
+# Long PDFs are split into chunks of this many pages, extracted concurrently
+PDF_PAGES_PER_CHUNK = int(os.getenv("PDF_PAGES_PER_CHUNK", "2"))
+PDF_EXTRACTION_CONCURRENCY = int(os.getenv("PDF_EXTRACTION_CONCURRENCY", "4"))
+
+# Pages whose embedded text layer passes these checks skip Gemini. Only
+# callers that pass allow_text_layer=True (teacher-uploaded quiz PDFs) use it;
+# student answer sheets may carry handwriting the text layer does not see
+PDF_TEXT_LAYER_ENABLED = os.getenv("PDF_TEXT_LAYER_ENABLED", "1") == "1"
+# Non-whitespace characters per square inch of page; a full typed A4 page
+# has roughly 30, so sparse pages (mostly drawn content) go to Gemini
+PDF_TEXT_LAYER_MIN_DENSITY = float(os.getenv("PDF_TEXT_LAYER_MIN_DENSITY", "15"))
+# Pages drawing more path segments than this (flattened handwriting,
+# diagrams) go to Gemini; ruled lines and table borders stay well below it
+PDF_TEXT_LAYER_MAX_PATH_OPS = int(os.getenv("PDF_TEXT_LAYER_MAX_PATH_OPS", "150"))
+# Share of characters that are control, private-use or replacement characters
+PDF_TEXT_LAYER_MAX_GARBAGE_RATIO = float(os.getenv("PDF_TEXT_LAYER_MAX_GARBAGE_RATIO", "0.05"))
+
+# Extracted text keyed by the SHA-256 of the PDF bytes (whole files) or of
+# the page hashes in a chunk, so an edited page only re-extracts its chunk
+pdf_text_cache = PersistentCache(
+    "pdf_text",
+    max_entries=int(os.getenv("PDF_TEXT_CACHE_MAX_ENTRIES", "256")),
+    ttl_seconds=int(os.getenv("PDF_TEXT_CACHE_TTL_SECONDS", str(90 * 24 * 3600)))
+)
+
+# Which path extracted pages took, to measure what the text layer saves
+pdf_extraction_stats = {"textLayerPages": 0, "llmPages": 0, "cachedPages": 0, "llmSeconds": 0.0, "textLayerSeconds": 0.0}
+_pdf_extraction_stats_lock = threading.Lock()
+
+def record_pdf_page_paths(page_timings):
+    with _pdf_extraction_stats_lock:
+        for timing in page_timings:
+            if timing["path"] == "text_layer":
+                pdf_extraction_stats["textLayerPages"] += 1
+                pdf_extraction_stats["textLayerSeconds"] += timing["seconds"]
+            elif timing["path"] == "llm":
+                pdf_extraction_stats["llmPages"] += 1
+                pdf_extraction_stats["llmSeconds"] += timing["seconds"]
+            else:
+                pdf_extraction_stats["cachedPages"] += 1
+
+def get_pdf_extraction_stats():
+    """Page counts per path, with the Gemini time the text layer saved (estimated from the average LLM page)"""
+    with _pdf_extraction_stats_lock:
+        stats = dict(pdf_extraction_stats)
+    avg_llm_page = stats["llmSeconds"] / stats["llmPages"] if stats["llmPages"] else 0
+    stats["avgLlmPageSeconds"] = round(avg_llm_page, 3)
+    stats["estimatedSecondsSaved"] = round(avg_llm_page * stats["textLayerPages"] - stats["textLayerSeconds"], 3)
+    stats["llmSeconds"] = round(stats["llmSeconds"], 3)
+    stats["textLayerSeconds"] = round(stats["textLayerSeconds"], 3)
+    return stats
+
+def page_has_images(page):
+    """True if the page draws image XObjects or carries ink annotations (scans, handwriting)"""
+    try:
+        resources = page.get("/Resources")
+        resources = resources.get_object() if resources is not None else {}
+        xobjects = resources.get("/XObject")
+        if xobjects is not None:
+            for xobject in xobjects.get_object().values():
+                if xobject.get_object().get("/Subtype") == "/Image":
+                    return True
+        annotations = page.get("/Annots")
+        if annotations is not None:
+            for annotation in annotations.get_object():
+                if annotation.get_object().get("/Subtype") == "/Ink":
+                    return True
+        return False
+    except Exception:
+        # Unknown structure: let Gemini look at it
+        return True
+
+# Content stream operators that build path segments
+PDF_PATH_OPERATORS = {b"m", b"l", b"c", b"v", b"y", b"re"}
+
+def count_path_operations(page):
+    """Path segments the page draws, including inside its form XObjects"""
+    from PyPDF2.generic import ContentStream
+    
+    streams = []
+    contents = page.get_contents()
+    if contents is not None:
+        streams.append(contents)
+    resources = page.get("/Resources")
+    resources = resources.get_object() if resources is not None else {}
+    xobjects = resources.get("/XObject")
+    if xobjects is not None:
+        for xobject in xobjects.get_object().values():
+            xobject = xobject.get_object()
+            if xobject.get("/Subtype") == "/Form":
+                streams.append(ContentStream(xobject, page.pdf))
+    return sum(
+        1 for stream in streams for _, operator in stream.operations
+        if operator in PDF_PATH_OPERATORS
+    )
+
+def page_has_drawn_content(page):
+    """True if the page draws images, ink annotations or substantial vector paths"""
+    if page_has_images(page):
+        return True
+    try:
+        return count_path_operations(page) > PDF_TEXT_LAYER_MAX_PATH_OPS
+    except Exception:
+        # Unparseable content stream: let Gemini look at it
+        return True
+
+def text_layer_quality(text, page_area_sq_in):
+    """
+    Judge whether an embedded text layer can stand in for LLM extraction.
+    
+    Returns:
+        tuple: (usable, {"density", "garbageRatio"})
+    """
+    visible = [char for char in text if not char.isspace()]
+    if not visible:
+        return False, {"density": 0, "garbageRatio": 0}
+    garbage = sum(
+        1 for char in visible
+        if char == "\ufffd" or unicodedata.category(char) in ("Cc", "Co", "Cn", "Cs")
+    )
+    density = len(visible) / page_area_sq_in if page_area_sq_in else 0
+    garbage_ratio = garbage / len(visible)
+    metrics = {"density": round(density, 2), "garbageRatio": round(garbage_ratio, 3)}
+    return density >= PDF_TEXT_LAYER_MIN_DENSITY and garbage_ratio <= PDF_TEXT_LAYER_MAX_GARBAGE_RATIO, metrics
+
+def split_pdf_pages(pdf_bytes, allow_text_layer=False):
     """
-    Extract text from PDF using Google's Gemini 1.5.
+    Split a PDF into single-page PDFs and, with allow_text_layer, read each
+    page's text layer.
+    
+    Returns:
+        list: {"hash", "pdf", "text"} per page in page order, where "text" is
+        the usable text layer or None; None if the file cannot be parsed (it
+        is then sent to Gemini whole)
+    """
+    from PyPDF2 import PdfReader, PdfWriter
+    
+    try:
+        reader = PdfReader(BytesIO(pdf_bytes))
+        pages = []
+        for page in reader.pages:
+            writer = PdfWriter()
+            writer.add_page(page)
+            buffer = BytesIO()
+            writer.write(buffer)
+            page_bytes = buffer.getvalue()
+            
+            text = None
+            if allow_text_layer and PDF_TEXT_LAYER_ENABLED and not page_has_drawn_content(page):
+                try:
+                    candidate = page.extract_text() or ""
+                    box = page.mediabox
+                    usable, _ = text_layer_quality(candidate, float(box.width) * float(box.height) / (72 * 72))
+                    text = candidate if usable else None
+                except Exception as e:
+                    print(f"Could not read text layer: {str(e)}")
+            
+            pages.append({"hash": sha256_hex(page_bytes), "pdf": page_bytes, "text": text})
+        return pages
+    except Exception as e:
+        print(f"Could not split PDF into pages: {str(e)}")
+        return None
+
+def merge_pdf_pages(page_pdfs):
+    """Combine single-page PDFs (in order) into one PDF"""
+    from PyPDF2 import PdfReader, PdfWriter
+    
+    writer = PdfWriter()
+    for page_bytes in page_pdfs:
+        writer.add_page(PdfReader(BytesIO(page_bytes)).pages[0])
+    buffer = BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+def extract_pdf_chunk(chunk_pdf, cache_key):
+    """Send one PDF (or page range) to Gemini and cache the text"""
+    cached_text = pdf_text_cache.get(cache_key)
+    if cached_text is not None:
+        return cached_text, True
+    
+    contents = [
+        {"mime_type": "application/pdf", "data": chunk_pdf},
+        PDF_EXTRACTION_PROMPT
+    ]
+    response = gemini_client.generate_content("extract_pdf_text", contents, model_name=PDF_EXTRACTION_MODEL)
+    text = response.text if response and response.text else ""
+    if text:
+        pdf_text_cache.put(cache_key, text)
+    return text, False
+
+def extract_text_from_pdf(pdf_bytes, report=None, allow_text_layer=False):
+    """
+    Extract text from PDF using Google's gemini-2.0-flash (PDF_EXTRACTION_MODEL).
     This function sends the PDF directly to the Gemini model for text extraction,
     works with both typed and handwritten content.
+    
+    With allow_text_layer (typed teacher PDFs only), pages whose embedded
+    text layer passes text_layer_quality() and that draw no images or
+    substantial vector paths are read locally with PyPDF2. The remaining pages
+    are grouped into runs of at most PDF_PAGES_PER_CHUNK consecutive pages
+    that are extracted concurrently (at most PDF_EXTRACTION_CONCURRENCY at a
+    time); everything is reassembled in page order. Results are cached for
+    the whole file and per chunk (keyed by its page hashes), so a re-upload
+    that changes one page only re-extracts that page's chunk.
+    
+    Args:
+        pdf_bytes (bytes): The PDF file
+        allow_text_layer (bool): Let typed pages skip Gemini. Off for student
+            answer sheets, whose handwriting the text layer can miss
+        report (dict, optional): Filled with the page count, total seconds and
+            per-page timings ({"page", "seconds", "path"}, path being
+            "text_layer", "llm" or "cache")
     """
+    started = time.monotonic()
+    file_key = f"{sha256_hex(pdf_bytes)}:{PDF_EXTRACTION_MODEL}:{PDF_EXTRACTION_PROMPT_VERSION}"
+    if allow_text_layer:
+        # Text-layer results must not be served to callers that want Gemini for every page
+        file_key += ":text_layer"
+    cached_text = pdf_text_cache.get(file_key)
+    if cached_text is not None:
+        print(f"Using cached text extraction ({len(cached_text)} characters)")
+        if report is not None:
+            report.update({"pages": None, "seconds": round(time.monotonic() - started, 3), "cached": True, "pageTimings": []})
+        return cached_text
+    
     try:
-        import tempfile
-        import pathlib
-        
-        # Create a temporary file to save the PDF
-        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=True) as temp_file:
-            temp_file.write(pdf_bytes)
-            temp_file.flush()
-            
-            filepath = pathlib.Path(temp_file.name)
-            
-            print(f"Processing PDF using Gemini 1.5")
-            prompt = "Extract all text from this document. Preserve structure and formatting as much as possible."
-            
-            # Send to Gemini 1.5 for processing
-            # Initialize a Gemini-1.5 model
-            model = genai.GenerativeModel('gemini-2.0-flash')
-            
-            # Read the PDF file
-            pdf_data = filepath.read_bytes()
-            
-            # Create contents array with PDF data and prompt
-            contents = [
-                {"mime_type": "application/pdf", "data": pdf_data},
-                prompt
-            ]
-            
-            # Generate content
-            response = model.generate_content(contents)
-            
-            # Check if we got a valid response
-            if response and response.text:
-                print(f"Successfully extracted {len(response.text)} characters using Gemini 1.5")
-                return response.text
-            else:
-                print("Gemini extraction returned empty text.")
-                return "No text was extracted from the PDF."
+        pages = split_pdf_pages(pdf_bytes, allow_text_layer=allow_text_layer)
+        page_texts = {}
+        page_timings = {}
+        if pages is None:
+            # Unparseable locally; let Gemini read the file as a whole
+            pages = [{"hash": sha256_hex(pdf_bytes), "pdf": pdf_bytes, "text": None}]
+            chunks = [([0], pdf_bytes)]
+        else:
+            local_seconds = (time.monotonic() - started) / len(pages) if pages else 0
+            chunks = []
+            run = []
+            for i, page in enumerate(pages):
+                if page["text"] is not None:
+                    page_texts[i] = page["text"]
+                    page_timings[i] = {"page": i + 1, "seconds": round(local_seconds, 3), "path": "text_layer"}
+                else:
+                    run.append(i)
+                # Chunks are runs of consecutive pages that need Gemini
+                run_ends = page["text"] is not None or len(run) == PDF_PAGES_PER_CHUNK or i == len(pages) - 1
+                if run and run_ends:
+                    chunk_pdf = pdf_bytes if len(run) == len(pages) else merge_pdf_pages([pages[j]["pdf"] for j in run])
+                    chunks.append((run, chunk_pdf))
+                    run = []
+        
+        print(f"Processing PDF using {PDF_EXTRACTION_MODEL} ({len(pages)} pages, {len(page_texts)} from the text layer, "
+              f"{len(chunks)} chunks for Gemini)")
+        
+        def run_chunk(indexes, chunk_pdf):
+            chunk_started = time.monotonic()
+            chunk_key = sha256_hex(":".join(pages[i]["hash"] for i in indexes))
+            text, cached = extract_pdf_chunk(chunk_pdf, f"pages:{chunk_key}:{PDF_EXTRACTION_MODEL}:{PDF_EXTRACTION_PROMPT_VERSION}")
+            return text, cached, time.monotonic() - chunk_started
+        
+        if chunks:
+            pool_size = max(1, min(PDF_EXTRACTION_CONCURRENCY, len(chunks)))
+            with ThreadPoolExecutor(max_workers=pool_size) as executor:
+                futures = [executor.submit(run_chunk, indexes, chunk_pdf) for indexes, chunk_pdf in chunks]
+                # Any failed chunk fails the extraction; finished chunks stay cached for the retry
+                results = [future.result() for future in futures]
+        else:
+            results = []
+        
+        # A chunk's text is placed at its first page; its time is shared by its pages
+        for (indexes, _), (text, cached, seconds) in zip(chunks, results):
+            page_texts[indexes[0]] = text
+            for i in indexes:
+                page_timings[i] = {"page": i + 1, "seconds": round(seconds / len(indexes), 3), "path": "cache" if cached else "llm"}
+        page_timings = [page_timings[i] for i in sorted(page_timings)]
+        record_pdf_page_paths(page_timings)
+        
+        extracted_text = "\n\n".join(
+            page_texts[i].strip() for i in sorted(page_texts) if page_texts[i] and page_texts[i].strip()
+        )
+        total_seconds = round(time.monotonic() - started, 3)
+        print("PDF page timings: " + ", ".join(
+            f"p{timing['page']}={timing['seconds']}s ({timing['path']})" for timing in page_timings
+        ))
+        if report is not None:
+            report.update({"pages": len(pages), "seconds": total_seconds, "cached": False, "pageTimings": page_timings})
+        
+        if extracted_text:
+            print(f"Successfully extracted {len(extracted_text)} characters in {total_seconds}s")
+            pdf_text_cache.put(file_key, extracted_text)
+            return extracted_text
+        else:
+            print("Gemini extraction returned empty text.")
+            return "No text was extracted from the PDF."
                 
     except Exception as e:
+        # Raise instead of returning the error text, so callers never store
+        # it as the extracted text (background jobs retry on this)
         print(f"Error extracting text from PDF with Gemini: {str(e)}")
-        return f"Error extracting text from PDF: {str(e)}"
-
-def segregate_questions_by_number(extracted_text, is_question_paper=True):
+        raise
+
+# Bump when either segregation prompt changes
+SEGREGATION_PROMPT_VERSION = "1"
+
+# Segregated questions/answers keyed by (sha256(text), is_question_paper, prompt version)
+segregation_cache = PersistentCache(
+    "segregation",
+    max_entries=int(os.getenv("SEGREGATION_CACHE_MAX_ENTRIES", "512")),
+    ttl_seconds=int(os.getenv("SEGREGATION_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+)
+
+# Local rule-based segmentation is trusted at or above this confidence
+SEGREGATION_LOCAL_MIN_CONFIDENCE = float(os.getenv("SEGREGATION_LOCAL_MIN_CONFIDENCE", "0.8"))
+
+# How each segregation was answered: local rules, cache, LLM or the single-section fallback
+segregation_paths = {"local": 0, "cache": 0, "llm": 0, "fallback": 0}
+_segregation_paths_lock = threading.Lock()
+
+def record_segregation_path(path):
+    with _segregation_paths_lock:
+        segregation_paths[path] += 1
+
+# "1.", "1)", "Q2", "Q.2:", "Question 3", "Ans 4", "5(a)", "6b." at the start of a line.
+# The label is either prefixed (Q/Question/Ans) or followed by a delimiter, or stands alone on its line.
+QUESTION_HEADER_PATTERN = re.compile(
+    r"^\s*(?P<prefix>(?:q(?:uestion|ues)?|ans(?:wer)?)\s*(?:no\.?|number)?\s*[.:#-]?\s*)?"
+    r"(?P<number>\d{1,3})\s*"
+    r"(?:\(\s*(?P<paren_part>[a-h]|[ivx]{1,4})\s*\)|(?P<part>[a-h])(?![a-z]))?"
+    r"\s*(?P<delimiter>[.):\-])?"
+    r"(?:\s+(?P<rest>.*))?$",
+    re.IGNORECASE
+)
+
+def segment_questions_locally(extracted_text, is_question_paper=True, max_question=None):
+    """
+    Split text on question numbering without an LLM.
+    
+    Headers must share one style (prefix word and delimiter, e.g. all "Q1:"
+    or all "1.") and increase monotonically; a repeated number with a
+    sub-part label (1a, 1(b)) stays inside its question, and lower numbers
+    and numbers above max_question (when the question count is known) are
+    kept as body text. When prefixed labels ("Q1", "Question 2") appear,
+    only those count. A number that repeats an accepted header means a
+    numbered list is posing as questions, so the text is left to the LLM.
+    
+    Returns:
+        tuple: (sections in the same shape as the LLM result, confidence 0-1)
+    """
+    lines = extracted_text.splitlines()
+    candidates = []
+    for index, line in enumerate(lines):
+        match = QUESTION_HEADER_PATTERN.match(line)
+        if not match:
+            continue
+        rest = (match.group("rest") or "").strip()
+        sub_part = match.group("paren_part") or match.group("part")
+        # A bare number needs a delimiter or a line of its own ("2 apples" is not a header)
+        if not match.group("prefix") and not match.group("delimiter") and not sub_part and rest:
+            continue
+        prefix_word = re.sub(r"[^a-z]", "", (match.group("prefix") or "").lower())
+        candidates.append({
+            "line": index,
+            "number": int(match.group("number")),
+            "sub_part": sub_part,
+            "prefixed": bool(match.group("prefix")),
+            "style": (prefix_word, match.group("delimiter") or ""),
+            "text": rest
+        })
+    
+    if sum(1 for candidate in candidates if candidate["prefixed"]) >= 2:
+        candidates = [candidate for candidate in candidates if candidate["prefixed"]]
+    
+    rejected = 0
+    styles = Counter(candidate["style"] for candidate in candidates if not candidate["sub_part"])
+    if styles:
+        # Only the most common header style counts; other labels are body text.
+        # Sub-part labels (1(a), 2b) rarely carry the delimiter, so they don't vote
+        style = styles.most_common(1)[0][0]
+        matching = [
+            candidate for candidate in candidates
+            if candidate["sub_part"] or candidate["style"] == style
+        ]
+        rejected = len(candidates) - len(matching)
+        candidates = matching
+    
+    headers = []
+    accepted = set()
+    for candidate in candidates:
+        number = candidate["number"]
+        last = headers[-1]["number"] if headers else 0
+        if candidate["sub_part"] and number == last:
+            continue
+        if number in accepted:
+            # "1. ... 2. ..." inside an answer shadows the real question headers
+            return {"0": extracted_text}, 0.0
+        if number > last and (headers or number <= 3) and (max_question is None or number <= max_question):
+            headers.append(candidate)
+            accepted.add(number)
+        else:
+            # Out-of-sequence label: body text, but a sign the layout is ambiguous
+            rejected += 1
+    
+    if len(headers) < 2:
+        return {"0": extracted_text}, 0.0
+    
+    sections = {}
+    header_lines = {header["line"]: header for header in headers}
+    preamble = "\n".join(lines[:headers[0]["line"]]).strip()
+    current = None
+    body = []
+    for index in range(headers[0]["line"], len(lines)):
+        if index in header_lines:
+            if current is not None:
+                sections[str(current)] = "\n".join(body).strip()
+            header = header_lines[index]
+            current = header["number"]
+            body = [header["text"]] if header["text"] else []
+        else:
+            body.append(lines[index])
+    sections[str(current)] = "\n".join(body).strip()
+    
+    numbers = [header["number"] for header in headers]
+    # Skipped numbers (unanswered questions are normal on answer scripts, so they cost less there)
+    gaps = (numbers[-1] - numbers[0] + 1 - len(numbers)) + (numbers[0] - 1)
+    gap_penalty = gaps / numbers[-1] * (0.5 if not is_question_paper else 1.0)
+    ambiguity_penalty = rejected / (len(headers) + rejected)
+    empty_penalty = sum(1 for text in sections.values() if not text) / len(sections)
+    numbered_chars = sum(len(text) for text in sections.values())
+    preamble_penalty = max(0.0, len(preamble) / (len(preamble) + numbered_chars) - 0.3) if numbered_chars else 1.0
+    confidence = max(0.0, 1.0 - gap_penalty - ambiguity_penalty - empty_penalty - preamble_penalty)
+    
+    result = {}
+    if preamble:
+        result["0"] = "preamble" if is_question_paper else "notes"
+    result.update(sections)
+    return result, round(confidence, 3)
+
+def segregate_questions_by_number(extracted_text, is_question_paper=True, max_question=None):
     """
     Use Gemini to segregate questions by number from extracted text.
     For question papers or solution scripts, this identifies individual questions
     and returns them in a structured format.
     
+    Well-formatted text is split locally by segment_questions_locally();
+    Gemini is only asked when the local confidence is below
+    SEGREGATION_LOCAL_MIN_CONFIDENCE. Identical text is only sent to Gemini
+    once; later calls are served from segregation_cache.
+    
     Args:
         extracted_text (str): The text extracted from the PDF
         is_question_paper (bool): Whether this is a question paper or a student answer
+        max_question (int, optional): Highest question number, when the question paper is known
     
     Returns:
         dict: A dictionary where keys are question numbers and values are the text of each question
     """
+    local_result, confidence = segment_questions_locally(extracted_text, is_question_paper, max_question)
+    if confidence >= SEGREGATION_LOCAL_MIN_CONFIDENCE:
+        print(f"Segregated locally into {len(local_result)} sections (confidence {confidence})")
+        record_segregation_path("local")
+        return local_result
+    print(f"Local segregation confidence {confidence} too low, using Gemini")
+    
+    cache_key = f"{sha256_hex(extracted_text)}:{'questions' if is_question_paper else 'answers'}:{SEGREGATION_PROMPT_VERSION}"
+    cached_result = segregation_cache.get(cache_key)
+    if cached_result is not None:
+        print(f"Using cached segregation ({len(cached_result)} sections)")
+        record_segregation_path("cache")
+        return dict(cached_result)
+    
     try:
         print(f"Segregating {'questions' if is_question_paper else 'answers'} by number...")
         
@@ -2834,18 +4507,16 @@ def segregate_questions_by_number(extracted_text, is_question_paper=True):
             
         prompt += extracted_text
         
-        # Initialize Gemini model
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        
         # Call Gemini with the prompt
-        response = model.generate_content(
+        response = gemini_client.generate_content(
+            "segregate",
             prompt,
-            generation_config=genai.GenerationConfig(
-                temperature=0.0,
-                top_p=0.95,
-                top_k=0,
-                max_output_tokens=8192,
-            )
+            generation_config={
+                "temperature": 0.0,
+                "top_p": 0.95,
+                "top_k": 0,
+                "max_output_tokens": 8192,
+            }
         )
         
         # Extract JSON from response
@@ -2871,11 +4542,14 @@ def segregate_questions_by_number(extracted_text, is_question_paper=True):
                 else:
                     print(f"Content: {q_text}")
         
-        return result
+        segregation_cache.put(cache_key, result)
+        record_segregation_path("llm")
+        return dict(result)
         
     except Exception as e:
         print(f"Error segregating questions: {str(e)}")
         traceback.print_exc()
+        record_segregation_path("fallback")
         # Return the original text as a single item if segregation fails
         return {"0": extracted_text}
 
@@ -2917,7 +4591,8 @@ def map_answers_to_questions(extracted_texts, questions):
     
     try:
         app.logger.info("Calling Gemini API to map answers to questions")
-        response = gemini_model.generate_content(
+        response = gemini_client.generate_content(
+            "map_answers",
             contents=[{"role": "user", "parts": [{"text": prompt}]}],
             generation_config=generation_config
         )
@@ -2970,8 +4645,22 @@ def map_answers_to_questions(extracted_texts, questions):
             app.logger.error(f"Fallback approach also failed: {str(fallback_error)}")
             return []
 
-def grade_answer(question, student_answer, model_answer, max_score):
-    """Grade a single answer using Gemini"""
+# Bump when a grading prompt changes so old grades are not reused
+GRADING_PROMPT_VERSION = "1"
+
+# LLM grading results keyed by a hash of the prompt inputs
+grading_cache = PersistentCache(
+    "grading",
+    max_entries=int(os.getenv("GRADING_CACHE_MAX_ENTRIES", "2048")),
+    ttl_seconds=int(os.getenv("GRADING_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+)
+
+def grading_cache_key(template, *inputs):
+    """Hash a grading prompt template name and its inputs into a cache key"""
+    return sha256_hex(json.dumps([template, GRADING_PROMPT_VERSION] + [str(value) for value in inputs]))
+
+def grade_answer(question, student_answer, model_answer, max_score, use_cache=True):
+    """Grade a single answer using Gemini (use_cache=False forces a fresh grade)"""
     app.logger.info(f"Grading answer for question: {question[:50]}...")
     
     # Limit the size of text to prevent API issues
@@ -2983,6 +4672,13 @@ def grade_answer(question, student_answer, model_answer, max_score):
         app.logger.warning(f"Model answer is very large ({len(model_answer)} chars), truncating to 5000 chars")
         model_answer = model_answer[:5000] + "... [truncated due to length]"
     
+    cache_key = grading_cache_key("answer", question, model_answer, student_answer, max_score)
+    if use_cache:
+        cached_result = grading_cache.get(cache_key)
+        if cached_result is not None:
+            app.logger.info("Using cached grading result")
+            return dict(cached_result)
+    
     prompt = f"""
     You are an expert exam grader. Grade the following student answer:
     
@@ -3009,7 +4705,8 @@ def grade_answer(question, student_answer, model_answer, max_score):
     
     try:
         app.logger.info("Calling Gemini API to grade answer")
-        response = gemini_model.generate_content(
+        response = gemini_client.generate_content(
+            "grade_answer",
             contents=[{"role": "user", "parts": [{"text": prompt}]}],
             generation_config=generation_config
         )
@@ -3026,7 +4723,8 @@ def grade_answer(question, student_answer, model_answer, max_score):
         result = json.loads(response_text)
         # Ensure the score is a number within the allowed range
         result["score"] = max(0, min(float(result["score"]), max_score))
-        return result
+        grading_cache.put(cache_key, result)
+        return dict(result)
         
     except Exception as e:
         app.logger.error(f"Error grading answer: {str(e)}")
@@ -3047,7 +4745,8 @@ def grade_answer(question, student_answer, model_answer, max_score):
             JSON ONLY.
             """
             
-            response = gemini_model.generate_content(
+            response = gemini_client.generate_content(
+                "grade_answer_fallback",
                 contents=[{"role": "user", "parts": [{"text": fallback_prompt}]}]
             )
             
@@ -3071,11 +4770,13 @@ def grade_answer(question, student_answer, model_answer, max_score):
                 "key_points_missed": []
             }
 
-def grade_all_answers(mapped_answers, quiz_questions, model_answers):
-    """Grade all answers for a quiz"""
+def grade_all_answers(mapped_answers, quiz_questions, model_answers, use_cache=True, on_answer_graded=None):
+    """Grade all answers for a quiz; on_answer_graded(graded, total, result) reports each one"""
     graded_answers = []
     total_score = 0
     max_total = 0
+    question_ids = {str(q["id"]) for q in quiz_questions}
+    gradable = sum(1 for answer in mapped_answers if answer["question_id"] in question_ids)
     
     for answer in mapped_answers:
         question_id = answer["question_id"]
@@ -3094,7 +4795,7 @@ def grade_all_answers(mapped_answers, quiz_questions, model_answers):
         model_answer = next((m["answer"] for m in model_answers if str(m["question_id"]) == question_id), "")
         
         # Grade the answer
-        grading_result = grade_answer(question_text, student_answer, model_answer, max_score)
+        grading_result = grade_answer(question_text, student_answer, model_answer, max_score, use_cache=use_cache)
         
         # Add question text to result for frontend display
         grading_result["question_text"] = question_text
@@ -3103,6 +4804,8 @@ def grade_all_answers(mapped_answers, quiz_questions, model_answers):
         
         graded_answers.append(grading_result)
         total_score += grading_result["score"]
+        if on_answer_graded:
+            on_answer_graded(len(graded_answers), gradable, grading_result)
     
     return {
         "graded_answers": graded_answers,
@@ -3120,6 +4823,8 @@ def advanced_pdf_grading():
         classroom_id = data.get("classId")
         quiz_id = data.get("quizId")
         student_id = data.get("studentId")
+        # Teachers can ask for a fresh grade instead of cached results
+        bypass_cache = bool(data.get("bypassCache", False))
         
         app.logger.info(f"Advanced PDF grading request: Class: {classroom_id}, Quiz: {quiz_id}, Student: {student_id}")
         
@@ -3133,7 +4838,7 @@ def advanced_pdf_grading():
             return jsonify({"error": "No submission found for this student"}), 404
         
         # Check if we already have advanced grading results to avoid reprocessing
-        if submission.get("advanced_grading") and submission.get("advanced_grading_status") == "completed":
+        if not bypass_cache and submission.get("advanced_grading") and submission.get("advanced_grading_status") == "completed":
             app.logger.info(f"Returning cached advanced grading results for submission")
             return jsonify({
                 "message": "Retrieved cached advanced grading results",
@@ -3164,13 +4869,28 @@ def advanced_pdf_grading():
         
         app.logger.info(f"Starting OCR processing for PDF with {len(quiz_questions)} questions")
         
+        # Progress for the teacher's /api/events/stream
+        teacher_id = get_jwt_identity()
+        progress = {"scope": "advanced_grading", "classroomId": classroom_id, "quizId": quiz_id, "studentId": student_id}
+        
+        def on_answer_graded(graded, total, result):
+            publish_progress([teacher_id], "question_graded", dict(
+                progress, questionId=result.get("question_id"), graded=graded, total=total,
+                score=result.get("score", 0),
+                message=f"Question {graded}/{total} graded"
+            ))
+        
         # Step 1: Process PDF and extract text using OCR
         extracted_texts = extract_text_from_pdf(pdf_bytes)
         if not extracted_texts:
             submission["advanced_grading_status"] = "failed"
             submission["advanced_grading_error"] = "Failed to extract text from PDF"
             update_submission(classroom_id, quiz_id, student_id, submission)
+            publish_progress([teacher_id], "failed", dict(progress, error="Failed to extract text from PDF"))
             return jsonify({"error": "Failed to extract text from PDF"}), 500
+        publish_progress([teacher_id], "extracted", dict(
+            progress, characters=len(extracted_texts), message="Text extracted from PDF"
+        ))
             
         app.logger.info(f"Successfully extracted text from {len(extracted_texts)} PDF pages")
         
@@ -3180,12 +4900,19 @@ def advanced_pdf_grading():
             submission["advanced_grading_status"] = "failed"
             submission["advanced_grading_error"] = "Failed to map answers to questions"
             update_submission(classroom_id, quiz_id, student_id, submission)
+            publish_progress([teacher_id], "failed", dict(progress, error="Failed to map answers to questions"))
             return jsonify({"error": "Failed to map answers to questions"}), 500
             
         app.logger.info(f"Successfully mapped answers to {len(mapped_answers)} questions")
+        publish_progress([teacher_id], "segregated", dict(
+            progress, answerCount=len(mapped_answers), message=f"Answers mapped to {len(mapped_answers)} questions"
+        ))
         
         # Step 3: Grade each answer
-        grading_results = grade_all_answers(mapped_answers, quiz_questions, model_answers)
+        grading_results = grade_all_answers(
+            mapped_answers, quiz_questions, model_answers,
+            use_cache=not bypass_cache, on_answer_graded=on_answer_graded
+        )
         
         # Step 4: Save results to submission
         submission["advanced_grading"] = grading_results
@@ -3198,6 +4925,10 @@ def advanced_pdf_grading():
             return jsonify({"error": "Failed to update submission"}), 500
             
         app.logger.info(f"Advanced grading completed successfully with score: {grading_results['total_score']}/{grading_results['max_total']}")
+        publish_progress([teacher_id], "graded", dict(
+            progress, score=grading_results["total_score"], maxScore=grading_results["max_total"],
+            percentage=grading_results["percentage"]
+        ))
         
         return jsonify({
             "message": "Advanced grading completed successfully",
@@ -3214,6 +4945,8 @@ def advanced_pdf_grading():
                 submission["advanced_grading_status"] = "failed"
                 submission["advanced_grading_error"] = str(e)
                 update_submission(classroom_id, quiz_id, student_id, submission)
+            if 'progress' in locals():
+                publish_progress([teacher_id], "failed", dict(progress, error=str(e)))
         except:
             pass
             
@@ -3234,15 +4967,14 @@ def set_model_answers():
         if error:
             return jsonify({"error": error}), 401
             
-        quiz = find_quiz_by_id(classroom, quiz_id)
+        quiz = find_quiz_by_id(classroom_id, quiz_id, projection={"_id": 1})
         if not quiz:
             return jsonify({"error": "Quiz not found"}), 404
             
         # Update quiz with model answers
-        result = classrooms_collection.update_one(
-            {"_id": ObjectId(classroom_id)},
-            {"$set": {f"quizzes.$[quiz].model_answers": model_answers}},
-            array_filters=[{"quiz.id": ObjectId(quiz_id)}]
+        result = quizzes_collection.update_one(
+            {"_id": quiz["_id"]},
+            {"$set": {"model_answers": model_answers}}
         )
         
         if result.modified_count == 0:
@@ -3264,156 +4996,103 @@ def convert_quiz_pdf_to_text(classroom_id, quiz_id):
     except Exception as e:
         return jsonify({"error": f"Server error: {str(e)}"}), 500
 
-def process_classroom_quizzes_pdfs(classroom_id):
-    """Process all quizzes in a classroom, converting PDFs to text if needed"""
+@app.route("/api/classrooms/<classroom_id>/process-pdfs", methods=["POST"])
+@jwt_required()
+def process_classroom_pdfs_endpoint(classroom_id):
+    """
+    Start background text extraction for every quiz in the classroom
+    (see process_classroom_pdfs_job). A batch that is already queued or
+    running is returned instead of starting another one.
+    """
+    user_id = get_jwt_identity()
     try:
-        # Find the classroom
-        classroom = classrooms_collection.find_one({"_id": ObjectId(classroom_id)})
-        if not classroom:
-            print(f"Classroom not found: {classroom_id}")
-            return {"success": False, "message": "Classroom not found"}
-        
-        print(f"\n===== PROCESSING ALL QUIZZES IN CLASSROOM: {classroom.get('name', 'Unknown')} =====")
-        
-        # Check if classroom has quizzes
-        if not classroom.get("quizzes"):
-            print("No quizzes found in classroom")
-            return {"success": True, "processed": 0, "already_processed": 0, "errors": 0, "message": "No quizzes found in classroom"}
+        # Check teacher access
+        classroom, user, error = get_classroom_and_validate_access(classroom_id, user_id, "teacher")
+        if error:
+            return error
         
-        processed_count = 0
-        already_processed_count = 0
-        error_count = 0
+        active_job = jobs_collection.find_one(
+            {"type": "process_classroom_pdfs", "classroom_id": ObjectId(classroom_id), "status": {"$in": ["queued", "running"]}},
+            {"_id": 1}
+        )
+        if active_job:
+            job_id = active_job["_id"]
+            msg = "PDF processing is already running for this classroom"
+        else:
+            job_id = enqueue_job("process_classroom_pdfs", {}, user_id=user_id, classroom_id=classroom_id)
+            msg = "PDF processing started in the background"
         
-        # Iterate through quizzes
-        for quiz in classroom["quizzes"]:
-            quiz_id = str(quiz["id"])
-            title = quiz.get("title", "Untitled Quiz")
-            print(f"\nProcessing quiz: {title} (ID: {quiz_id})")
-            
-            # Skip if already processed
-            if quiz.get("extractedText"):
-                print(f"Quiz already has extracted text (processed on {quiz['extractedText'].get('timestamp', 'unknown date')})")
-                already_processed_count += 1
-                continue
+        return jsonify({
+            "msg": msg,
+            "jobId": str(job_id),
+            "statusUrl": url_for("get_job_status", job_id=str(job_id)),
+            "progressUrl": url_for("get_classroom_pdfs_progress", classroom_id=classroom_id, job_id=str(job_id))
+        }), 202
             
-            pdf_processed = False
-            # Check for question paper PDF
-            if quiz.get("questionPaper") and "content" in quiz.get("questionPaper", {}):
-                try:
-                    print(f"Found question paper PDF: {quiz['questionPaper'].get('filename', 'unnamed')}")
-                    
-                    # Extract question paper PDF content
-                    pdf_binary = quiz["questionPaper"]["content"]
-                    
-                    # Use the more robust text extraction method
-                    print("Extracting text from question paper PDF...")
-                    question_paper_text = extract_text_from_pdf(pdf_binary)
-                    
-                    # Process answer key PDF if available
-                    answer_key_text = None
-                    if quiz.get("answerKey") and "content" in quiz.get("answerKey", {}):
-                        print(f"\nFound answer key PDF: {quiz['answerKey'].get('filename', 'unnamed')}")
-                        
-                        # Extract answer key PDF content
-                        answer_key_binary = quiz["answerKey"]["content"]
-                        
-                        # Use the more robust text extraction method
-                        print("Extracting text from answer key PDF...")
-                        answer_key_text = extract_text_from_pdf(answer_key_binary)
-                    
-                    # Save extracted text to database
-                    extracted_text = {
-                        "timestamp": datetime.utcnow()
-                    }
-                    
-                    if question_paper_text:
-                        extracted_text["questionPaper"] = [question_paper_text]
-                        
-                    if answer_key_text:
-                        extracted_text["answerKey"] = [answer_key_text]
-                    
-                    # Check if we have any text to save
-                    if "questionPaper" in extracted_text or "answerKey" in extracted_text:
-                        print("\nSaving extracted text to database...")
-                        
-                        result = classrooms_collection.update_one(
-                            {"_id": ObjectId(classroom_id), "quizzes.id": ObjectId(quiz_id)},
-                            {"$set": {"quizzes.$.extractedText": extracted_text}}
-                        )
-                        
-                        if result.modified_count == 1:
-                            print("Text extraction saved to database successfully")
-                            processed_count += 1
-                            pdf_processed = True
-                        else:
-                            print("Warning: Failed to save text extraction to database")
-                            error_count += 1
-                    else:
-                        print("No text was extracted from either PDF")
-                        error_count += 1
-                        
-                except Exception as e:
-                    print(f"Error extracting text from PDF: {str(e)}")
-                    traceback.print_exc()
-                    error_count += 1
-            else:
-                print("No PDF found or PDF content is missing")
-                error_count += 1
-            
-            print(f"Quiz processing {'COMPLETED' if pdf_processed else 'FAILED'}\n")
-        
-        # Print summary
-        print("\n===== PDF TEXT EXTRACTION SUMMARY =====")
-        print(f"Total quizzes processed: {processed_count}")
-        print(f"Total quizzes already processed: {already_processed_count}")
-        print(f"Total quizzes with errors: {error_count}")
-        print("===== PDF TEXT EXTRACTION COMPLETE =====\n")
-        
-        return {
-            "success": True,
-            "processed": processed_count,
-            "already_processed": already_processed_count,
-            "errors": error_count,
-            "message": f"Processed {processed_count} quizzes, {already_processed_count} already had text, {error_count} errors"
-        }
-        
     except Exception as e:
-        print(f"ERROR processing classroom quizzes: {str(e)}")
         traceback.print_exc()
-        return {"success": False, "message": f"Server error: {str(e)}"}
+        return jsonify({"msg": f"Server error: {str(e)}"}), 500
 
-@app.route("/api/classrooms/<classroom_id>/process-pdfs", methods=["POST"])
+def classroom_pdfs_progress_payload(job):
+    """Progress of a classroom PDF batch as returned to the client"""
+    progress = dict(job.get("progress") or {})
+    progress.pop("quizzes", None)
+    return mongo_to_json_serializable({
+        "jobId": job["_id"],
+        "status": job["status"],
+        "progress": progress,
+        "result": job.get("result"),
+        "lastError": job.get("lastError")
+    })
+
+@app.route("/api/classrooms/<classroom_id>/process-pdfs/<job_id>", methods=["GET"])
 @jwt_required()
-def process_classroom_pdfs_endpoint(classroom_id):
-    """Process all PDF quizzes in a classroom to extract and segregate text"""
-    try:
-        # Check teacher access
-        classroom, user, error = get_classroom_and_validate_access(classroom_id, get_jwt_identity(), "teacher")
-        if error:
-            return error
-            
-        # Process all quizzes in classroom
-        result = process_classroom_quizzes_pdfs(classroom_id)
-        
-        # Handle different response formats
-        if isinstance(result, dict):
-            if result.get("success", False):
-                return jsonify({
-                    "msg": "PDF processing completed successfully",
-                    "details": result
-                }), 200
-            else:
-                return jsonify({"msg": result.get("message", "Error processing PDFs")}), 500
-        else:
-            # Old boolean format for backward compatibility
-            if result:
-                return jsonify({"msg": "PDF processing completed successfully"}), 200
+def get_classroom_pdfs_progress(classroom_id, job_id):
+    """
+    Progress of a classroom PDF batch: processed/remaining/errors.
+    With ?stream=1 the progress is pushed as Server-Sent Events until the
+    batch finishes, or for at most PROGRESS_STREAM_MAX_SECONDS, after which
+    EventSource reconnects and picks up the current progress.
+    """
+    classroom, user, error = get_classroom_and_validate_access(classroom_id, get_jwt_identity(), "teacher")
+    if error:
+        return error
+    if not ObjectId.is_valid(job_id):
+        return jsonify({"msg": "Invalid job ID"}), 400
+    
+    job_query = {"_id": ObjectId(job_id), "type": "process_classroom_pdfs", "classroom_id": ObjectId(classroom_id)}
+    job = jobs_collection.find_one(job_query)
+    if not job:
+        return jsonify({"msg": "Job not found"}), 404
+    
+    if request.args.get("stream", "").lower() not in ("1", "true", "yes"):
+        return jsonify(classroom_pdfs_progress_payload(job)), 200
+    
+    def generate():
+        current = job
+        last_update = None
+        deadline = time.monotonic() + PROGRESS_STREAM_MAX_SECONDS
+        yield f"retry: {PROGRESS_STREAM_RETRY_MS}\n\n"
+        while time.monotonic() < deadline:
+            if current is None:
+                yield sse_event("error", {"error": "Job not found"})
+                return
+            if current.get("updatedAt") != last_update:
+                last_update = current.get("updatedAt")
+                yield sse_event("progress", classroom_pdfs_progress_payload(current))
             else:
-                return jsonify({"msg": "Error processing PDFs"}), 500
-            
-    except Exception as e:
-        traceback.print_exc()
-        return jsonify({"msg": f"Server error: {str(e)}"}), 500
+                # Keep proxies from closing an idle stream
+                yield ": keep-alive\n\n"
+            if current["status"] in ("completed", "failed"):
+                yield sse_event("done", classroom_pdfs_progress_payload(current))
+                return
+            time.sleep(CLASSROOM_PDF_PROGRESS_POLL_SECONDS)
+            current = jobs_collection.find_one(job_query)
+    
+    return Response(generate(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
 
 @jwt_required()
 def get_submission_extracted_text(classroom_id, quiz_id, student_id):
@@ -3448,18 +5127,13 @@ def get_submission_extracted_text(classroom_id, quiz_id, student_id):
     
     try:
         # Find the quiz
-        quiz = find_quiz_by_id(classroom, quiz_id)
+        quiz = find_quiz_by_id(classroom_id, quiz_id)
         if not quiz:
             return jsonify({"msg": "Quiz not found"}), 404
         
         # Find student's submission
         student_obj_id = ObjectId(student_id)
-        submission = None
-        
-        for sub in quiz.get("submissions", []):
-            if sub["student_id"] == student_obj_id:
-                submission = sub
-                break
+        submission = find_submission(classroom_id, quiz_id, student_obj_id)
                 
         if not submission:
             return jsonify({"msg": "Submission not found"}), 404
@@ -3525,7 +5199,7 @@ def get_segregated_quiz_questions(classroom_id, quiz_id):
     
     try:
         # Find the quiz
-        quiz = find_quiz_by_id(classroom, quiz_id)
+        quiz = find_quiz_by_id(classroom_id, quiz_id)
         if not quiz:
             return jsonify({"msg": "Quiz not found"}), 404
         
@@ -3582,7 +5256,7 @@ def get_segregated_answer_key(classroom_id, quiz_id):
     
     try:
         # Find the quiz
-        quiz = find_quiz_by_id(classroom, quiz_id)
+        quiz = find_quiz_by_id(classroom_id, quiz_id)
         if not quiz:
             return jsonify({"msg": "Quiz not found"}), 404
         
@@ -3650,18 +5324,13 @@ def get_segregated_student_answers(classroom_id, quiz_id, student_id):
     
     try:
         # Find the quiz
-        quiz = find_quiz_by_id(classroom, quiz_id)
+        quiz = find_quiz_by_id(classroom_id, quiz_id)
         if not quiz:
             return jsonify({"msg": "Quiz not found"}), 404
         
         # Find student's submission
         student_obj_id = ObjectId(student_id)
-        submission = None
-        
-        for sub in quiz.get("submissions", []):
-            if sub["student_id"] == student_obj_id:
-                submission = sub
-                break
+        submission = find_submission(classroom_id, quiz_id, student_obj_id)
                 
         if not submission:
             return jsonify({"msg": "Submission not found"}), 404
@@ -3749,7 +5418,7 @@ def get_segregated_student_answers(classroom_id, quiz_id, student_id):
         print(f"Traceback: {error_traceback}")
         return jsonify({"msg": f"Server error: {str(e)}"}), 500
 
-def grade_student_answer_by_question(student_answer, model_answer, question_number, max_marks=20):
+def grade_student_answer_by_question(student_answer, model_answer, question_number, max_marks=20, use_cache=True):
     """
     Use Gemini to grade a student's answer for a specific question by comparing it to the model answer.
     
@@ -3758,10 +5427,18 @@ def grade_student_answer_by_question(student_answer, model_answer, question_numb
         model_answer (str): The model/correct answer text from the teacher
         question_number (str): The question number being graded
         max_marks (int): Maximum marks for this question (default: 20)
+        use_cache (bool): Reuse a cached grade for identical inputs (False forces a fresh grade)
         
     Returns:
         dict: Grading result with score, feedback, and analysis
     """
+    cache_key = grading_cache_key("by_question", model_answer, student_answer, max_marks)
+    if use_cache:
+        cached_result = grading_cache.get(cache_key)
+        if cached_result is not None:
+            print(f"Using cached grade for question {question_number}: {cached_result['score']}/{max_marks}")
+            return dict(cached_result)
+    
     try:
         print(f"Grading question {question_number} using Gemini...")
         
@@ -3793,14 +5470,16 @@ def grade_student_answer_by_question(student_answer, model_answer, question_numb
         """
         
         # Generate grading using Gemini
-        response = gemini_model.generate_content(
+        response = gemini_client.generate_content(
+            "grade_question",
             contents=[{"role": "user", "parts": [{"text": prompt}]}],
-            generation_config=genai.GenerationConfig(
-                temperature=0.2,
-                top_p=0.95,
-                top_k=40,
-                max_output_tokens=8192,
-            )
+            generation_config={
+                "temperature": 0.2,
+                "top_p": 0.95,
+                "top_k": 40,
+                "max_output_tokens": 8192,
+            },
+            timeout=GRADING_QUESTION_TIMEOUT_SECONDS
         )
         
         # Extract and parse JSON from response
@@ -3818,7 +5497,8 @@ def grade_student_answer_by_question(student_answer, model_answer, question_numb
         result["score"] = max(0, min(max_marks, result["score"]))
         
         print(f"Question {question_number} grading complete: {result['score']}/{max_marks}")
-        return result
+        grading_cache.put(cache_key, result)
+        return dict(result)
         
     except Exception as e:
         print(f"Error grading question {question_number}: {str(e)}")
@@ -3832,11 +5512,23 @@ def grade_student_answer_by_question(student_answer, model_answer, question_numb
             "grading_failed": True
         }
 
-def auto_grade_submission(quiz, submission):
+# Per-question grading calls run concurrently, at most this many at a time
+GRADING_CONCURRENCY = int(os.getenv("GRADING_CONCURRENCY", "4"))
+# Client-side timeout of each grading request, and how long auto_grade_submission
+# waits for a question (from when its call starts) before scoring it as timed out
+GRADING_QUESTION_TIMEOUT_SECONDS = float(os.getenv("GRADING_QUESTION_TIMEOUT_SECONDS", "60"))
+
+def auto_grade_submission(quiz, submission, use_cache=True, on_question_graded=None):
     """
     Automatically grade a student submission using Gemini by comparing segregated 
     answers to the teacher's answer key.
     
+    Answered questions are graded in parallel (GRADING_CONCURRENCY at a time),
+    and results are collected in question order so totals are deterministic.
+    Pass use_cache=False to skip grading_cache and regrade every answer.
+    on_question_graded(graded, total, result) is called as each question's
+    result is collected.
+    
     Args:
         quiz (dict): The quiz object containing answer key
         submission (dict): The student's submission with segregated answers
@@ -3881,53 +5573,98 @@ def auto_grade_submission(quiz, submission):
     
     print(f"Found {len(all_question_numbers)} questions to grade")
     
-    # Grade each question
+    # Work out the grading order up front, skipping the preamble (key "0")
+    # and questions without a model answer
+    ordered_questions = []
     for question_number in sorted(all_question_numbers, key=lambda x: int(x) if x.isdigit() else float('inf')):
-        # Skip if it's the preamble (key "0")
         if question_number == "0":
             continue
             
         model_answer = model_answers.get(question_number, "")
-        student_answer = student_answers.get(question_number, "")
-        
         if not model_answer:
             print(f"Warning: No model answer for question {question_number}")
             continue
-            
-        if not student_answer:
-            print(f"Student did not answer question {question_number}")
-            # Create an empty grading result for unanswered questions
-            grading_result = {
-                "questionNumber": question_number,
-                "score": 0,
-                "maxScore": 20,
-                "feedback": "No answer provided for this question.",
-                "key_points_addressed": [],
-                "key_points_missed": ["All points missed - no answer provided"],
-                "improvement_suggestions": ["Please provide an answer to this question."],
-                "answered": False
-            }
-        else:
-            # Grade this answer using Gemini
-            grading_result = grade_student_answer_by_question(
-                student_answer=student_answer,
-                model_answer=model_answer,
-                question_number=question_number,
-                max_marks=20  # Each question is worth 20 marks
-            )
-            
-            # Add question metadata
-            grading_result["questionNumber"] = question_number
-            grading_result["maxScore"] = 20
-            grading_result["answered"] = True
-            
-            # Update total score
-            total_score += grading_result["score"]
-            
-        # Add to results
-        max_score += 20
-        graded_questions[question_number] = grading_result
-        question_grading_results.append(grading_result)
+        ordered_questions.append((question_number, model_answer, student_answers.get(question_number, "")))
+    
+    # Grade the answered questions concurrently through a bounded pool
+    answered = [(number, model, answer) for number, model, answer in ordered_questions if answer]
+    pool_size = max(1, min(GRADING_CONCURRENCY, len(answered)))
+    executor = ThreadPoolExecutor(max_workers=pool_size)
+    started_at = {}
+    
+    def grade_question(question_number, model_answer, student_answer):
+        started_at[question_number] = time.monotonic()
+        return grade_student_answer_by_question(
+            student_answer=student_answer,
+            model_answer=model_answer,
+            question_number=question_number,
+            max_marks=20,  # Each question is worth 20 marks
+            use_cache=use_cache
+        )
+    
+    futures = {
+        question_number: executor.submit(grade_question, question_number, model_answer, student_answer)
+        for question_number, model_answer, student_answer in answered
+    }
+    
+    def wait_for_grade(question_number):
+        """The question's result, allowing GRADING_QUESTION_TIMEOUT_SECONDS from when its call started"""
+        future = futures[question_number]
+        while True:
+            started = started_at.get(question_number)
+            # Still queued behind other questions: wait for a slot, then time it from its start
+            remaining = GRADING_QUESTION_TIMEOUT_SECONDS if started is None else started + GRADING_QUESTION_TIMEOUT_SECONDS - time.monotonic()
+            try:
+                return future.result(timeout=max(0, remaining))
+            except FuturesTimeoutError:
+                if started is not None:
+                    raise
+    
+    # Collect results in question order
+    try:
+        for question_number, model_answer, student_answer in ordered_questions:
+            if not student_answer:
+                print(f"Student did not answer question {question_number}")
+                # Create an empty grading result for unanswered questions
+                grading_result = {
+                    "questionNumber": question_number,
+                    "score": 0,
+                    "maxScore": 20,
+                    "feedback": "No answer provided for this question.",
+                    "key_points_addressed": [],
+                    "key_points_missed": ["All points missed - no answer provided"],
+                    "improvement_suggestions": ["Please provide an answer to this question."],
+                    "answered": False
+                }
+            else:
+                try:
+                    grading_result = wait_for_grade(question_number)
+                except FuturesTimeoutError:
+                    print(f"Grading question {question_number} timed out")
+                    grading_result = {
+                        "score": 0,
+                        "feedback": "Automated grading timed out for this question.",
+                        "error": "timeout",
+                        "grading_failed": True
+                    }
+                
+                # Add question metadata
+                grading_result["questionNumber"] = question_number
+                grading_result["maxScore"] = 20
+                grading_result["answered"] = True
+                
+                # Update total score
+                total_score += grading_result["score"]
+                
+            # Add to results
+            max_score += 20
+            graded_questions[question_number] = grading_result
+            question_grading_results.append(grading_result)
+            if on_question_graded:
+                on_question_graded(len(question_grading_results), len(ordered_questions), grading_result)
+    finally:
+        # Don't wait for calls that overran their timeout
+        executor.shutdown(wait=False, cancel_futures=True)
     
     # Calculate overall results
     overall_percentage = (total_score / max_score * 100) if max_score > 0 else 0
@@ -3981,216 +5718,1137 @@ def get_submission_grading_details(classroom_id, quiz_id, student_id):
     """
     user_id = get_jwt_identity()
     
-    # Check if user is a teacher for this classroom or the student who submitted
-    is_teacher = False
-    is_owner = (user_id == student_id)
+    # Check if user is a teacher for this classroom or the student who submitted
+    is_teacher = False
+    is_owner = (user_id == student_id)
+    
+    if not is_owner:
+        # If not the owner, must be a teacher
+        classroom, user, error = get_classroom_and_validate_access(classroom_id, user_id, "teacher")
+        if error:
+            return error
+        is_teacher = True
+    else:
+        # Student accessing their own submission
+        classroom, user, error = get_classroom_and_validate_access(classroom_id, user_id, "student")
+        if error:
+            return error
+    
+    try:
+        # Find the quiz
+        quiz = find_quiz_by_id(classroom_id, quiz_id)
+        if not quiz:
+            return jsonify({"msg": "Quiz not found"}), 404
+        
+        # Find student's submission
+        student_obj_id = ObjectId(student_id)
+        submission = find_submission(classroom_id, quiz_id, student_obj_id)
+                
+        if not submission:
+            return jsonify({"msg": "Submission not found"}), 404
+        
+        # Check if submission has been auto-graded
+        if not submission.get("autoGraded", False) or not submission.get("isGraded", False):
+            return jsonify({"msg": "This submission has not been auto-graded"}), 404
+            
+        if "questionGradingResults" not in submission:
+            return jsonify({"msg": "No question-by-question grading results available"}), 404
+        
+        # Get student info for teachers
+        student_info = {}
+        if is_teacher:
+            student = users_collection.find_one({"_id": student_obj_id})
+            if student:
+                student_info = {
+                    "name": student.get("fullName", "Unknown"),
+                    "email": student.get("email", "")
+                }
+        
+        # Get quiz questions and answer key if available
+        has_questions = quiz.get("extractedText") and quiz["extractedText"].get("segregatedQuestions")
+        has_answer_key = quiz.get("extractedText") and quiz["extractedText"].get("segregatedAnswers")
+        
+        # Create response
+        response_data = {
+            "quizTitle": quiz.get("title", "Untitled Quiz"),
+            "studentInfo": student_info,
+            "submissionDate": submission.get("endTime", "").isoformat() if isinstance(submission.get("endTime"), datetime) else submission.get("endTime", ""),
+            "score": submission.get("score", 0),
+            "maxScore": submission.get("maxScore", 0),
+            "percentage": submission.get("percentage", 0),
+            "feedback": submission.get("feedback", ""),
+            "autoGraded": True,
+            "questionGradingResults": submission["questionGradingResults"],
+            "hasQuestions": has_questions,
+            "hasAnswerKey": has_answer_key,
+            "gradedAt": submission.get("gradedAt", "").isoformat() if isinstance(submission.get("gradedAt"), datetime) else submission.get("gradedAt", "")
+        }
+        
+        # Add links to related resources
+        if has_questions:
+            response_data["questionPaperLink"] = f"/api/classrooms/{classroom_id}/quizzes/{quiz_id}/segregated-questions"
+            
+        if has_answer_key and is_teacher:
+            response_data["answerKeyLink"] = f"/api/classrooms/{classroom_id}/quizzes/{quiz_id}/segregated-answer-key"
+            
+        if "segregatedAnswers" in submission:
+            response_data["studentAnswersLink"] = f"/api/classrooms/{classroom_id}/quizzes/{quiz_id}/submissions/{student_id}/segregated-answers"
+        
+        # Include more detailed information for teachers
+        if is_teacher:
+            # Provide summary statistics by question
+            question_stats = {}
+            
+            for result in submission["questionGradingResults"]:
+                q_num = result["questionNumber"]
+                question_stats[q_num] = {
+                    "score": result["score"],
+                    "maxScore": result["maxScore"],
+                    "percentage": round(result["score"] / result["maxScore"] * 100, 1) if result["maxScore"] > 0 else 0,
+                    "keyPointsCovered": len(result.get("key_points_addressed", [])),
+                    "keyPointsMissed": len(result.get("key_points_missed", [])),
+                    "answered": result.get("answered", False)
+                }
+            
+            response_data["questionStats"] = question_stats
+        
+        # Convert response data to JSON serializable format
+        serializable_response = mongo_to_json_serializable(response_data)
+        
+        return jsonify(serializable_response), 200
+        
+    except Exception as e:
+        error_traceback = traceback.format_exc()
+        print(f"Error retrieving grading details: {str(e)}")
+        print(f"Traceback: {error_traceback}")
+        return jsonify({"msg": f"Server error: {str(e)}"}), 500
+
+@app.route("/api/classrooms/<classroom_id>/quizzes/student", methods=["GET"])
+@jwt_required()
+def get_student_quizzes(classroom_id):
+    """Get all quizzes for a classroom - student view"""
+    user_id = get_jwt_identity()
+    
+    classroom, user, error = get_classroom_and_validate_access(classroom_id, user_id)
+    if error:
+        return error
+    
+    try:
+        # Process quizzes for student view
+        current_time = get_current_ist_time()
+        
+        user_obj_id = ObjectId(user_id)
+        processed_quizzes = []
+        
+        # Only this student's submissions are needed
+        student_submissions = {
+            submission["quiz_id"]: submission
+            for submission in submissions_collection.find(
+                {"classroom_id": ObjectId(classroom_id), "student_id": user_obj_id},
+                SUBMISSION_FILE_CONTENT_PROJECTION
+            )
+        }
+        
+        for quiz in list_classroom_quizzes(classroom_id):
+            # Skip unpublished quizzes for students (but not for teachers)
+            if not quiz.get("published", True) and classroom["teacher_id"] != user_obj_id:
+                continue
+            
+            # Determine quiz status for this student
+            submission = student_submissions.get(quiz["id"])
+            student_status = get_quiz_status(quiz, user_obj_id, current_time, has_submitted=submission is not None)
+            
+            # Identify quiz type
+            quiz_type = quiz.get("quizType", "question")  # Default to question type for backwards compatibility
+            
+            # Create base student-friendly quiz object
+            student_quiz = {
+                "id": str(quiz["id"]),
+                "title": quiz.get("title", "Untitled Quiz"),
+                "description": quiz.get("description", ""),
+                "startTime": quiz["startTime"],
+                "endTime": calculate_quiz_end_time(quiz),
+                "duration": int(quiz["duration"]),
+                "quizType": quiz_type,
+                "studentStatus": student_status,
+                "serverProvidedStatus": True  # Mark status as coming from server to prevent frontend recalculation
+            }
+            
+            # For PDF quizzes, add file information
+            if quiz_type == "pdf":
+                if "questionPaper" in quiz:
+                    student_quiz["questionPaper"] = {
+                        "filename": quiz["questionPaper"].get("filename", "question_paper.pdf"),
+                        "size": quiz["questionPaper"].get("size", 0)
+                    }
+            else:
+                # For legacy quizzes, use the existing prepare_quiz_for_student function
+                legacy_quiz = prepare_quiz_for_student(quiz)
+                student_quiz["questions"] = legacy_quiz.get("questions", [])
+            
+            # If quiz is submitted, include the submission time and score info
+            if student_status == "submitted" and submission:
+                student_quiz["submittedAt"] = submission.get("endTime")
+                student_quiz["score"] = submission.get("score", 0)
+                student_quiz["maxScore"] = submission.get("maxScore", 0)
+                student_quiz["percentage"] = round((submission.get("score", 0) / submission.get("maxScore", 1)) * 100, 1) if submission.get("maxScore", 0) > 0 else 0
+                
+                # For PDF quizzes, add grading status
+                if quiz_type == "pdf":
+                    student_quiz["isGraded"] = submission.get("isGraded", False)
+                    if "answerFile" in submission:
+                        student_quiz["submission"] = {
+                            "filename": submission["answerFile"].get("filename", "answer.pdf"),
+                            "size": submission["answerFile"].get("size", 0)
+                        }
+                    if submission.get("isGraded", False):
+                        student_quiz["feedback"] = submission.get("feedback", "")
+                        
+                    # Add auto-grading info if available
+                    if submission.get("autoGraded", False):
+                        student_quiz["autoGraded"] = True
+                        if "questionGradingResults" in submission:
+                            student_quiz["gradedQuestionCount"] = len(submission["questionGradingResults"])
+                            student_quiz["gradingDetailUrl"] = f"/api/classrooms/{classroom_id}/quizzes/{str(quiz['id'])}/submissions/{user_id}/grading"
+            
+            processed_quizzes.append(student_quiz)
+        
+        # Sort quizzes by start time (newest first)
+        def quiz_sort_key(quiz):
+            try:
+                return quiz.get("startTime", datetime.min)
+            except:
+                return datetime.min
+                
+        processed_quizzes.sort(key=quiz_sort_key, reverse=True)
+        
+        # Convert to JSON serializable format
+        serializable_quizzes = mongo_to_json_serializable(processed_quizzes)
+        
+        return jsonify(serializable_quizzes), 200
+        
+    except Exception as e:
+        error_traceback = traceback.format_exc()
+        print(f"Error getting student quizzes: {str(e)}")
+        print(f"Traceback: {error_traceback}")
+        return jsonify({"msg": f"Server error: {str(e)}"}), 500
+
+# ============ PROGRESS EVENTS ============
+
+# progress_events is capped, so old events roll off on their own
+PROGRESS_EVENTS_CAPPED_BYTES = int(os.getenv("PROGRESS_EVENTS_CAPPED_BYTES", str(16 * 1024 * 1024)))
+PROGRESS_EVENTS_MAX_DOCS = int(os.getenv("PROGRESS_EVENTS_MAX_DOCS", "50000"))
+# How long a tail waits for new events before sending a keep-alive
+PROGRESS_STREAM_AWAIT_MS = int(os.getenv("PROGRESS_STREAM_AWAIT_MS", "15000"))
+# Streams are closed after this long; EventSource reconnects with Last-Event-ID
+PROGRESS_STREAM_MAX_SECONDS = int(os.getenv("PROGRESS_STREAM_MAX_SECONDS", "300"))
+PROGRESS_STREAM_RETRY_MS = int(os.getenv("PROGRESS_STREAM_RETRY_MS", "3000"))
+# A resumed stream looks this far behind the last event for late inserts from other processes
+PROGRESS_STREAM_RESUME_WINDOW_SECONDS = int(os.getenv("PROGRESS_STREAM_RESUME_WINDOW_SECONDS", "300"))
+
+_progress_events_ready = False
+_progress_events_lock = threading.Lock()
+
+def ensure_progress_events_collection():
+    """
+    Create progress_events as a capped collection (tailable cursors only work
+    on capped collections), converting a plain one if an insert got there
+    first. Safe to call from every worker.
+    
+    Returns:
+        bool: whether the collection is ready for publishing and tailing
+    """
+    global _progress_events_ready
+    if _progress_events_ready:
+        return True
+    with _progress_events_lock:
+        if _progress_events_ready:
+            return True
+        try:
+            if not progress_events_collection.options().get("capped"):
+                if progress_events_collection.name in db.list_collection_names(filter={"name": progress_events_collection.name}):
+                    db.command("convertToCapped", progress_events_collection.name, size=PROGRESS_EVENTS_CAPPED_BYTES)
+                else:
+                    try:
+                        db.create_collection(
+                            progress_events_collection.name,
+                            capped=True,
+                            size=PROGRESS_EVENTS_CAPPED_BYTES,
+                            max=PROGRESS_EVENTS_MAX_DOCS
+                        )
+                    except Exception:
+                        # Another worker may have created it first
+                        if not progress_events_collection.options().get("capped"):
+                            raise
+            _progress_events_ready = True
+        except Exception as e:
+            print(f"Error preparing progress_events collection: {str(e)}")
+    return _progress_events_ready
+
+def publish_progress(user_ids, event, data):
+    """
+    Publish a progress event to the given users' event streams. Any worker
+    can publish; every worker tailing the collection delivers it.
+    
+    Best-effort: a failure is logged and never breaks the work being reported.
+    """
+    recipients = list(dict.fromkeys(ObjectId(user_id) for user_id in user_ids if user_id))
+    if not recipients or not ensure_progress_events_collection():
+        return None
+    try:
+        return progress_events_collection.insert_one({
+            "user_ids": recipients,
+            "event": event,
+            "data": mongo_to_json_serializable(data),
+            "createdAt": datetime.utcnow()
+        }).inserted_id
+    except Exception as e:
+        print(f"Error publishing progress event {event}: {str(e)}")
+        return None
+
+def classroom_teacher_id(classroom_id):
+    """teacher_id of a classroom, or None"""
+    classroom = classrooms_collection.find_one({"_id": classroom_id}, {"teacher_id": 1})
+    return classroom.get("teacher_id") if classroom else None
+
+@app.route("/api/events/stream", methods=["GET"])
+@jwt_required()
+def stream_progress_events():
+    """
+    Server-Sent Events with the caller's grading and extraction progress
+    ("extracted", "segregated", "question_graded", "graded", "failed",
+    "quiz_extraction", "classroom_pdfs"), read by tailing progress_events so
+    events published by any worker arrive.
+    
+    EventSource passes the token as ?token=... and resumes after the
+    Last-Event-ID header when it reconnects. Publishers in different
+    processes make ObjectIds that do not sort in insertion order, so resuming
+    follows the capped collection's natural (insertion) order: the tail
+    starts at the last delivered event and skips up to and including it.
+    """
+    user_obj_id = ObjectId(get_jwt_identity())
+    if not ensure_progress_events_collection():
+        return jsonify({"msg": "Progress events are unavailable"}), 503
+    
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("lastEventId")
+    if last_event_id and ObjectId.is_valid(last_event_id):
+        last_id = ObjectId(last_event_id)
+    else:
+        # A new subscriber only gets events published from now on
+        newest = progress_events_collection.find_one({}, {"_id": 1}, sort=[("$natural", -1)])
+        last_id = newest["_id"] if newest else None
+    
+    def tail_query():
+        """The tail's filter, and whether the last delivered event (the marker) is in it"""
+        query = {"user_ids": user_obj_id}
+        if last_id is None:
+            return query, False
+        # Clocks differ between publishers; look back far enough to cover the skew
+        query["createdAt"] = {"$gte": last_id.generation_time.replace(tzinfo=None) - timedelta(seconds=PROGRESS_STREAM_RESUME_WINDOW_SECONDS)}
+        if progress_events_collection.find_one({"_id": last_id}, {"_id": 1}) is None:
+            # The marker rolled off the capped collection: replay the recent window
+            return query, False
+        return {"$or": [query, {"_id": last_id}]}, True
+    
+    def generate():
+        nonlocal last_id
+        deadline = time.monotonic() + PROGRESS_STREAM_MAX_SECONDS
+        yield f"retry: {PROGRESS_STREAM_RETRY_MS}\n\n"
+        if last_id is not None:
+            # Sets the client's Last-Event-ID even if no event arrives before a reconnect
+            yield f"id: {last_id}\n\n"
+        while time.monotonic() < deadline:
+            query, before_marker = tail_query()
+            cursor = progress_events_collection.find(
+                query, cursor_type=CursorType.TAILABLE_AWAIT
+            ).max_await_time_ms(PROGRESS_STREAM_AWAIT_MS)
+            try:
+                while cursor.alive and time.monotonic() < deadline:
+                    event = cursor.try_next()
+                    if event is None:
+                        # Keep proxies from closing an idle stream
+                        yield ": keep-alive\n\n"
+                        continue
+                    if before_marker:
+                        # Everything up to the marker was delivered already
+                        before_marker = event["_id"] != last_id
+                        continue
+                    if user_obj_id not in event.get("user_ids", []):
+                        continue
+                    last_id = event["_id"]
+                    yield sse_event(event["event"], event["data"], event_id=str(event["_id"]))
+            except Exception as e:
+                print(f"Error tailing progress events: {str(e)}")
+            finally:
+                cursor.close()
+            # The cursor dies on an empty collection or a lost connection; tail again
+            yield ": keep-alive\n\n"
+            time.sleep(min(1, max(0, deadline - time.monotonic())))
+    
+    return Response(generate(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+# ============ BACKGROUND JOB QUEUE ============
+
+# How long a worker owns a claimed job before another worker may take it over
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "600"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_POLL_INTERVAL_SECONDS = float(os.getenv("JOB_POLL_INTERVAL_SECONDS", "2"))
+# Worker threads started inside each web process (0 to rely on `flask run-job-worker`)
+JOB_WORKER_THREADS = int(os.getenv("JOB_WORKER_THREADS", "2"))
+
+# Job type -> handler(job). Handlers return a result dict stored on the job.
+JOB_HANDLERS = {}
+
+class JobDeferred(Exception):
+    """Raised by a handler that cannot run yet; the job is requeued without using up an attempt"""
+    
+    def __init__(self, message, delay_seconds):
+        super().__init__(message)
+        self.delay_seconds = delay_seconds
+
+_job_workers_started = False
+_job_workers_lock = threading.Lock()
+
+def enqueue_job(job_type, payload, user_id=None, classroom_id=None):
+    """Insert a queued job and return its id"""
+    now = datetime.utcnow()
+    job = {
+        "type": job_type,
+        "status": "queued",
+        "payload": payload,
+        "user_id": ObjectId(user_id) if user_id else None,
+        "classroom_id": ObjectId(classroom_id) if classroom_id else None,
+        "attempts": 0,
+        "maxAttempts": JOB_MAX_ATTEMPTS,
+        "runAfter": now,
+        "leaseExpiresAt": None,
+        "workerId": None,
+        "createdAt": now,
+        "updatedAt": now
+    }
+    return jobs_collection.insert_one(job).inserted_id
+
+def claim_next_job(worker_id):
+    """
+    Atomically claim the oldest runnable job: a queued job that is due, or a
+    running job whose worker let the lease expire.
+    """
+    now = datetime.utcnow()
+    
+    # Jobs whose lease ran out on their last allowed attempt are not retried.
+    # Each is failed individually so its :failed handler can clean up.
+    while True:
+        expired = jobs_collection.find_one_and_update(
+            {"status": "running", "leaseExpiresAt": {"$lt": now}, "$expr": {"$gte": ["$attempts", "$maxAttempts"]}},
+            {"$set": {"status": "failed", "lastError": "Lease expired", "completedAt": now, "updatedAt": now, "leaseExpiresAt": None}},
+            return_document=ReturnDocument.AFTER
+        )
+        if expired is None:
+            break
+        print(f"Job {expired['_id']} ({expired['type']}) lease expired on its last attempt")
+        run_job_failure_handler(expired, "Lease expired")
+    
+    return jobs_collection.find_one_and_update(
+        {"$or": [
+            {"status": "queued", "runAfter": {"$lte": now}},
+            {"status": "running", "leaseExpiresAt": {"$lt": now}}
+        ]},
+        {
+            "$set": {
+                "status": "running",
+                "workerId": worker_id,
+                "leaseExpiresAt": now + timedelta(seconds=JOB_LEASE_SECONDS),
+                "startedAt": now,
+                "updatedAt": now
+            },
+            "$inc": {"attempts": 1}
+        },
+        sort=[("runAfter", ASCENDING)],
+        return_document=ReturnDocument.AFTER
+    )
+
+def renew_job_lease(job):
+    """Extend the lease on a job that is still being worked on"""
+    now = datetime.utcnow()
+    jobs_collection.update_one(
+        {"_id": job["_id"], "workerId": job["workerId"]},
+        {"$set": {"leaseExpiresAt": now + timedelta(seconds=JOB_LEASE_SECONDS), "updatedAt": now}}
+    )
+
+def run_job_failure_handler(job, error_message):
+    """Call the job type's :failed handler, if any, logging its errors"""
+    failure_handler = JOB_HANDLERS.get(f"{job['type']}:failed")
+    if not failure_handler:
+        return
+    try:
+        failure_handler(job, error_message)
+    except Exception as e:
+        print(f"Failure handler for job {job['_id']} ({job['type']}) raised: {str(e)}")
+
+def run_claimed_job(job):
+    """Run a claimed job and record success, a scheduled retry or the final failure"""
+    handler = JOB_HANDLERS.get(job["type"])
+    try:
+        if handler is None:
+            raise ValueError(f"No handler for job type {job['type']}")
+        result = handler(job)
+        now = datetime.utcnow()
+        jobs_collection.update_one(
+            {"_id": job["_id"], "workerId": job["workerId"]},
+            {"$set": {
+                "status": "completed",
+                "result": result or {},
+                "completedAt": now,
+                "updatedAt": now,
+                "leaseExpiresAt": None
+            }}
+        )
+    except JobDeferred as e:
+        print(f"Job {job['_id']} ({job['type']}) deferred for {e.delay_seconds}s: {str(e)}")
+        now = datetime.utcnow()
+        jobs_collection.update_one(
+            {"_id": job["_id"], "workerId": job["workerId"]},
+            {
+                "$set": {
+                    "status": "queued",
+                    "runAfter": now + timedelta(seconds=e.delay_seconds),
+                    "lastError": str(e),
+                    "updatedAt": now,
+                    "leaseExpiresAt": None
+                },
+                # Claiming counted an attempt; waiting is not a failure
+                "$inc": {"attempts": -1}
+            }
+        )
+    except Exception as e:
+        print(f"Job {job['_id']} ({job['type']}) failed on attempt {job['attempts']}: {str(e)}")
+        traceback.print_exc()
+        now = datetime.utcnow()
+        if job["attempts"] < job.get("maxAttempts", JOB_MAX_ATTEMPTS):
+            # Exponential backoff before the next attempt
+            retry_delay = min(300, 15 * 2 ** (job["attempts"] - 1))
+            update = {"status": "queued", "runAfter": now + timedelta(seconds=retry_delay)}
+        else:
+            update = {"status": "failed", "completedAt": now}
+            # Still record the job as failed below if the handler raises
+            run_job_failure_handler(job, str(e))
+        update.update({"lastError": str(e), "updatedAt": now, "leaseExpiresAt": None})
+        jobs_collection.update_one({"_id": job["_id"], "workerId": job["workerId"]}, {"$set": update})
+
+def run_job_worker(worker_id, stop_event=None):
+    """Claim and run jobs until stop_event is set"""
+    print(f"Job worker {worker_id} started")
+    while stop_event is None or not stop_event.is_set():
+        try:
+            job = claim_next_job(worker_id)
+        except Exception as e:
+            print(f"Job worker {worker_id} could not claim a job: {str(e)}")
+            job = None
+        if job is None:
+            time.sleep(JOB_POLL_INTERVAL_SECONDS)
+            continue
+        try:
+            run_claimed_job(job)
+        except Exception as e:
+            # e.g. Mongo errors while recording the outcome; the job's lease
+            # runs out and it is claimed again, but this thread keeps going
+            print(f"Job worker {worker_id} could not finish job {job['_id']}: {str(e)}")
+            traceback.print_exc()
+
+def start_job_workers():
+    """Start the in-process worker threads once per process"""
+    global _job_workers_started
+    if _job_workers_started or JOB_WORKER_THREADS <= 0:
+        return
+    with _job_workers_lock:
+        if _job_workers_started:
+            return
+        for i in range(JOB_WORKER_THREADS):
+            worker_id = f"{os.getpid()}-{i}"
+            threading.Thread(target=run_job_worker, args=(worker_id,), daemon=True, name=f"job-worker-{i}").start()
+        _job_workers_started = True
+
+@app.before_request
+def ensure_job_workers_started():
+    start_job_workers()
+    # Covers servers pointed at main:app instead of the factory
+    create_app()
+
+@app.cli.command("run-job-worker")
+@click.option("--threads", default=1, help="Number of worker threads.")
+def run_job_worker_command(threads):
+    """Run background job workers in the foreground."""
+    workers = []
+    for i in range(threads):
+        worker_id = f"cli-{os.getpid()}-{i}"
+        worker = threading.Thread(target=run_job_worker, args=(worker_id,), daemon=True)
+        worker.start()
+        workers.append(worker)
+    click.echo(f"Running {threads} job worker(s); press Ctrl+C to stop")
+    for worker in workers:
+        worker.join()
+
+# Grading waits this long for the quiz's own PDF ingestion, polling every GRADING_QUIZ_POLL_SECONDS
+GRADING_QUIZ_WAIT_SECONDS = int(os.getenv("GRADING_QUIZ_WAIT_SECONDS", "1800"))
+GRADING_QUIZ_POLL_SECONDS = int(os.getenv("GRADING_QUIZ_POLL_SECONDS", "20"))
+
+def quiz_question_count(quiz):
+    """Highest question number in the quiz's segregated question paper (or answer key), or None"""
+    extracted = quiz.get("extractedText") or {}
+    for field in ("segregatedQuestions", "segregatedAnswers"):
+        numbers = [int(key) for key in (extracted.get(field) or {}) if key.isdigit() and key != "0"]
+        if numbers:
+            return max(numbers)
+    return None
+
+def submission_progress(submission):
+    """Fields identifying a submission in its progress events"""
+    return {
+        "scope": "submission",
+        "submissionId": submission["_id"],
+        "classroomId": submission["classroom_id"],
+        "quizId": submission["quiz_id"],
+        "studentId": submission["student_id"]
+    }
+
+def grade_submission_job(job):
+    """
+    Extract, segregate and auto-grade a PDF submission in the background.
+    
+    Extraction errors are raised so the job is retried; an auto-grading error
+    is stored on the submission like it was when grading ran inline.
+    """
+    payload = job["payload"]
+    submission = submissions_collection.find_one({"_id": payload["submission_id"]}, SUBMISSION_FILE_CONTENT_PROJECTION)
+    if not submission:
+        raise ValueError("Submission not found")
+    quiz = quizzes_collection.find_one({"_id": submission["quiz_id"]}, QUIZ_FILE_CONTENT_PROJECTION)
+    if not quiz:
+        raise ValueError("Quiz not found")
+    
+    if quiz.get("extractionStatus") in ("queued", "running"):
+        # The answer key is still being processed; wait for it without using up
+        # attempts, unless ingestion looks stuck
+        if datetime.utcnow() - job["createdAt"] < timedelta(seconds=GRADING_QUIZ_WAIT_SECONDS):
+            raise JobDeferred("Quiz PDFs are still being processed", GRADING_QUIZ_POLL_SECONDS)
+        raise ValueError("Quiz PDFs are still being processed")
+    
+    submissions_collection.update_one({"_id": submission["_id"]}, {"$set": {"gradingStatus": "running"}})
+    
+    # The student and the classroom teacher both follow grading on /api/events/stream
+    recipients = [submission["student_id"], classroom_teacher_id(submission["classroom_id"])]
+    progress = submission_progress(submission)
+    
+    print(f"\nExtracting text from student answer file: {submission['answerFile'].get('filename')}")
+    extraction_report = {}
+    extracted_text = extract_text_from_pdf(read_pdf_file(submission["answerFile"]), report=extraction_report)
+    print(f"Successfully extracted {len(extracted_text)} characters from student answer")
+    publish_progress(recipients, "extracted", dict(
+        progress, characters=len(extracted_text), pages=extraction_report.get("pages"),
+        message="Text extracted from answer sheet"
+    ))
+    
+    # Segregate student answers by question number
+    print("Segregating student answers by question number...")
+    segregated_student_answers = segregate_questions_by_number(
+        extracted_text, is_question_paper=False, max_question=quiz_question_count(quiz)
+    )
+    renew_job_lease(job)
+    answer_count = len(segregated_student_answers) - (1 if "0" in segregated_student_answers else 0)
+    publish_progress(recipients, "segregated", dict(
+        progress, answerCount=answer_count, message=f"Found answers to {answer_count} questions"
+    ))
+    
+    def on_question_graded(graded, total, result):
+        # Long papers can grade for longer than one lease
+        renew_job_lease(job)
+        publish_progress(recipients, "question_graded", dict(
+            progress, questionNumber=result["questionNumber"], graded=graded, total=total,
+            score=result.get("score", 0), maxScore=result.get("maxScore"),
+            message=f"Question {graded}/{total} graded"
+        ))
+    
+    submission["extractedText"] = extracted_text
+    submission["extractionReport"] = extraction_report
+    submission["segregatedAnswers"] = segregated_student_answers
+    
+    # Attempt to auto-grade if the quiz has an answer key with segregated answers
+    if "extractedText" in quiz and "segregatedAnswers" in quiz["extractedText"]:
+        print("Answer key with segregated answers found. Attempting auto-grading...")
+        try:
+            submission = auto_grade_submission(
+                quiz, submission,
+                use_cache=not payload.get("bypassCache", False),
+                on_question_graded=on_question_graded
+            )
+            print(f"Auto-grading successful. Score: {submission.get('score', 0)}/{submission.get('maxScore', 100)}")
+        except Exception as grading_error:
+            print(f"Error during auto-grading: {str(grading_error)}")
+            traceback.print_exc()
+            submission["autoGradingError"] = str(grading_error)
+    else:
+        print("Quiz does not have an answer key with segregated answers. Skipping auto-grading.")
+    
+    submission["gradingStatus"] = "completed"
+    updates = {
+        field: value for field, value in submission.items()
+        if field not in ("_id", "classroom_id", "quiz_id", "student_id", "answerFile")
+    }
+    submissions_collection.update_one(
+        {"_id": submission["_id"]},
+        {"$set": updates, "$unset": {"extractionError": ""}}
+    )
+    publish_progress(recipients, "graded", dict(
+        progress, autoGraded=bool(submission.get("autoGraded")), score=submission.get("score", 0),
+        maxScore=submission.get("maxScore", 100), percentage=submission.get("percentage", 0),
+        autoGradingError=submission.get("autoGradingError")
+    ))
+    
+    return {
+        "submissionId": str(submission["_id"]),
+        "textLength": len(extracted_text),
+        "answerCount": answer_count,
+        "autoGraded": bool(submission.get("autoGraded")),
+        "score": submission.get("score", 0),
+        "maxScore": submission.get("maxScore", 100),
+        "percentage": submission.get("percentage", 0),
+        "autoGradingError": submission.get("autoGradingError")
+    }
+
+def grade_submission_job_failed(job, error_message):
+    """Record on the submission that background processing gave up"""
+    submission = submissions_collection.find_one_and_update(
+        {"_id": job["payload"]["submission_id"]},
+        {"$set": {"gradingStatus": "failed", "extractionError": error_message}},
+        projection={"classroom_id": 1, "quiz_id": 1, "student_id": 1}
+    )
+    if submission:
+        publish_progress(
+            [submission["student_id"], classroom_teacher_id(submission["classroom_id"])],
+            "failed", dict(submission_progress(submission), error=error_message)
+        )
+
+JOB_HANDLERS["grade_submission"] = grade_submission_job
+JOB_HANDLERS["grade_submission:failed"] = grade_submission_job_failed
+
+def compact_chat_history_job(job):
+    """Summarize the older part of a user's doubt-chat history"""
+    return chat_session_store.compact(job["payload"]["user_id"])
+
+def compact_chat_history_job_failed(job, error_message):
+    """Let the next turn queue a fresh compaction"""
+    chat_history_collection.update_one(
+        {"_id": ObjectId(job["payload"]["user_id"])},
+        {"$set": {"compactionPending": False}}
+    )
+
+JOB_HANDLERS["compact_chat_history"] = compact_chat_history_job
+JOB_HANDLERS["compact_chat_history:failed"] = compact_chat_history_job_failed
+
+def run_quiz_pdf_chain(pdf_binary, is_question_paper):
+    """extract -> segregate for one quiz PDF"""
+    # Teacher-uploaded papers: typed pages can be read from the text layer
+    text = extract_text_from_pdf(pdf_binary, allow_text_layer=True)
+    segregated = segregate_questions_by_number(text, is_question_paper=is_question_paper)
+    return text, segregated
+
+def build_quiz_extracted_text(question_paper_binary, answer_key_binary=None, on_stage=None):
+    """
+    Run the question paper and answer key extract -> segregate chains
+    concurrently and assemble the quiz's extractedText.
+    
+    on_stage(stage, status) is called as each chain ("questionPaper",
+    "answerKey") starts ("running") and ends ("completed" or "failed").
+    
+    Returns:
+        tuple: (extractedText dict, {stage: error message} for failed chains)
+    """
+    chains = {}
+    if question_paper_binary:
+        chains["questionPaper"] = (question_paper_binary, True)
+    if answer_key_binary:
+        chains["answerKey"] = (answer_key_binary, False)
+    
+    def run_stage(stage, pdf_binary, is_question_paper):
+        if on_stage:
+            on_stage(stage, "running")
+        try:
+            result = run_quiz_pdf_chain(pdf_binary, is_question_paper)
+        except Exception:
+            if on_stage:
+                on_stage(stage, "failed")
+            raise
+        if on_stage:
+            on_stage(stage, "completed")
+        return result
+    
+    extracted_text = {"timestamp": datetime.utcnow()}
+    errors = {}
+    if not chains:
+        return extracted_text, errors
+    
+    with ThreadPoolExecutor(max_workers=len(chains)) as executor:
+        futures = {
+            stage: executor.submit(run_stage, stage, pdf_binary, is_question_paper)
+            for stage, (pdf_binary, is_question_paper) in chains.items()
+        }
+        for stage, future in futures.items():
+            try:
+                text, segregated = future.result()
+            except Exception as e:
+                print(f"ERROR extracting text from {stage}: {str(e)}")
+                traceback.print_exc()
+                errors[stage] = str(e)
+                continue
+            if stage == "questionPaper":
+                extracted_text["questionPaper"] = [text]
+                extracted_text["segregatedQuestions"] = segregated
+            else:
+                extracted_text["answerKey"] = [text]
+                extracted_text["segregatedAnswers"] = segregated
+    
+    return extracted_text, errors
+
+def ingest_quiz_pdfs(quiz_id, heartbeat=None):
+    """
+    Extract and segregate a quiz's question paper and answer key and save
+    them as extractedText. Chains that succeeded are saved even if the other
+    one fails; the failure is then raised (finished extractions are cached,
+    so a retry only redoes the failed chain's work). heartbeat() is called
+    as each chain starts and ends, and each stage is published to the
+    classroom teacher as a "quiz_extraction" progress event.
+    """
+    quiz = quizzes_collection.find_one({"_id": quiz_id}, {"title": 1, "classroom_id": 1, "questionPaper": 1, "answerKey": 1})
+    if not quiz:
+        raise ValueError("Quiz not found")
+    
+    print(f"\n===== QUIZ PDF INGESTION STARTED: {quiz.get('title', 'Untitled Quiz')} =====")
+    quizzes_collection.update_one({"_id": quiz_id}, {"$set": {"extractionStatus": "running"}})
+    
+    recipients = [classroom_teacher_id(quiz.get("classroom_id"))]
+    progress = {"scope": "quiz", "quizId": quiz_id, "classroomId": quiz.get("classroom_id"), "title": quiz.get("title", "Untitled Quiz")}
+    
+    def on_stage(stage, status):
+        quizzes_collection.update_one({"_id": quiz_id}, {"$set": {f"extractionProgress.{stage}": status}})
+        publish_progress(recipients, "quiz_extraction", dict(progress, stage=stage, status=status))
+        if heartbeat:
+            heartbeat()
+    
+    question_paper_binary = read_pdf_file(quiz["questionPaper"]) if has_pdf_content(quiz.get("questionPaper")) else None
+    answer_key_binary = read_pdf_file(quiz["answerKey"]) if has_pdf_content(quiz.get("answerKey")) else None
+    extracted_text, errors = build_quiz_extracted_text(question_paper_binary, answer_key_binary, on_stage=on_stage)
+    
+    update = {"updatedAt": datetime.utcnow()}
+    if "questionPaper" in extracted_text or "answerKey" in extracted_text:
+        update["extractedText"] = extracted_text
+    if errors:
+        quizzes_collection.update_one({"_id": quiz_id}, {"$set": update})
+        raise ValueError("; ".join(f"{stage}: {error}" for stage, error in errors.items()))
+    
+    update["extractionStatus"] = "completed"
+    quizzes_collection.update_one({"_id": quiz_id}, {"$set": update, "$unset": {"extractionError": ""}})
+    print(f"===== QUIZ PDF INGESTION COMPLETE: {quiz.get('title', 'Untitled Quiz')} =====\n")
+    
+    counts = {
+        "questionCount": len([key for key in extracted_text.get("segregatedQuestions", {}) if key != "0"]),
+        "answerCount": len([key for key in extracted_text.get("segregatedAnswers", {}) if key != "0"])
+    }
+    publish_progress(recipients, "quiz_extraction", dict(progress, stage="all", status="completed", **counts))
+    return counts
+
+def ingest_quiz_pdfs_job(job):
+    """Background ingestion of a new (or backfilled) quiz's PDFs"""
+    return ingest_quiz_pdfs(job["payload"]["quiz_id"], heartbeat=lambda: renew_job_lease(job))
+
+def ingest_quiz_pdfs_job_failed(job, error_message):
+    """Record on the quiz that background extraction gave up"""
+    quiz = quizzes_collection.find_one_and_update(
+        {"_id": job["payload"]["quiz_id"]},
+        {"$set": {"extractionStatus": "failed", "extractionError": error_message}},
+        projection={"title": 1, "classroom_id": 1}
+    )
+    if quiz:
+        publish_progress([classroom_teacher_id(quiz.get("classroom_id"))], "quiz_extraction", {
+            "scope": "quiz", "quizId": quiz["_id"], "classroomId": quiz.get("classroom_id"),
+            "title": quiz.get("title", "Untitled Quiz"), "stage": "all", "status": "failed", "error": error_message
+        })
+
+JOB_HANDLERS["ingest_quiz_pdfs"] = ingest_quiz_pdfs_job
+JOB_HANDLERS["ingest_quiz_pdfs:failed"] = ingest_quiz_pdfs_job_failed
+
+# A queued or running quiz extraction is not started again until this lease
+# runs out, so concurrent GETs share one in-flight extraction
+QUIZ_EXTRACTION_LEASE_SECONDS = int(os.getenv("QUIZ_EXTRACTION_LEASE_SECONDS", "900"))
+
+def claim_quiz_extraction_lease(quiz_id, owner=None):
+    """
+    Atomically take the extraction lease on a quiz that still needs text.
+    Returns True for the single caller that should run the extraction.
+    An owner (e.g. a batch job id) can take back a lease it still holds.
+    """
+    now = datetime.utcnow()
+    lease_free = [
+        {"extractionLeaseExpiresAt": None},
+        {"extractionLeaseExpiresAt": {"$lt": now}}
+    ]
+    if owner is not None:
+        lease_free.append({"extractionLeaseOwner": owner})
+    claimed = quizzes_collection.find_one_and_update(
+        {
+            "_id": quiz_id,
+            # Matches a missing or null field
+            "extractedText": None,
+            "extractionStatus": {"$ne": "completed"},
+            "$or": lease_free
+        },
+        {"$set": {
+            "extractionStatus": "queued",
+            "extractionLeaseExpiresAt": now + timedelta(seconds=QUIZ_EXTRACTION_LEASE_SECONDS),
+            "extractionLeaseOwner": owner
+        }},
+        projection={"_id": 1}
+    )
+    return claimed is not None
+
+def request_quiz_extraction(quiz, user_id, classroom_id):
+    """
+    Singleflight backfill for quizzes without extractedText: the first caller
+    atomically takes the quiz's extraction lease and queues an
+    ingest_quiz_pdfs job; everyone else just gets the current status.
+    
+    Returns:
+        str: the quiz's extractionStatus after the call
+    """
+    if not (quiz.get("questionPaper") or quiz.get("answerKey")):
+        return quiz.get("extractionStatus", "unavailable")
+    
+    if not claim_quiz_extraction_lease(quiz["_id"]):
+        # Someone else holds the lease (or the quiz changed underneath us)
+        current = quizzes_collection.find_one({"_id": quiz["_id"]}, {"extractionStatus": 1}) or {}
+        return current.get("extractionStatus", "queued")
+    
+    try:
+        job_id = enqueue_job("ingest_quiz_pdfs", {"quiz_id": quiz["_id"]}, user_id=user_id, classroom_id=classroom_id)
+    except Exception:
+        # Release the lease so the next request can try again
+        quizzes_collection.update_one(
+            {"_id": quiz["_id"]},
+            {"$set": {"extractionStatus": "failed"}, "$unset": {"extractionLeaseExpiresAt": ""}}
+        )
+        raise
+    quizzes_collection.update_one({"_id": quiz["_id"]}, {"$set": {"extractionJobId": job_id}})
+    print(f"Queued background PDF extraction for quiz {quiz['_id']} (job {job_id})")
+    return "queued"
+
+# Quizzes extracted at the same time by one classroom batch
+CLASSROOM_PDF_CONCURRENCY = int(os.getenv("CLASSROOM_PDF_CONCURRENCY", "3"))
+CLASSROOM_PDF_PROGRESS_POLL_SECONDS = float(os.getenv("CLASSROOM_PDF_PROGRESS_POLL_SECONDS", "1"))
+
+# Per-quiz outcomes that are final; anything else is (re)done when a batch resumes
+CLASSROOM_PDF_FINAL_OUTCOMES = ("processed", "already_processed", "in_progress_elsewhere", "error")
+
+def summarize_classroom_pdf_progress(outcomes, total, error_details):
+    """Counters reported by the progress endpoint, built from the per-quiz checkpoints"""
+    counts = {outcome: 0 for outcome in CLASSROOM_PDF_FINAL_OUTCOMES}
+    for outcome in outcomes.values():
+        if outcome in counts:
+            counts[outcome] += 1
+    done = sum(counts.values())
+    return {
+        "total": total,
+        "processed": counts["processed"],
+        "alreadyProcessed": counts["already_processed"],
+        "inProgressElsewhere": counts["in_progress_elsewhere"],
+        "errors": counts["error"],
+        "remaining": total - done,
+        "running": sum(1 for outcome in outcomes.values() if outcome == "running"),
+        "quizzes": outcomes,
+        "errorDetails": error_details,
+        "updatedAt": datetime.utcnow()
+    }
+
+def process_classroom_pdfs_job(job):
+    """
+    Extract text for every quiz in a classroom that is missing it, at most
+    CLASSROOM_PDF_CONCURRENCY quizzes at a time.
+    
+    Each quiz's outcome is checkpointed on the job's progress field as it
+    finishes, so when a crashed batch is picked up again (expired job lease)
+    it skips finished quizzes and only redoes the ones that were running.
+    Quizzes take the same extraction lease as the GET backfill, owned by
+    this job, so a quiz is never extracted twice at once.
+    """
+    classroom_id = job["classroom_id"]
+    job_id = job["_id"]
+    progress = job.get("progress") or {}
+    outcomes = dict(progress.get("quizzes", {}))
+    error_details = list(progress.get("errorDetails", []))
+    if outcomes:
+        print(f"Resuming classroom PDF batch {job_id}: {len(outcomes)} quizzes checkpointed")
+    
+    classroom = classrooms_collection.find_one({"_id": classroom_id}, {"name": 1})
+    if not classroom:
+        raise ValueError("Classroom not found")
+    print(f"\n===== PROCESSING ALL QUIZZES IN CLASSROOM: {classroom.get('name', 'Unknown')} =====")
+    
+    quizzes = list_classroom_quizzes(classroom_id, projection={
+        "title": 1, "extractedText.timestamp": 1, "questionPaper.filename": 1, "answerKey.filename": 1
+    })
+    progress_lock = threading.Lock()
+    
+    def checkpoint(quiz=None, outcome=None, error=None):
+        with progress_lock:
+            if quiz is not None:
+                outcomes[str(quiz["_id"])] = outcome
+                if error:
+                    error_details.append({"quizId": str(quiz["_id"]), "title": quiz.get("title", "Untitled Quiz"), "error": error})
+            summary = summarize_classroom_pdf_progress(outcomes, len(quizzes), error_details)
+            now = datetime.utcnow()
+            jobs_collection.update_one(
+                {"_id": job_id, "workerId": job["workerId"]},
+                {"$set": {
+                    "progress": summary,
+                    "leaseExpiresAt": now + timedelta(seconds=JOB_LEASE_SECONDS),
+                    "updatedAt": now
+                }}
+            )
+        publish_progress([job.get("user_id")], "classroom_pdfs", dict(
+            {key: value for key, value in summary.items() if key != "quizzes"},
+            scope="classroom_pdfs", jobId=job_id, classroomId=classroom_id
+        ))
+    
+    pending = []
+    for quiz in quizzes:
+        outcome = outcomes.get(str(quiz["_id"]))
+        if outcome in CLASSROOM_PDF_FINAL_OUTCOMES:
+            continue
+        if quiz.get("extractedText"):
+            outcomes[str(quiz["_id"])] = "already_processed"
+        elif not (quiz.get("questionPaper") or quiz.get("answerKey")):
+            outcomes[str(quiz["_id"])] = "error"
+            error_details.append({"quizId": str(quiz["_id"]), "title": quiz.get("title", "Untitled Quiz"), "error": "No PDF found"})
+        else:
+            pending.append(quiz)
+    checkpoint()
+    
+    def process_quiz(quiz):
+        # A quiz left "running" by a crashed run of this batch still holds our lease
+        if not claim_quiz_extraction_lease(quiz["_id"], owner=job_id):
+            return "in_progress_elsewhere", None
+        checkpoint(quiz, "running")
+        try:
+            ingest_quiz_pdfs(quiz["_id"], heartbeat=lambda: renew_job_lease(job))
+            return "processed", None
+        except Exception as e:
+            quizzes_collection.update_one(
+                {"_id": quiz["_id"]},
+                {"$set": {"extractionStatus": "failed", "extractionError": str(e)}}
+            )
+            return "error", str(e)
+    
+    if pending:
+        pool_size = max(1, min(CLASSROOM_PDF_CONCURRENCY, len(pending)))
+        with ThreadPoolExecutor(max_workers=pool_size) as executor:
+            futures = {executor.submit(process_quiz, quiz): quiz for quiz in pending}
+            for future in as_completed(futures):
+                quiz = futures[future]
+                outcome, error = future.result()
+                print(f"Quiz {quiz.get('title', 'Untitled Quiz')}: {outcome}{f' ({error})' if error else ''}")
+                checkpoint(quiz, outcome, error)
+    
+    summary = summarize_classroom_pdf_progress(outcomes, len(quizzes), error_details)
+    print("\n===== PDF TEXT EXTRACTION SUMMARY =====")
+    print(f"Total quizzes processed: {summary['processed']}")
+    print(f"Total quizzes already processed: {summary['alreadyProcessed']}")
+    print(f"Total quizzes with errors: {summary['errors']}")
+    print("===== PDF TEXT EXTRACTION COMPLETE =====\n")
+    
+    return {
+        "success": True,
+        "processed": summary["processed"],
+        "already_processed": summary["alreadyProcessed"],
+        "in_progress_elsewhere": summary["inProgressElsewhere"],
+        "errors": summary["errors"],
+        "message": f"Processed {summary['processed']} quizzes, {summary['alreadyProcessed']} already had text, {summary['errors']} errors"
+    }
+
+JOB_HANDLERS["process_classroom_pdfs"] = process_classroom_pdfs_job
+
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+@jwt_required()
+def get_job_status(job_id):
+    """Get the status of a background job (owner or classroom teacher only)"""
+    user_id = get_jwt_identity()
+    
+    if not ObjectId.is_valid(job_id):
+        return jsonify({"msg": "Invalid job ID"}), 400
     
-    if not is_owner:
-        # If not the owner, must be a teacher
-        classroom, user, error = get_classroom_and_validate_access(classroom_id, user_id, "teacher")
-        if error:
-            return error
-        is_teacher = True
-    else:
-        # Student accessing their own submission
-        classroom, user, error = get_classroom_and_validate_access(classroom_id, user_id, "student")
+    job = jobs_collection.find_one({"_id": ObjectId(job_id)})
+    if not job:
+        return jsonify({"msg": "Job not found"}), 404
+    
+    if job.get("user_id") != ObjectId(user_id):
+        if not job.get("classroom_id"):
+            return jsonify({"msg": "Unauthorized to view this job"}), 403
+        classroom, user, error = get_classroom_and_validate_access(job["classroom_id"], user_id, "teacher")
         if error:
             return error
     
-    try:
-        # Find the quiz
-        quiz = find_quiz_by_id(classroom, quiz_id)
-        if not quiz:
-            return jsonify({"msg": "Quiz not found"}), 404
-        
-        # Find student's submission
-        student_obj_id = ObjectId(student_id)
-        submission = None
-        
-        for sub in quiz.get("submissions", []):
-            if sub["student_id"] == student_obj_id:
-                submission = sub
-                break
-                
-        if not submission:
-            return jsonify({"msg": "Submission not found"}), 404
-        
-        # Check if submission has been auto-graded
-        if not submission.get("autoGraded", False) or not submission.get("isGraded", False):
-            return jsonify({"msg": "This submission has not been auto-graded"}), 404
-            
-        if "questionGradingResults" not in submission:
-            return jsonify({"msg": "No question-by-question grading results available"}), 404
-        
-        # Get student info for teachers
-        student_info = {}
-        if is_teacher:
-            student = users_collection.find_one({"_id": student_obj_id})
-            if student:
-                student_info = {
-                    "name": student.get("fullName", "Unknown"),
-                    "email": student.get("email", "")
-                }
-        
-        # Get quiz questions and answer key if available
-        has_questions = quiz.get("extractedText") and quiz["extractedText"].get("segregatedQuestions")
-        has_answer_key = quiz.get("extractedText") and quiz["extractedText"].get("segregatedAnswers")
-        
-        # Create response
-        response_data = {
-            "quizTitle": quiz.get("title", "Untitled Quiz"),
-            "studentInfo": student_info,
-            "submissionDate": submission.get("endTime", "").isoformat() if isinstance(submission.get("endTime"), datetime) else submission.get("endTime", ""),
-            "score": submission.get("score", 0),
-            "maxScore": submission.get("maxScore", 0),
-            "percentage": submission.get("percentage", 0),
-            "feedback": submission.get("feedback", ""),
-            "autoGraded": True,
-            "questionGradingResults": submission["questionGradingResults"],
-            "hasQuestions": has_questions,
-            "hasAnswerKey": has_answer_key,
-            "gradedAt": submission.get("gradedAt", "").isoformat() if isinstance(submission.get("gradedAt"), datetime) else submission.get("gradedAt", "")
-        }
-        
-        # Add links to related resources
-        if has_questions:
-            response_data["questionPaperLink"] = f"/api/classrooms/{classroom_id}/quizzes/{quiz_id}/segregated-questions"
-            
-        if has_answer_key and is_teacher:
-            response_data["answerKeyLink"] = f"/api/classrooms/{classroom_id}/quizzes/{quiz_id}/segregated-answer-key"
-            
-        if "segregatedAnswers" in submission:
-            response_data["studentAnswersLink"] = f"/api/classrooms/{classroom_id}/quizzes/{quiz_id}/submissions/{student_id}/segregated-answers"
-        
-        # Include more detailed information for teachers
-        if is_teacher:
-            # Provide summary statistics by question
-            question_stats = {}
-            
-            for result in submission["questionGradingResults"]:
-                q_num = result["questionNumber"]
-                question_stats[q_num] = {
-                    "score": result["score"],
-                    "maxScore": result["maxScore"],
-                    "percentage": round(result["score"] / result["maxScore"] * 100, 1) if result["maxScore"] > 0 else 0,
-                    "keyPointsCovered": len(result.get("key_points_addressed", [])),
-                    "keyPointsMissed": len(result.get("key_points_missed", [])),
-                    "answered": result.get("answered", False)
-                }
-            
-            response_data["questionStats"] = question_stats
-        
-        # Convert response data to JSON serializable format
-        serializable_response = mongo_to_json_serializable(response_data)
-        
-        return jsonify(serializable_response), 200
-        
-    except Exception as e:
-        error_traceback = traceback.format_exc()
-        print(f"Error retrieving grading details: {str(e)}")
-        print(f"Traceback: {error_traceback}")
-        return jsonify({"msg": f"Server error: {str(e)}"}), 500
-
-@app.route("/api/classrooms/<classroom_id>/quizzes/student", methods=["GET"])
+    return jsonify(mongo_to_json_serializable({
+        "id": job["_id"],
+        "type": job["type"],
+        "status": job["status"],
+        "attempts": job.get("attempts", 0),
+        "maxAttempts": job.get("maxAttempts", JOB_MAX_ATTEMPTS),
+        "lastError": job.get("lastError"),
+        "result": job.get("result"),
+        "createdAt": job.get("createdAt"),
+        "updatedAt": job.get("updatedAt"),
+        "completedAt": job.get("completedAt")
+    })), 200
+
+@app.route("/api/classrooms/<classroom_id>/quizzes/<quiz_id>/submissions/<student_id>/regrade", methods=["POST"])
 @jwt_required()
-def get_student_quizzes(classroom_id):
-    """Get all quizzes for a classroom - student view"""
+def regrade_submission(classroom_id, quiz_id, student_id):
+    """Queue a PDF submission for re-grading; {"bypassCache": true} forces fresh LLM grades"""
     user_id = get_jwt_identity()
     
-    classroom, user, error = get_classroom_and_validate_access(classroom_id, user_id)
+    classroom, user, error = get_classroom_and_validate_access(classroom_id, user_id, "teacher")
     if error:
         return error
     
     try:
-        # Process quizzes for student view
-        current_time = get_current_ist_time()
-        
-        user_obj_id = ObjectId(user_id)
-        processed_quizzes = []
-        
-        for quiz in classroom.get("quizzes", []):
-            # Skip unpublished quizzes for students (but not for teachers)
-            if not quiz.get("published", True) and classroom["teacher_id"] != user_obj_id:
-                continue
-            
-            # Determine quiz status for this student
-            student_status = get_quiz_status(quiz, user_obj_id, current_time)
-            
-            # Identify quiz type
-            quiz_type = quiz.get("quizType", "question")  # Default to question type for backwards compatibility
-            
-            # Create base student-friendly quiz object
-            student_quiz = {
-                "id": str(quiz["id"]),
-                "title": quiz.get("title", "Untitled Quiz"),
-                "description": quiz.get("description", ""),
-                "startTime": quiz["startTime"],
-                "endTime": calculate_quiz_end_time(quiz),
-                "duration": int(quiz["duration"]),
-                "quizType": quiz_type,
-                "studentStatus": student_status,
-                "serverProvidedStatus": True  # Mark status as coming from server to prevent frontend recalculation
-            }
-            
-            # For PDF quizzes, add file information
-            if quiz_type == "pdf":
-                if "questionPaper" in quiz:
-                    student_quiz["questionPaper"] = {
-                        "filename": quiz["questionPaper"].get("filename", "question_paper.pdf"),
-                        "size": quiz["questionPaper"].get("size", 0)
-                    }
-            else:
-                # For legacy quizzes, use the existing prepare_quiz_for_student function
-                legacy_quiz = prepare_quiz_for_student(quiz)
-                student_quiz["questions"] = legacy_quiz.get("questions", [])
-            
-            # If quiz is submitted, include the submission time and score info
-            if student_status == "submitted":
-                for submission in quiz.get("submissions", []):
-                    if submission["student_id"] == user_obj_id:
-                        student_quiz["submittedAt"] = submission.get("endTime")
-                        student_quiz["score"] = submission.get("score", 0)
-                        student_quiz["maxScore"] = submission.get("maxScore", 0)
-                        student_quiz["percentage"] = round((submission.get("score", 0) / submission.get("maxScore", 1)) * 100, 1) if submission.get("maxScore", 0) > 0 else 0
-                        
-                        # For PDF quizzes, add grading status
-                        if quiz_type == "pdf":
-                            student_quiz["isGraded"] = submission.get("isGraded", False)
-                            if "answerFile" in submission:
-                                student_quiz["submission"] = {
-                                    "filename": submission["answerFile"].get("filename", "answer.pdf"),
-                                    "size": submission["answerFile"].get("size", 0)
-                                }
-                            if submission.get("isGraded", False):
-                                student_quiz["feedback"] = submission.get("feedback", "")
-                                
-                            # Add auto-grading info if available
-                            if submission.get("autoGraded", False):
-                                student_quiz["autoGraded"] = True
-                                if "questionGradingResults" in submission:
-                                    student_quiz["gradedQuestionCount"] = len(submission["questionGradingResults"])
-                                    student_quiz["gradingDetailUrl"] = f"/api/classrooms/{classroom_id}/quizzes/{str(quiz['id'])}/submissions/{user_id}/grading"
-                        break
-            
-            processed_quizzes.append(student_quiz)
-        
-        # Sort quizzes by start time (newest first)
-        def quiz_sort_key(quiz):
-            try:
-                return quiz.get("startTime", datetime.min)
-            except:
-                return datetime.min
-                
-        processed_quizzes.sort(key=quiz_sort_key, reverse=True)
-        
-        # Convert to JSON serializable format
-        serializable_quizzes = mongo_to_json_serializable(processed_quizzes)
+        submission = find_submission(classroom_id, quiz_id, student_id, projection={"_id": 1, "answerFile.filename": 1})
+        if not submission:
+            return jsonify({"msg": "Student submission not found"}), 404
+        if "answerFile" not in submission:
+            return jsonify({"msg": "This submission has no PDF file attached"}), 400
+        
+        data = request.get_json(silent=True) or {}
+        job_id = enqueue_job(
+            "grade_submission",
+            {"submission_id": submission["_id"], "bypassCache": bool(data.get("bypassCache", False))},
+            user_id=user_id,
+            classroom_id=classroom_id
+        )
+        submissions_collection.update_one(
+            {"_id": submission["_id"]},
+            {"$set": {"gradingStatus": "queued", "gradingJobId": job_id}}
+        )
         
-        return jsonify(serializable_quizzes), 200
+        return jsonify({
+            "msg": "Submission queued for re-grading",
+            "gradingStatus": "queued",
+            "jobId": str(job_id),
+            "statusUrl": url_for("get_job_status", job_id=str(job_id))
+        }), 202
         
     except Exception as e:
         error_traceback = traceback.format_exc()
-        print(f"Error getting student quizzes: {str(e)}")
+        print(f"Error queueing re-grade: {str(e)}")
         print(f"Traceback: {error_traceback}")
         return jsonify({"msg": f"Server error: {str(e)}"}), 500
 
@@ -4199,9 +6857,9 @@ def get_student_quizzes(classroom_id):
 def submit_quiz(classroom_id, quiz_id):
     """
     Submit a quiz with student answers or PDF submission.
-    For PDF submissions, the API extracts text using Google's Gemini 2.5 AI model
-    to make the content searchable and accessible. The extracted text is stored
-    alongside the original PDF submission for future reference and analysis.
+    PDF submissions are stored and answered with 202; text extraction,
+    segregation and auto-grading run as a background job whose progress can
+    be polled at /api/jobs/<job_id>.
     """
     user_id = get_jwt_identity()
     
@@ -4211,7 +6869,7 @@ def submit_quiz(classroom_id, quiz_id):
     
     try:
         # Find the quiz
-        quiz = find_quiz_by_id(classroom, quiz_id)
+        quiz = find_quiz_by_id(classroom_id, quiz_id)
         if not quiz:
             return jsonify({"msg": "Quiz not found"}), 404
         
@@ -4221,13 +6879,13 @@ def submit_quiz(classroom_id, quiz_id):
         
         # Check if student has already submitted
         user_obj_id = ObjectId(user_id)
-        if any(s["student_id"] == user_obj_id for s in quiz.get("submissions", [])):
+        if has_student_submitted(quiz, user_obj_id):
             return jsonify({"msg": "You have already submitted this quiz"}), 400
         
         # Check if quiz is still available (we'll be lenient for development)
         current_time = get_current_ist_time()
         
-        quiz_status = get_quiz_status(quiz, user_obj_id, current_time)
+        quiz_status = get_quiz_status(quiz, user_obj_id, current_time, has_submitted=False)
         
         if quiz_status == "missed":
             return jsonify({"msg": "This quiz has ended and cannot be submitted"}), 400
@@ -4248,78 +6906,25 @@ def submit_quiz(classroom_id, quiz_id):
             if not answer_file.filename.lower().endswith('.pdf'):
                 return jsonify({"msg": "Answer file must be a PDF"}), 400
                 
-            # Read the file
+            # Read the file and store it in GridFS
             answer_file_binary = answer_file.read()
+            answer_file_info = store_pdf_file(
+                answer_file_binary,
+                answer_file.filename,
+                metadata={"classroom_id": ObjectId(classroom_id), "quiz_id": quiz["id"], "student_id": user_obj_id}
+            )
             
-            # Extract text from the submitted PDF using Gemini 2.5
-            try:
-                print(f"\nExtracting text from student answer file: {answer_file.filename}")
-                print("Processing with Gemini 2.5...")
-                
-                # Extract text using Gemini 2.5
-                extracted_text = extract_text_from_pdf(answer_file_binary)
-                print(f"Successfully extracted {len(extracted_text)} characters from student answer")
-                print(f"Sample text: {extracted_text[:100]}...")
-                
-                # Segregate student answers by question number
-                print("Segregating student answers by question number...")
-                segregated_student_answers = segregate_questions_by_number(extracted_text, is_question_paper=False)
-                
-                # Create submission object with extracted text
-                submission = {
-                    "student_id": user_obj_id,
-                    "startTime": datetime.fromisoformat(request.form.get("startTime").replace('Z', '+00:00')) if "startTime" in request.form else current_time - timedelta(minutes=5),
-                    "endTime": current_time,
-                    "answerFile": {
-                        "filename": answer_file.filename,
-                        "content": Binary(answer_file_binary),
-                        "contentType": "application/pdf",
-                        "size": len(answer_file_binary)
-                    },
-                    "extractedText": extracted_text,  # Store the extracted text
-                    "segregatedAnswers": segregated_student_answers,  # Store segregated answers
-                    "score": 0,  # Score will be set by teacher after grading
-                    "maxScore": 100,  # Default max score
-                    "isGraded": False
-                }
-                
-                # Attempt to auto-grade if the quiz has an answer key with segregated answers
-                if "extractedText" in quiz and "segregatedAnswers" in quiz["extractedText"]:
-                    print("Answer key with segregated answers found. Attempting auto-grading...")
-                    try:
-                        # Auto-grade the submission
-                        graded_submission = auto_grade_submission(quiz, submission)
-                        
-                        # Use the graded submission
-                        submission = graded_submission
-                        print(f"Auto-grading successful. Score: {submission.get('score', 0)}/{submission.get('maxScore', 100)}")
-                    except Exception as grading_error:
-                        print(f"Error during auto-grading: {str(grading_error)}")
-                        traceback.print_exc()
-                        # Continue with ungraded submission
-                        submission["autoGradingError"] = str(grading_error)
-                else:
-                    print("Quiz does not have an answer key with segregated answers. Skipping auto-grading.")
-            except Exception as e:
-                print(f"Error extracting text from student answer: {str(e)}")
-                traceback.print_exc()
-                
-                # Create submission without extracted text if extraction fails
-                submission = {
-                    "student_id": user_obj_id,
-                    "startTime": datetime.fromisoformat(request.form.get("startTime").replace('Z', '+00:00')) if "startTime" in request.form else current_time - timedelta(minutes=5),
-                    "endTime": current_time,
-                    "answerFile": {
-                        "filename": answer_file.filename,
-                        "content": Binary(answer_file_binary),
-                        "contentType": "application/pdf",
-                        "size": len(answer_file_binary)
-                    },
-                    "extractionError": str(e),  # Store error message
-                    "score": 0,  # Score will be set by teacher after grading
-                    "maxScore": 100,  # Default max score
-                    "isGraded": False
-                }
+            # Extraction, segregation and auto-grading run in a background job
+            submission = {
+                "student_id": user_obj_id,
+                "startTime": datetime.fromisoformat(request.form.get("startTime").replace('Z', '+00:00')) if "startTime" in request.form else current_time - timedelta(minutes=5),
+                "endTime": current_time,
+                "answerFile": answer_file_info,
+                "score": 0,  # Score will be set by teacher after grading
+                "maxScore": 100,  # Default max score
+                "isGraded": False,
+                "gradingStatus": "queued"
+            }
         else:
             # Legacy quiz submission with questions and answers
             # Get submitted answers
@@ -4344,69 +6949,44 @@ def submit_quiz(classroom_id, quiz_id):
                 "answers": scored_answers
             }
         
-        # Add submission to quiz
-        result = classrooms_collection.update_one(
-            {"_id": ObjectId(classroom_id), "quizzes.id": ObjectId(quiz_id)},
-            {"$push": {"quizzes.$.submissions": submission}}
-        )
+        # Store the submission; the unique index rejects a concurrent duplicate
+        submission["classroom_id"] = ObjectId(classroom_id)
+        submission["quiz_id"] = quiz["id"]
+        try:
+            result = submissions_collection.insert_one(submission)
+        except DuplicateKeyError:
+            delete_pdf_file(submission.get("answerFile"))
+            return jsonify({"msg": "You have already submitted this quiz"}), 400
         
-        if not result.modified_count:
+        if not result.inserted_id:
             return jsonify({"msg": "Failed to submit quiz"}), 500
         
         # Create response based on quiz type
         if quiz_type == "pdf":
-            # For PDF quizzes, just confirm submission
-            response_data = {
-                "msg": "Quiz submitted successfully",
+            try:
+                job_id = enqueue_job(
+                    "grade_submission",
+                    {"submission_id": result.inserted_id},
+                    user_id=user_obj_id,
+                    classroom_id=classroom_id
+                )
+            except Exception as e:
+                # Undo the submission so the student can submit again
+                print(f"Error queueing grading for submission {result.inserted_id}: {str(e)}")
+                submissions_collection.delete_one({"_id": result.inserted_id})
+                delete_pdf_file(submission.get("answerFile"))
+                return jsonify({"msg": "Could not queue your submission for grading. Please submit again."}), 500
+            submissions_collection.update_one({"_id": result.inserted_id}, {"$set": {"gradingJobId": job_id}})
+            
+            return jsonify({
+                "msg": "Quiz submitted successfully. Your answers are being processed.",
                 "submissionTime": current_time.isoformat(),
                 "filename": submission["answerFile"]["filename"],
-                "fileSize": submission["answerFile"]["size"]
-            }
-            
-            # Add text extraction info if available
-            if "extractedText" in submission:
-                text_length = len(submission["extractedText"])
-                response_data["textExtracted"] = True
-                response_data["textLength"] = text_length
-                response_data["textPreview"] = submission["extractedText"][:100] + "..." if text_length > 100 else submission["extractedText"]
-                
-                # Add segregated answers info if available
-                if "segregatedAnswers" in submission:
-                    answer_count = len(submission["segregatedAnswers"]) - (1 if "0" in submission["segregatedAnswers"] else 0)
-                    response_data["answersSegregated"] = True
-                    response_data["answerCount"] = answer_count
-                    response_data["segregatedAnswersPreview"] = {
-                        k: v[:50] + "..." if len(v) > 50 else v
-                        for k, v in list(submission["segregatedAnswers"].items())[:3]
-                    }
-                
-                # Add auto-grading info if available
-                if submission.get("isGraded") and submission.get("autoGraded"):
-                    response_data["autoGraded"] = True
-                    response_data["score"] = submission.get("score", 0)
-                    response_data["maxScore"] = submission.get("maxScore", 100)
-                    response_data["percentage"] = submission.get("percentage", 0)
-                    response_data["gradedQuestionCount"] = len(submission.get("questionGradingResults", []))
-                    
-                    # Add preview of question scores
-                    if "questionGradingResults" in submission and len(submission["questionGradingResults"]) > 0:
-                        response_data["questionScores"] = {
-                            result["questionNumber"]: f"{result['score']}/{result['maxScore']}"
-                            for result in submission["questionGradingResults"][:3]  # Show first 3 questions
-                        }
-                        
-                        if len(submission["questionGradingResults"]) > 3:
-                            response_data["questionScores"]["..."] = f"and {len(submission['questionGradingResults']) - 3} more questions"
-                
-                # Add error information if auto-grading failed
-                if "autoGradingError" in submission:
-                    response_data["autoGradingError"] = submission["autoGradingError"]
-            
-            elif "extractionError" in submission:
-                response_data["textExtracted"] = False
-                response_data["extractionError"] = submission["extractionError"]
-            
-            return jsonify(response_data), 200
+                "fileSize": submission["answerFile"]["size"],
+                "gradingStatus": "queued",
+                "jobId": str(job_id),
+                "statusUrl": url_for("get_job_status", job_id=str(job_id))
+            }), 202
         else:
             # For legacy quizzes, return detailed results
             results = create_quiz_results_response(quiz, scored_answers, correct_count, total_questions)
@@ -4431,7 +7011,31 @@ def get_student_analytics():
     
     try:
         # Get all classrooms where student is enrolled
-        classrooms = list(classrooms_collection.find({"enrolled_students": user_obj_id}))
+        classrooms = list(classrooms_collection.find(
+            {"enrolled_students": user_obj_id},
+            {"className": 1, "subject": 1}
+        ))
+        classroom_ids = [classroom["_id"] for classroom in classrooms]
+        for classroom_id in classroom_ids:
+            migrate_classroom_quizzes(classroom_id)
+        
+        # Load quiz metadata for those classrooms and this student's submissions only
+        quizzes_by_classroom = {}
+        quiz_cursor = quizzes_collection.find(
+            {"classroom_id": {"$in": classroom_ids}},
+            {"id": 1, "classroom_id": 1, "title": 1, "quizType": 1, "published": 1}
+        ).sort("_id", ASCENDING)
+        for quiz in quiz_cursor:
+            quizzes_by_classroom.setdefault(quiz["classroom_id"], []).append(quiz)
+        
+        student_submissions = {
+            submission["quiz_id"]: submission
+            for submission in submissions_collection.find(
+                {"student_id": user_obj_id, "classroom_id": {"$in": classroom_ids}},
+                {"quiz_id": 1, "score": 1, "maxScore": 1, "endTime": 1, "feedback": 1,
+                 "isGraded": 1, "questionGradingResults": 1}
+            )
+        }
         
         # Initialize analytics data
         analytics = {
@@ -4474,7 +7078,7 @@ def get_student_analytics():
             }
             
             # Process quizzes in this classroom
-            for quiz in classroom.get("quizzes", []):
+            for quiz in quizzes_by_classroom.get(classroom["_id"], []):
                 if not quiz.get("published", True):
                     continue
                     
@@ -4484,8 +7088,7 @@ def get_student_analytics():
                 classroom_analytics["totalQuizzes"] += 1
                 
                 # Find student's submission
-                submission = next((sub for sub in quiz.get("submissions", []) 
-                                if sub["student_id"] == user_obj_id), None)
+                submission = student_submissions.get(quiz["id"])
                 
                 if submission:
                     # Get submission details
@@ -4598,20 +7201,17 @@ def get_student_analytics():
             for month in sorted_months
         ]
         
+        # Fetch the scores of every submission to the attempted quizzes in one query
+        quiz_submissions = group_submissions_by_quiz(submissions_collection.find(
+            {"classroom_id": {"$in": classroom_ids}, "quiz_id": {"$in": list(student_submissions.keys())}},
+            {"quiz_id": 1, "student_id": 1, "score": 1, "maxScore": 1}
+        ))
+        
         # Calculate and sort rankings for each quiz
         for classroom_id, classroom_data in analytics["classroomWise"].items():
             for quiz in classroom_data["quizzes"]:
-                # Get all submissions for this quiz
-                classroom = classrooms_collection.find_one({"_id": ObjectId(classroom_id)})
-                if not classroom:
-                    continue
-                    
-                quiz_obj = next((q for q in classroom.get("quizzes", []) if str(q["id"]) == quiz["quizId"]), None)
-                if not quiz_obj:
-                    continue
-                    
                 # Calculate rankings
-                submissions = quiz_obj.get("submissions", [])
+                submissions = quiz_submissions.get(ObjectId(quiz["quizId"]), [])
                 sorted_submissions = sorted(
                     submissions,
                     key=lambda x: (x.get("score", 0) / x.get("maxScore", 1)) if x.get("maxScore", 0) > 0 else 0,
@@ -4659,17 +7259,31 @@ def get_classroom_analytics(classroom_id):
     
     try:
         # Get classroom and validate access
-        classroom, user, error = get_classroom_and_validate_access(classroom_id, user_id)
+        classroom, user, error = get_classroom_and_validate_access(
+            classroom_id, user_id,
+            projection={"teacher_id": 1, "className": 1, "enrolled_students": 1}
+        )
         if error:
             return error
             
         is_teacher = classroom["teacher_id"] == ObjectId(user_id)
         
+        # Load quiz metadata and submission scores, never the PDFs or extracted text
+        quizzes = list_classroom_quizzes(
+            classroom_id,
+            projection={"id": 1, "title": 1, "quizType": 1, "startTime": 1}
+        )
+        submissions_by_quiz = group_submissions_by_quiz(submissions_collection.find(
+            {"classroom_id": ObjectId(classroom_id)},
+            {"quiz_id": 1, "student_id": 1, "score": 1, "maxScore": 1, "endTime": 1,
+             "questionGradingResults": 1}
+        ))
+        
         # Initialize analytics
         analytics = {
             "overview": {
                 "totalStudents": len(classroom.get("enrolled_students", [])),
-                "totalQuizzes": len(classroom.get("quizzes", [])),
+                "totalQuizzes": len(quizzes),
                 "averageParticipation": 0,
                 "averageScore": 0
             },
@@ -4685,10 +7299,10 @@ def get_classroom_analytics(classroom_id):
         total_submissions = 0
         
         # Process each quiz
-        for quiz in classroom.get("quizzes", []):
+        for quiz in quizzes:
             quiz_id = str(quiz["id"])
             quiz_type = quiz.get("quizType", "question")
-            submissions = quiz.get("submissions", [])
+            submissions = submissions_by_quiz.get(quiz["id"], [])
             
             # Update quiz type count
             analytics["quizTypeDistribution"][quiz_type] += 1
@@ -4770,7 +7384,7 @@ def get_classroom_analytics(classroom_id):
             })
         
         # Calculate overall statistics
-        quiz_count = len(classroom.get("quizzes", []))
+        quiz_count = len(quizzes)
         if quiz_count > 0:
             analytics["overview"]["averageParticipation"] = round((total_participation / quiz_count) * 100, 1)
         
@@ -4782,8 +7396,9 @@ def get_classroom_analytics(classroom_id):
             student_performance = {}
             
             # Process each student's performance
+            students = resolve_users(classroom.get("enrolled_students", []))
             for student_id in classroom.get("enrolled_students", []):
-                student = users_collection.find_one({"_id": student_id})
+                student = students.get(student_id)
                 if not student:
                     continue
                     
@@ -4798,8 +7413,8 @@ def get_classroom_analytics(classroom_id):
                 }
                 
                 # Get student's submissions across all quizzes
-                for quiz in classroom.get("quizzes", []):
-                    submission = next((sub for sub in quiz.get("submissions", [])
+                for quiz in quizzes:
+                    submission = next((sub for sub in submissions_by_quiz.get(quiz["id"], [])
                                     if sub["student_id"] == student_id), None)
                     
                     if submission:
@@ -4859,20 +7474,15 @@ def update_question_grade(classroom_id, quiz_id, student_id):
     
     try:
         # Find the quiz
-        quiz = find_quiz_by_id(classroom, quiz_id)
+        quiz = find_quiz_by_id(classroom_id, quiz_id, projection={"_id": 1})
         if not quiz:
             return jsonify({"msg": "Quiz not found"}), 404
         
         # Find the student's submission
-        student_obj_id = ObjectId(student_id)
-        submission = None
-        submission_index = -1
-        
-        for i, sub in enumerate(quiz.get("submissions", [])):
-            if sub["student_id"] == student_obj_id:
-                submission = sub
-                submission_index = i
-                break
+        submission = find_submission(
+            classroom_id, quiz_id, student_id,
+            projection={"score": 1, "maxScore": 1, "percentage": 1, "questionGradingResults": 1}
+        )
                 
         if not submission:
             return jsonify({"msg": "Student submission not found"}), 404
@@ -4919,14 +7529,16 @@ def update_question_grade(classroom_id, quiz_id, student_id):
         if not question_found:
             return jsonify({"msg": f"Question number {question_number} not found in grading results"}), 404
         
-        # Update the submission in the quiz
-        quiz["submissions"][submission_index] = submission
-        
-        # Update the quiz in the database
-        result = classrooms_collection.update_one(
-            {"_id": ObjectId(classroom_id)},
-            {"$set": {f"quizzes.$[quiz].submissions": quiz["submissions"]}},
-            array_filters=[{"quiz.id": ObjectId(quiz_id)}]
+        # Update the submission in the database
+        updated_fields = {
+            "score": submission["score"],
+            "questionGradingResults": submission["questionGradingResults"]
+        }
+        if "percentage" in submission:
+            updated_fields["percentage"] = submission["percentage"]
+        result = submissions_collection.update_one(
+            {"_id": submission["_id"]},
+            {"$set": updated_fields}
         )
         
         if result.modified_count:
@@ -4978,9 +7590,23 @@ def get_enrolled_students():
                 print(f"Fetching enrolled students for teacher: {user.get('fullName', 'Unknown')}")
                 
                 # Get all classrooms where this teacher is the owner
-                teacher_classrooms = list(classrooms_collection.find({"teacher_id": ObjectId(user_id)}))
+                teacher_classrooms = list(classrooms_collection.find(
+                    {"teacher_id": ObjectId(user_id)},
+                    {"quizzes": 0, "announcements": 0}
+                ))
                 print(f"Found {len(teacher_classrooms)} classrooms for this teacher")
                 
+                quizzes_by_classroom = {}
+                if include_quiz_data:
+                    quizzes_by_classroom = load_quizzes_with_submissions([c["_id"] for c in teacher_classrooms])
+                
+                # Load every enrolled student's profile in one query
+                students = resolve_users(
+                    [student_id for c in teacher_classrooms for student_id in c.get("enrolled_students", [])],
+                    projection={"fullName": 1, "email": 1, "institution": 1, "department": 1,
+                                "phone": 1, "title": 1, "bio": 1, "createdAt": 1}
+                )
+                
                 result = []
                 student_counts = {}
                 
@@ -4994,12 +7620,12 @@ def get_enrolled_students():
                     }
                     
                     # Include quiz data if requested
-                    if include_quiz_data and "quizzes" in classroom:
+                    if include_quiz_data and quizzes_by_classroom.get(classroom["_id"]):
                         print(f"Including quiz data for classroom {classroom_data['name']}")
                         # Create a clean version of quizzes without binary content
                         classroom_data["quizzes"] = []
                         
-                        for quiz in classroom.get("quizzes", []):
+                        for quiz in quizzes_by_classroom[classroom["_id"]]:
                             # Make a copy of the quiz without binary content
                             clean_quiz = {
                                 "id": str(quiz.get("id")) if isinstance(quiz.get("id"), ObjectId) else quiz.get("id"),
@@ -5037,7 +7663,7 @@ def get_enrolled_students():
                     print(f"Classroom {classroom_data['name']} has {len(enrolled_student_ids)} enrolled students")
                     
                     for student_id in enrolled_student_ids:
-                        student = users_collection.find_one({"_id": student_id})
+                        student = students.get(student_id)
                         if student:
                             # Count student across all classrooms
                             student_id_str = str(student["_id"])
@@ -5325,7 +7951,90 @@ def get_enrolled_students():
         "isSampleData": True
     }), 200
 
+# ============ APP FACTORY / HEALTH ============
+
+# Boot state reported by /api/ready
+BOOT_STATUS = {
+    "importSeconds": None,
+    "bootSeconds": None,
+    "indexesReady": False,
+    "indexErrors": [],
+    "progressEventsReady": False,
+}
+_boot_started = False
+_boot_lock = threading.Lock()
+
+def boot_indexes():
+    """Create the registered indexes off the request path and record the outcome"""
+    BOOT_STATUS["progressEventsReady"] = ensure_progress_events_collection()
+    try:
+        failures = ensure_indexes()
+        BOOT_STATUS["indexErrors"] = [f"{name} {keys}: {error}" for name, keys, error in failures]
+        BOOT_STATUS["indexesReady"] = not failures
+    except Exception as e:
+        print("Error creating indexes:", e)
+        BOOT_STATUS["indexErrors"] = [str(e)]
+    BOOT_STATUS["bootSeconds"] = round(time.perf_counter() - _import_started, 3)
+    print(f"Boot finished in {BOOT_STATUS['bootSeconds']}s (indexes ready: {BOOT_STATUS['indexesReady']})")
+
+def create_app():
+    """
+    App factory used by the servers (`gunicorn 'main:create_app()'`).
+    
+    Importing this module only builds the Flask app and cheap handles; the
+    one-off boot work (index creation) runs here in a background thread so
+    the worker starts taking /api/health checks immediately, and
+    /api/ready reports when it is done. Safe to call more than once.
+    """
+    global _boot_started
+    if not _boot_started:
+        with _boot_lock:
+            if not _boot_started:
+                threading.Thread(target=boot_indexes, daemon=True, name="boot-indexes").start()
+                _boot_started = True
+    return app
+
+@app.route("/api/health", methods=["GET"])
+def health_check():
+    """Liveness probe: the process is up and serving requests"""
+    return jsonify({"status": "ok"}), 200
+
+@app.route("/api/ready", methods=["GET"])
+def readiness_check():
+    """Readiness probe: MongoDB answers, indexes are in place and the LLM backend is configured"""
+    checks = {}
+    
+    try:
+        client.admin.command("ping")
+        checks["mongo"] = "ok"
+    except Exception as e:
+        checks["mongo"] = f"error: {str(e)}"
+    
+    if BOOT_STATUS["indexesReady"]:
+        checks["indexes"] = "ok"
+    elif BOOT_STATUS["indexErrors"]:
+        checks["indexes"] = "error: " + "; ".join(BOOT_STATUS["indexErrors"])
+    else:
+        checks["indexes"] = "pending"
+    
+    # Only the local configuration is checked; the probe never calls the LLM
+    llm_error = llm_backend.config_error()
+    checks["llm"] = f"error: {llm_error}" if llm_error else "ok"
+    
+    ready = all(value == "ok" for value in checks.values())
+    return jsonify({
+        "status": "ready" if ready else "not_ready",
+        "checks": checks,
+        "llmBackend": llm_backend.name,
+        "importSeconds": BOOT_STATUS["importSeconds"],
+        "bootSeconds": BOOT_STATUS["bootSeconds"]
+    }), 200 if ready else 503
+
+BOOT_STATUS["importSeconds"] = round(time.perf_counter() - _import_started, 3)
+print(f"Imported main in {BOOT_STATUS['importSeconds']}s")
+
 if __name__ == "__main__":
+    create_app()
     port = int(os.environ.get("PORT", 5000))
     host = os.environ.get("HOST", "0.0.0.0")
     debug = os.environ.get("FLASK_ENV") == "development"